@@ -0,0 +1,91 @@
+# This script times the declarative adjustment specs of the antenne
+# cleaning against the former row-wise df.apply path, on dose tables
+# shaped like those of the 2023 report, and checks that both give the
+# same columns. Run it from the codes folder.
+
+import sys
+import time
+import inspect
+import numpy as np
+import pandas as pd
+from data_construction.antenne_reports_cleaning_utils import compile_adjustments
+
+TWOCB_SUFFIXES = ['2', '3', '2', '4', '4', '2', '3', '3', '6', '7', '0', '7']
+
+# Former adjustments, and the spec replacing them
+LEGACY_ADJUSTMENTS = [
+    {'column': 'Unnamed: 0', 'function': lambda x: x + 2000 if x < 50 else x + 1000},
+    {'column': 'Unnamed: 1', 'function': lambda x: x * 1000 if x < 10 else x},
+    {'column': 'Unnamed: 3', 'function': lambda x: x * 1000 if x < 10 else x},
+    {'column': 'Unnamed: 5', 'function': lambda x, i: x + TWOCB_SUFFIXES[i % len(TWOCB_SUFFIXES)]},
+]
+SPEC_ADJUSTMENTS = [
+    {'op': 'offset', 'column': 'Unnamed: 0', 'value': 2000, 'below': 50, 'otherwise': 1000},
+    {'op': 'scale', 'column': 'Unnamed: 1', 'factor': 1000, 'below': 10},
+    {'op': 'scale', 'column': 'Unnamed: 3', 'factor': 1000, 'below': 10},
+]
+
+
+def dose_table(n_rows, seed=0):
+    '''Dose table with the columns and value ranges of the 2023 report'''
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'Unnamed: 0': rng.integers(0, 100, n_rows).astype(float),
+        'Unnamed: 1': rng.choice([1.2, 2.5, 150.0, 320.0, np.nan], n_rows),
+        'Unnamed: 2': [f'{a}-{a + b}' for a, b in rng.integers(50, 150, (n_rows, 2))],
+        'Unnamed: 3': rng.integers(1, 400, n_rows),
+        'Unnamed: 5': [f'{p},{q}' for p, q in rng.integers(1, 20, (n_rows, 2))],
+        'dosering': [f'{m} ({s})' for m, s in rng.integers(50, 200, (n_rows, 2))],
+    })
+
+
+def apply_legacy(df, adjustments):
+    '''Former path: one df.apply(axis=1) per adjustment'''
+    for adjustment in adjustments:
+        column = adjustment['column']
+        function = adjustment['function']
+        function_args = inspect.signature(function).parameters
+        if len(function_args) == 1:
+            df[column] = df.apply(lambda row: function(row[column]), axis=1)
+        else:
+            df[column] = df.apply(lambda row: function(row[column], row.name), axis=1)
+    return df
+
+
+def time_paths(n_rows, repeat=5):
+    '''Best time of each path on a table of n_rows, checking their output'''
+    spec = SPEC_ADJUSTMENTS + [{
+        'op': 'suffix',
+        'column': 'Unnamed: 5',
+        'suffixes': [TWOCB_SUFFIXES[i % len(TWOCB_SUFFIXES)] for i in range(n_rows)]
+    }]
+    adjust = compile_adjustments(spec)
+    table = dose_table(n_rows)
+
+    pd.testing.assert_frame_equal(
+        apply_legacy(table.copy(), LEGACY_ADJUSTMENTS), adjust(table.copy())
+    )
+
+    timings = {}
+    for name, function in [
+            ('apply', lambda df: apply_legacy(df, LEGACY_ADJUSTMENTS)),
+            ('spec', adjust)]:
+        best = float('inf')
+        for _ in range(repeat):
+            df = table.copy()
+            start_time = time.perf_counter()
+            function(df)
+            best = min(best, time.perf_counter() - start_time)
+        timings[name] = best
+
+    print(
+        f"{n_rows} rows: apply {timings['apply'] * 1000:.2f} ms, "
+        f"spec {timings['spec'] * 1000:.2f} ms, "
+        f"x{timings['apply'] / timings['spec']:.1f} (identical output)"
+    )
+    return timings
+
+
+if __name__ == '__main__':
+    for n_rows in [int(arg) for arg in sys.argv[1:]] or [12, 1000, 100000]:
+        time_paths(n_rows)
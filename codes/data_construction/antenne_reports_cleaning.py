@@ -4,9 +4,12 @@ from data_construction.antenne_reports_cleaning_utils import (
     clean_purity_data,
     get_paths
 )
+from data_construction.table_store import open_store, YearTables
 
 paths = get_paths()
 path_2023 = paths["antenne"]["csv"] + 'antenne_amsterdam_2023/'
+# Tables of the 2023 report, from the table store if pyarrow is installed
+tables_2023 = YearTables(open_store(), 'antenne', 2023, path_2023)
 
 # TOTAL SAMPLES DATA
 
@@ -47,7 +50,8 @@ clean_total_reports_data(
     COLUMN_MAP_TOTAL_SAMPLES,
     faulty_rows,
     changes,
-    units
+    units,
+    tables=tables_2023
 )
 
 # DOSES DATA
@@ -66,33 +70,41 @@ SUBSTANCE_SETTINGS_DOSES = {
     'mdma': {
         'adjustments': [
             {
+                'op': 'offset',
                 'column': COLUMN_MAP_DOSES['year'],
-                'function': lambda x: x + 2000 if x < 50 else x + 1000
+                'value': 2000,
+                'below': 50,
+                'otherwise': 1000
             },
             {
+                'op': 'scale',
                 'column': COLUMN_MAP_DOSES['n_samples'],
-                'function': lambda x: x * 1000 if x < 10 else x
+                'factor': 1000,
+                'below': 10
             },
             {
+                'op': 'scale',
                 'column': COLUMN_MAP_DOSES['n_prices_default'],
-                'function': lambda x: x * 1000 if x < 10 else x
+                'factor': 1000,
+                'below': 10
             },
         ]
     },
     'cocaine': {
         'adjustments': [
             {
+                'op': 'offset',
                 'column': COLUMN_MAP_DOSES['year'],
-                'function': lambda x: x + 2000
+                'value': 2000
             }
         ]
     },
     'twocb': {
         'adjustments': [
             {
+                'op': 'suffix',
                 'column': 'Unnamed: 5',
-                'function': lambda x, i: x + ['2', '3', '2', '4', '4', '2', '3', '3', '6', '7', '0', '7'][i],
-                'index': True
+                'suffixes': ['2', '3', '2', '4', '4', '2', '3', '3', '6', '7', '0', '7']
             },
         ],
         'drop_columns': ['Unnamed: 3'],
@@ -110,8 +122,9 @@ SUBSTANCE_SETTINGS_DOSES = {
     'lsd': {
         'adjustments': [
             {
+                'op': 'offset',
                 'column': COLUMN_MAP_DOSES['year'],
-                'function': lambda x: x + 2000
+                'value': 2000
             }
         ],
         'price_column': 'prijs',
@@ -134,7 +147,8 @@ for substance, file_name in substances_doses:
         substance, file_name,
         path_2023,
         SUBSTANCE_SETTINGS_DOSES,
-        COLUMN_MAP_DOSES
+        COLUMN_MAP_DOSES,
+        tables=tables_2023
     )
 
 # PURITY DATA
@@ -168,5 +182,6 @@ for substance, file_name in substances_purity:
         file_name,
         path_2023,
         COLUMN_MAP_PURITY,
-        TRANSLATIONS
+        TRANSLATIONS,
+        tables=tables_2023
     )
@@ -1,6 +1,92 @@
 import pandas as pd
 import numpy as np
-import inspect
+
+
+def offset_column(df, column, value, below=None, otherwise=None):
+    '''Adds value to a column, or otherwise where it is not below a threshold'''
+    x = df[column]
+    if below is None:
+        df[column] = x + value
+    else:
+        df[column] = np.where(x < below, x + value, x + otherwise)
+    return df
+
+
+def scale_column(df, column, factor, below):
+    '''Multiplies the values of a column below a threshold by factor'''
+    x = df[column]
+    df[column] = np.where(x < below, x * factor, x)
+    return df
+
+
+def suffix_column(df, column, suffixes):
+    '''Appends to each string of a column the suffix at its row position'''
+    if len(suffixes) < len(df):
+        raise ValueError(f"{len(suffixes)} suffixes for the {len(df)} rows of {column}")
+    df[column] = df[column].to_numpy(dtype=object) + np.array(suffixes[:len(df)], dtype=object)
+    return df
+
+
+def split_column(df, column, into, separators=('-', ' '), only_if_present=False):
+    '''Splits a string column into new columns
+
+    The separator is the first of separators found in the first non-null
+    row, or the last one. With only_if_present, the column is only split
+    if some row holds the separator.
+    '''
+    separator = separators[-1]
+    if len(separators) > 1:
+        present = df[column].dropna()
+        if len(present):
+            first = present.iloc[0]
+            separator = next((sep for sep in separators if sep in first), separator)
+    if only_if_present and not df[column].str.contains(separator, regex=False).any():
+        return df
+    df[into] = df[column].str.split(separator, expand=True)
+    return df
+
+
+# Operations of the adjustment specs
+ADJUSTMENT_OPERATIONS = {
+    'offset': offset_column,
+    'scale': scale_column,
+    'suffix': suffix_column,
+    'split': split_column,
+}
+
+
+def compile_adjustments(adjustments):
+    '''Compiles a declarative adjustment spec into column operations
+
+    Each adjustment is a dict with the 'op' and 'column' to apply it to,
+    and the arguments of the operation:
+        offset  value, and optionally below and otherwise: adds value, or
+                otherwise where the column is not below the threshold
+        scale   factor, below: multiplies the values below the threshold
+        suffix  suffixes: appends the suffix at each row position
+        split   into, and optionally separators and only_if_present
+    Returns a function applying the adjustments to a dataframe in order,
+    each as a single vectorized operation on its column.
+    '''
+    steps = []
+    for adjustment in adjustments:
+        arguments = dict(adjustment)
+        op = arguments.pop('op')
+        if op not in ADJUSTMENT_OPERATIONS:
+            raise ValueError(f"Unknown adjustment: {op}")
+        steps.append((ADJUSTMENT_OPERATIONS[op], arguments))
+
+    def apply(df):
+        for operation, arguments in steps:
+            df = operation(df, **arguments)
+        return df
+
+    return apply
+
+
+def apply_adjustments(df, adjustments):
+    '''Applies a declarative adjustment spec to a dataframe'''
+    return compile_adjustments(adjustments)(df)
 
 
 def clean_total_reports_data(
@@ -9,11 +95,12 @@ def clean_total_reports_data(
         column_map,
         faulty_rows,
         changes,
-        units
+        units,
+        tables=None
         ):
 
-    # Read the CSV file into a DataFrame
-    df = pd.read_csv(path + file_name)
+    # Read the table, from the table store if the year's tables are given
+    df = tables.read(file_name) if tables is not None else pd.read_csv(path + file_name)
 
     # Drop the specified faulty rows and reset the index
     df = df.drop(index=faulty_rows).reset_index(drop=True)
@@ -26,8 +113,10 @@ def clean_total_reports_data(
     df.rename(columns=column_map, inplace=True)
 
     # Scale the specified columns' values by 1000 if they are less than 10
-    for variable in units:
-        df[variable] = df[variable].apply(lambda x: x * 1000 if x < 10 else x)
+    df = apply_adjustments(df, [
+        {'op': 'scale', 'column': variable, 'factor': 1000, 'below': 10}
+        for variable in units
+    ])
 
     # Fill NaN values with 0 and convert all values to integers
     df = df.fillna(0).astype(int)
@@ -42,32 +131,20 @@ def clean_dosering_data(
         file_name,
         path,
         substance_settings,
-        column_map
+        column_map,
+        tables=None
         ):
 
-    df = pd.read_csv(path + file_name)
+    df = tables.read(file_name) if tables is not None else pd.read_csv(path + file_name)
     df = df.drop(index=[0, 1]).reset_index(drop=True)
 
     # Get the substance-specific settings
     settings = substance_settings.get(substance, {})
 
     # Apply adjustments
-    for adjustment in settings.get('adjustments', []):
-        column = adjustment['column']
-        function = adjustment['function']
-        function_args = inspect.signature(function).parameters
-        if len(function_args) == 1:
-            df[column] = df.apply(
-                lambda row: function(row[column]),
-                axis=1
-            )
-        else:
-            df[column] = df.apply(
-                lambda row: function(row[column], row.name),
-                axis=1
-            )
-
-    # Column splitting
+    df = apply_adjustments(df, settings.get('adjustments', []))
+
+    # Column splitting, on '-' if the first row holds one and on ' ' otherwise
     split_columns = settings.get(
         'split_columns',
         {
@@ -76,12 +153,10 @@ def clean_dosering_data(
         }
     )
 
-    for col, new_cols in split_columns.items():
-        df[new_cols] = (
-            df[col].str.split('-', expand=True)
-            if '-' in df[col].iloc[0]
-            else df[col].str.split(' ', expand=True)
-        )
+    df = apply_adjustments(df, [
+        {'op': 'split', 'column': col, 'into': new_cols}
+        for col, new_cols in split_columns.items()
+    ])
 
     # Get the price and number of samples priced columns
     price_col = settings.get(
@@ -146,19 +221,27 @@ def clean_purity_data(
         file_name,
         path,
         column_map,
-        translations
+        translations,
+        tables=None
         ):
 
-    df = pd.read_csv(path + file_name)
+    df = tables.read(file_name) if tables is not None else pd.read_csv(path + file_name)
     df = df.drop(index=[0]).reset_index(drop=True)
 
     # Rename specific columns
     df.rename(columns=column_map, inplace=True)
 
     # Split columns with multiple values
-    for col, eng_col in translations.items():
-        if df[col].str.contains(' ').any():
-            df[[f'N_{eng_col}_{substance}', f'{eng_col}_{substance}_pct']] = df[col].str.split(' ', expand=True)
+    df = apply_adjustments(df, [
+        {
+            'op': 'split',
+            'column': col,
+            'into': [f'N_{eng_col}_{substance}', f'{eng_col}_{substance}_pct'],
+            'separators': [' '],
+            'only_if_present': True
+        }
+        for col, eng_col in translations.items()
+    ])
     df.drop(columns=translations.keys(), inplace=True)
 
     # Convert columns to numeric
@@ -174,7 +257,7 @@ def clean_purity_data(
         )
         df = pd.concat([df, missing_row_2023.to_frame().T], ignore_index=True)
     elif substance in ['ketamine', 'lsd']:
-        df['year'] = df['year'] + 2000
+        df = apply_adjustments(df, [{'op': 'offset', 'column': 'year', 'value': 2000}])
 
     # Save processed data
     testservice_path = r'./data/processed/antenne_reports/testservice/'
@@ -4,23 +4,37 @@
 # General purpose
 import os
 import re
+import math
+import json
+import time
+import queue
+import tempfile
+import threading
 import torch
+from functools import lru_cache
 
 # PDF scraping
 import requests
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # PDF to image conversion
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
+from data_construction.pdf_rasterizer import iter_pdfium_pages, document_pool
 
 # Table extraction (tensors)
 from PIL import Image
 
 # Read tables and save them as .csv
 import tabula
+import numpy as np
 import pandas as pd
 
+# Locate tables from the text layer of born-digital PDFs
+from data_construction.text_layer_tables import text_layer_detections
+
 
 # Load the links
 def read_link(file_path):
@@ -54,12 +68,143 @@ def get_paths():
     return paths
 
 
-def download_reports(url, download_folder):
-    """Download PDF reports from the HvA webpage."""
+def get_year_paths(report, year):
+    """Returns the PDF and the intermediate folders of a report's year."""
+    paths = get_paths()[report]
+
+    if report == "antenne":
+        pdf_name, folder_name = f"antenne-amsterdam-{year}.pdf", f"antenne_amsterdam_{year}"
+    elif report == "national":
+        pdf_name, folder_name = f"NDM-{year}.pdf", f"national_report_{year}"
+    else:
+        raise ValueError(f"Unknown report: {report}")
+
+    return {
+        "pdf": paths["source"] + pdf_name,
+        "img": paths["img"] + folder_name,
+        "tens": paths["tens"] + folder_name,
+        "csv": paths["csv"] + folder_name,
+    }
+
+
+# Candidate boxes of every page of a report year, with scores and labels
+DETECTIONS_FILE = "detections.pt"
+
+# Checkpoint of the table detector
+DETECTOR_CHECKPOINT = "microsoft/table-transformer-detection"
+
+# dpi value rendering each page at the detector's input resolution
+DETECT_DPI = "detect"
+
+# Sidecar file storing the ETag/Last-Modified of the downloaded PDFs
+DOWNLOADS_MANIFEST = ".downloads.json"
+
+
+def load_downloads_manifest(download_folder):
+    """Load the validators of the PDFs downloaded to a folder."""
+    manifest_path = os.path.join(download_folder, DOWNLOADS_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_downloads_manifest(download_folder, manifest):
+    manifest_path = os.path.join(download_folder, DOWNLOADS_MANIFEST)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def download_pdf(session, url, download_folder, record, chunk_size=1 << 16):
+    """Stream a PDF to disk, resuming partial files and skipping unchanged ones.
+
+    `record` holds the validators (ETag, Last-Modified) and local file name
+    of a previous download of the same URL. Existing files are requested
+    conditionally, and partial `.part` files are resumed with a Range
+    request guarded by If-Range. The validators of a download are saved
+    next to its `.part` file as soon as the response headers arrive, so
+    an interrupted first download can be resumed too. A `.part` file the
+    server answers 416 (range not satisfiable) for is kept if it holds the
+    whole file, e.g. after a crash before its rename, and is downloaded
+    again otherwise. Returns the status and the updated record.
+    """
+    pdf_path = os.path.join(download_folder, record.get("file") or url.split("/")[-1])
+    part_path = os.path.join(download_folder, url.split("/")[-1] + ".part")
+    part_record_path = part_path + ".json"
+
+    headers = {}
+    validator = record.get("etag") or record.get("last_modified")
+    if os.path.exists(pdf_path) and validator:
+        if record.get("etag"):
+            headers["If-None-Match"] = record["etag"]
+        if record.get("last_modified"):
+            headers["If-Modified-Since"] = record["last_modified"]
+    elif os.path.exists(part_path) and os.path.exists(part_record_path):
+        with open(part_record_path, "r") as f:
+            part_record = json.load(f)
+        part_validator = part_record.get("etag") or part_record.get("last_modified")
+        if part_validator:
+            headers["Range"] = f"bytes={os.path.getsize(part_path)}-"
+            headers["If-Range"] = part_validator
+
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 304:
+            return "unchanged", record
+        complete = None
+        if response.status_code == 416 and "Range" in headers:
+            # Range starting past the end: compare the .part file to the total
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            complete = total == str(os.path.getsize(part_path))
+        else:
+            response.raise_for_status()
+
+            new_record = {
+                "file": url.split("/")[-1],
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+
+            resumed = response.status_code == 206
+            if not resumed:
+                # Validators of the bytes about to be written to the .part file
+                with open(part_record_path, "w") as f:
+                    json.dump(new_record, f)
+            with open(part_path, "ab" if resumed else "wb") as pdf_file:
+                for chunk in response.iter_content(chunk_size):
+                    pdf_file.write(chunk)
+
+    if complete is False:
+        # Start over without the .part file
+        os.remove(part_path)
+        os.remove(part_record_path)
+        return download_pdf(session, url, download_folder, record, chunk_size)
+    if complete:
+        new_record = part_record
+        resumed = True
+
+    os.replace(part_path, os.path.join(download_folder, new_record["file"]))
+    os.remove(part_record_path)
+    return "resumed" if resumed else "downloaded", new_record
+
+
+def download_reports(url, download_folder, max_workers=4):
+    """Download PDF reports from the HvA webpage.
+
+    PDFs are fetched concurrently through a pooled session and streamed to
+    disk. Files that did not change since the last run (according to the
+    ETag or Last-Modified stored in the folder's sidecar manifest) are
+    skipped, and interrupted downloads are resumed.
+    """
     print("Downloading the reports from the HvA webpage...")
 
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
     # Get the HTML content of the webpage
-    response = requests.get(url)
+    response = session.get(url)
     if response.status_code != 200:
         print("Failed to retrieve the webpage.")
         return
@@ -74,24 +219,33 @@ def download_reports(url, download_folder):
         if link["href"].endswith(".pdf")
     ]
 
-    # Download each PDF file
-    for pdf_link in pdf_links:
-        try:
-            pdf_response = requests.get(pdf_link)
-            pdf_response.raise_for_status()
-
-            # Extract the file name from the link
+    # Download the PDF files concurrently
+    manifest = load_downloads_manifest(download_folder)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                download_pdf,
+                session,
+                pdf_link,
+                download_folder,
+                manifest.get(pdf_link, {})
+            ): pdf_link
+            for pdf_link in dict.fromkeys(pdf_links)
+        }
+        for future in as_completed(futures):
+            pdf_link = futures[future]
             pdf_name = pdf_link.split("/")[-1]
-
-            # Save the PDF to the folder
-            pdf_path = os.path.join(download_folder, pdf_name)
-            with open(pdf_path, "wb") as pdf_file:
-                pdf_file.write(pdf_response.content)
-
-            print(f"Downloaded: {pdf_name}")
-        except requests.exceptions.RequestException as e:
-            print(f"Failed to download {pdf_link}: {e}")
-
+            try:
+                status, manifest[pdf_link] = future.result()
+                save_downloads_manifest(download_folder, manifest)
+                if status == "unchanged":
+                    print(f"Unchanged: {pdf_name}")
+                else:
+                    print(f"Downloaded: {pdf_name}")
+            except requests.exceptions.RequestException as e:
+                print(f"Failed to download {pdf_link}: {e}")
+
+    session.close()
     print("Done!")
 
 
@@ -100,12 +254,17 @@ def rename_pdf_files(directory):
     # Regular expression to find the first year in the filename
     year_pattern = re.compile(r"(19|20)\d{2}")
 
+    # Keep the downloads manifest pointing to the renamed files
+    manifest = load_downloads_manifest(directory)
+    renamed = {}
+
     # Iterate over all files in the directory
     for filename in os.listdir(directory):
         if filename == "bevriezing-JB23-verkleind.pdf":
             old_file = os.path.join(directory, filename)
             new_file = os.path.join(directory, "NDM-2023.pdf")
             os.rename(old_file, new_file)
+            renamed[filename] = "NDM-2023.pdf"
             continue
         if filename.endswith(".pdf"):
             # Search for the first year in the filename
@@ -118,13 +277,183 @@ def rename_pdf_files(directory):
                 new_file = os.path.join(directory, new_filename)
                 # Rename the file
                 os.rename(old_file, new_file)
+                renamed[filename] = new_filename
                 print(f"Renamed '{filename}' to '{new_filename}'")
 
+    if manifest:
+        for record in manifest.values():
+            record["file"] = renamed.get(record.get("file"), record.get("file"))
+        save_downloads_manifest(directory, manifest)
+
     print("Done!")
 
 
-def report_tables_to_png(tables_dict, report, init_year, end_year):
-    """Convert the tables in the reports to images."""
+@lru_cache(maxsize=None)
+def checkpoint_shortest_edge(checkpoint=DETECTOR_CHECKPOINT):
+    """Shortest edge the image processor of a checkpoint resizes pages to."""
+    from transformers import AutoImageProcessor
+
+    return AutoImageProcessor.from_pretrained(checkpoint).size["shortest_edge"]
+
+
+def detector_shortest_edge(image_processor=None):
+    """Shortest edge the detector's image processor resizes pages to.
+
+    Read from image_processor, or from the processor of DETECTOR_CHECKPOINT
+    where none is loaded, e.g. in the png stage or with a detection worker.
+    """
+    if image_processor is None:
+        return checkpoint_shortest_edge()
+    return image_processor.size["shortest_edge"]
+
+
+def detection_dpi(shortest_edge, page_short_side=595):
+    """Lowest dpi rendering a page at least as large as the detector input.
+
+    The image processor resizes every page to `shortest_edge` pixels on
+    its short side, so pixels rendered beyond that are thrown away. The
+    default short side is that of an A4 page, in points.
+    """
+    return math.ceil(shortest_edge * 72 / page_short_side)
+
+
+def page_sizes(pdf_path, pages, renderer="pdf2image"):
+    """(width, height) in points of the listed pages of a PDF.
+
+    Read with poppler's pdfinfo, or from the PDFium document pool with
+    renderer="pdfium", so each renderer only needs its own backend.
+    """
+    if renderer == "pdfium":
+        pool = document_pool()
+        return {page: pool.page_size(pdf_path, page) for page in pages}
+
+    first, last = min(pages), max(pages)
+    info = pdfinfo_from_path(pdf_path, first_page=first, last_page=last)
+    sizes = {}
+    for key, value in info.items():
+        # "Page    N size" over a page range, "Page size" for a single page
+        match = re.fullmatch(r"Page\s+(\d+) size|Page size", key.strip())
+        if match:
+            page = int(match.group(1)) if match.group(1) else first
+            width, height = re.findall(r"[\d.]+", value)[:2]
+            sizes[page] = (float(width), float(height))
+    return {page: sizes[page] for page in pages}
+
+
+def page_dpis(pdf_path, pages, dpi=200, renderer="pdf2image", image_processor=None):
+    """dpi of each listed page: dpi itself, or with dpi=DETECT_DPI the
+    lowest dpi rendering that page at the input resolution of the
+    detector (see detector_shortest_edge)."""
+    if dpi != DETECT_DPI:
+        return {page: dpi for page in pages}
+    shortest_edge = detector_shortest_edge(image_processor)
+    return {
+        page: detection_dpi(shortest_edge, page_short_side=min(size))
+        for page, size in page_sizes(pdf_path, pages, renderer).items()
+    }
+
+
+def image_dpi(image):
+    """Dpi recorded in a rendered page image, or None for older images."""
+    dpi = image.info.get("dpi")
+    return round(dpi[0]) if dpi else None
+
+
+def report_error(errors, message):
+    """Print a per-year error, or collect it if an errors list is given."""
+    if errors is None:
+        print(message)
+    else:
+        errors.append(message)
+
+
+def consecutive_page_runs(pages, max_run=None, dpis=None):
+    """Group page numbers into (first, last) runs of consecutive pages.
+
+    With a {page: dpi} dict, the pages of a run also share their dpi.
+    """
+    runs = []
+    for page in sorted(set(pages)):
+        if (
+            runs
+            and page == runs[-1][1] + 1
+            and (max_run is None or page - runs[-1][0] < max_run)
+            and (dpis is None or dpis[page] == dpis[runs[-1][1]])
+        ):
+            runs[-1][1] = page
+        else:
+            runs.append([page, page])
+    return [tuple(run) for run in runs]
+
+
+def iter_pdf_pages(
+        pdf_path, pages, dpi=200, max_run=16, renderer="pdf2image", image_processor=None):
+    """Render only the listed pages of a PDF, yielding one image at a time.
+
+    With renderer="pdf2image", consecutive pages rendered at the same dpi
+    are rasterized with a single poppler call that writes to a temporary
+    folder, so only the page currently being handled is held in memory.
+    Each image is closed once the caller asks for the next one. With
+    renderer="pdfium", pages are rendered in-process from a pooled
+    document handle. With dpi=DETECT_DPI each page gets its own dpi from
+    its size and the input size of image_processor (see page_dpis). The
+    dpi of every page is recorded in its image's info, as read by
+    image_dpi.
+    """
+    dpis = page_dpis(pdf_path, pages, dpi, renderer, image_processor)
+
+    if renderer == "pdfium":
+        for page_num in pages:
+            for _, image in iter_pdfium_pages(pdf_path, [page_num], dpi=dpis[page_num]):
+                image.info["dpi"] = (dpis[page_num], dpis[page_num])
+                yield page_num, image
+        return
+
+    for first, last in consecutive_page_runs(pages, max_run=max_run, dpis=dpis):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_paths = convert_from_path(
+                pdf_path,
+                dpi=dpis[first],
+                first_page=first,
+                last_page=last,
+                output_folder=tmp_dir,
+                paths_only=True,
+            )
+            for page_num, image_path in zip(range(first, last + 1), sorted(image_paths)):
+                image = Image.open(image_path)
+                image.info["dpi"] = (dpis[page_num], dpis[page_num])
+                try:
+                    yield page_num, image
+                finally:
+                    image.close()
+                    os.remove(image_path)
+
+
+def report_tables_to_png(
+        tables_dict,
+        report,
+        init_year,
+        end_year,
+        stream=True,
+        dpi=200,
+        cache=None,
+        renderer="pdf2image",
+        errors=None
+        ):
+    """Convert the tables in the reports to images.
+
+    With stream=True (default) only the pages listed in tables_dict are
+    rendered, one at a time, by `renderer` ("pdf2image" or the in-process
+    "pdfium"). With stream=False the whole span between the
+    first and last listed page is rendered in memory, as before. If an
+    ArtifactCache is given, pages already rendered from the same PDF at
+    the same dpi by the same renderer are copied from it instead of
+    rendered. The dpi is
+    recorded in the PNG metadata, so the detected boxes can be converted
+    back to PDF points at the right scale.
+    Per-year errors are appended to `errors` if a list is given, and
+    printed otherwise.
+    """
     print("Converting the tables to images...")
 
     paths = get_paths()
@@ -139,12 +468,6 @@ def report_tables_to_png(tables_dict, report, init_year, end_year):
         try:
             if report == "antenne":
                 pdf_path = antenne_path + f"antenne-amsterdam-{year}.pdf"
-                pages_to_convert = tables_dict[str(year)]
-                images = convert_from_path(
-                    pdf_path,
-                    first_page=min(pages_to_convert),
-                    last_page=max(pages_to_convert),
-                )
                 output_path = (antenne_img_path + "antenne_amsterdam_")
 
             elif report == "national":
@@ -155,38 +478,253 @@ def report_tables_to_png(tables_dict, report, init_year, end_year):
                     print(f"Warning: {pdf_path} not found. Skipping {year}.")
                     continue
 
-                pages_to_convert = tables_dict[str(year)]
+                output_path = (national_img_path + "national_report_")
+
+            pages_to_convert = tables_dict[str(year)]
+
+            # Ensure the output directory exists before saving
+            year_output_dir = os.path.dirname(output_path + f"{year}/")
+            os.makedirs(year_output_dir, exist_ok=True)
+
+            # Per-page dpis (DETECT_DPI) are only rendered page by page
+            page_by_page = stream or dpi == DETECT_DPI
+
+            # Reuse the pages rendered in previous runs by the same renderer
+            if cache is not None:
+                pdf_hash = cache.file_hash(pdf_path)
+                page_renderer = renderer if page_by_page else "pdf2image"
+                page_keys = {
+                    page_num: cache.key(pdf_hash, page_num, dpi, page_renderer)
+                    for page_num in pages_to_convert
+                }
+                pages_to_convert = [
+                    page_num for page_num in pages_to_convert
+                    if not cache.fetch(
+                        "png",
+                        page_keys[page_num],
+                        output_path + f"{year}/{page_num}.png"
+                    )
+                ]
+                if not pages_to_convert:
+                    continue
+
+            if page_by_page:
+                page_images = iter_pdf_pages(
+                    pdf_path, pages_to_convert, dpi=dpi, renderer=renderer
+                )
+            else:
                 images = convert_from_path(
                     pdf_path,
+                    dpi=dpi,
                     first_page=min(pages_to_convert),
                     last_page=max(pages_to_convert),
                 )
-                output_path = (national_img_path + "national_report_")
-
-            # Save or process the selected pages
-            selected_images = []
-            for i, page_num in enumerate(pages_to_convert):
-                page_image = images[page_num - min(pages_to_convert)]
-                selected_images.append(page_image)
-
-                # Ensure the output directory exists before saving
-                year_output_dir = os.path.dirname(
-                    output_path + f"{year}/{page_num}.png"
+                page_images = (
+                    (page_num, images[page_num - min(pages_to_convert)])
+                    for page_num in pages_to_convert
                 )
-                os.makedirs(year_output_dir, exist_ok=True)
 
-                page_image.save(output_path + f"{year}/{page_num}.png", "PNG")
+            # Save the selected pages
+            for page_num, page_image in page_images:
+                page_path = output_path + f"{year}/{page_num}.png"
+                page_dpi = image_dpi(page_image) or dpi
+                page_image.save(page_path, "PNG", dpi=(page_dpi, page_dpi))
+                if cache is not None:
+                    cache.store("png", page_keys[page_num], page_path)
 
         except FileNotFoundError:
-            print(f"Error: {pdf_path} does not exist. Skipping {year}")
+            report_error(errors, f"Error: {pdf_path} does not exist. Skipping {year}")
         except Exception as e:
-            print(f"Unexpected error processing {pdf_path}: {e}")
+            report_error(errors, f"Unexpected error processing {pdf_path}: {e}")
 
     print("Done!")
 
 
+def prefetch_in_thread(items, maxsize=2):
+    """Consume an iterator in a background thread through a bounded queue.
+
+    At most `maxsize` items are produced ahead of the consumer, so the
+    producer (disk, renderer) and the consumer (model) overlap while
+    memory stays bounded. Errors of the producer are raised to the consumer.
+    """
+    buffer = queue.Queue(maxsize=maxsize)
+    done = object()
+    errors = []
+
+    def produce():
+        try:
+            for item in items:
+                buffer.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            buffer.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    while (item := buffer.get()) is not done:
+        yield item
+
+    if errors:
+        raise errors[0]
+
+
+def batched(items, batch_size):
+    """Group an iterator into lists of at most batch_size items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def prefetch_page_batches(file_paths, batch_size, prefetch=2):
+    """Load page images in a background thread and yield them in batches.
+
+    At most `prefetch` batches are decoded ahead of the consumer, so the
+    model never waits on disk while memory stays bounded.
+    """
+    batches = (
+        [
+            (file_path, Image.open(file_path).convert("RGB"))
+            for file_path in file_paths[start:start + batch_size]
+        ]
+        for start in range(0, len(file_paths), batch_size)
+    )
+    return prefetch_in_thread(batches, maxsize=prefetch)
+
+
+def detect_table_batch(image_processor, model, images, threshold=0.9):
+    """Run the table detector on a batch of PIL images without autograd.
+
+    The processor pads the batch to a common size, and the boxes of every
+    page are post-processed in a single call. Returns one result dict
+    (scores, labels, boxes) per image, in input order.
+    """
+    inputs = image_processor(images=images, return_tensors="pt")
+
+    with torch.inference_mode():
+        outputs = model(**inputs)
+
+    target_sizes = torch.tensor([image.size[::-1] for image in images])
+    return image_processor.post_process_object_detection(
+        outputs, threshold=threshold, target_sizes=target_sizes
+    )
+
+
+def model_revision(model):
+    """Revision of a Hugging Face model, used to key cached artifacts."""
+    return getattr(model.config, "_commit_hash", None) or "local"
+
+
+def box_iou(boxes_a, boxes_b):
+    """Pairwise IoU of two (n, 4) and (m, 4) tensors of xyxy boxes."""
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+
+    top_left = torch.max(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = torch.min(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = (bottom_right - top_left).clamp(min=0).prod(dim=2)
+
+    return intersection / (area_a[:, None] + area_b[None, :] - intersection)
+
+
+def page_number(image_path):
+    """Page number of a rendered page image."""
+    return int(os.path.basename(image_path).replace(".png", ""))
+
+
+def candidates(result, dpi=None):
+    """Keep the scores, labels and boxes of a detection result.
+
+    The dpi the page was rendered at, if known, is kept with them.
+    """
+    page_candidates = {key: result[key] for key in ("scores", "labels", "boxes")}
+    if dpi is not None:
+        page_candidates["dpi"] = dpi
+    return page_candidates
+
+
+def no_candidates():
+    """Candidates of a page that was not passed to the detector."""
+    return {
+        "scores": torch.empty(0),
+        "labels": torch.empty(0, dtype=torch.int64),
+        "boxes": torch.empty(0, 4),
+    }
+
+
+def save_detections(output_path, detections):
+    """Write the candidate boxes of a report year to its detections file.
+
+    detections maps each page number to its candidates (scores, labels and
+    boxes tensors, in query order, and the dpi of the boxes). The file is
+    replaced atomically.
+    """
+    detections_path = os.path.join(output_path, DETECTIONS_FILE)
+    torch.save(dict(sorted(detections.items())), detections_path + ".tmp")
+    os.replace(detections_path + ".tmp", detections_path)
+
+
+def load_detections(output_path, threshold=0.9, res_cons=72 / 200):
+    """Boxes per page, in PDF points, of the candidates scoring above threshold.
+
+    Filtering keeps the query order, so the tensor indices match those of
+    post-processing at the same threshold. Pixel boxes are converted with
+    the dpi recorded for their page; boxes without one, and the per-page
+    .pt files of boxes written before the detections file existed, are
+    scaled by res_cons.
+    """
+    detections_path = os.path.join(output_path, DETECTIONS_FILE)
+    if not os.path.exists(detections_path):
+        return {
+            int(file_name.replace(".pt", "")): torch.load(
+                os.path.join(output_path, file_name), weights_only=True
+            ) * res_cons
+            for file_name in os.listdir(output_path) if file_name.endswith(".pt")
+        }
+
+    detections = torch.load(detections_path, weights_only=True)
+    return {
+        page: page_candidates["boxes"][page_candidates["scores"] > threshold]
+        * (72 / page_candidates["dpi"] if "dpi" in page_candidates else res_cons)
+        for page, page_candidates in detections.items()
+    }
+
+
 # Obtain the boundaries of the tables inside the pages of the reports
-def obtain_the_tensors(image_processor, model, report, init_year, end_year):
+def obtain_the_tensors(
+        image_processor,
+        model,
+        report,
+        init_year,
+        end_year,
+        batch_size=4,
+        prefetch=2,
+        threshold=0.0,
+        cache=None,
+        client=None,
+        prefilter=None,
+        errors=None
+        ):
+    """Detect the tables of the page images and save their candidates.
+
+    The scores, labels and boxes of every candidate scoring above
+    threshold are saved in one detections file per report year, so the
+    confidence threshold is applied when the tables are extracted and can
+    change without running the model again. If an ArtifactCache is given,
+    pages whose image was already processed by the same model revision are
+    taken from it.
+    If a DetectionClient is given, the pages are sent to the running
+    detection worker and image_processor and model are not used.
+    If a PagePrefilter is given, pages it rejects get no candidates and
+    never reach the model.
+    Per-year errors are appended to `errors` if a list is given, and
+    printed otherwise.
+    """
 
     print("Detecting tables in the images...")
 
@@ -198,6 +736,14 @@ def obtain_the_tensors(image_processor, model, report, init_year, end_year):
     antenne_tens_path = paths["antenne"]["tens"]
     national_tens_path = paths["national"]["tens"]
 
+    if client is not None:
+        revision = client.revision
+    else:
+        model.eval()
+        revision = model_revision(model)
+    n_pages, start_time = 0, time.perf_counter()
+    model_seconds = 0.0
+
     for year in range(init_year, end_year):
 
         try:
@@ -214,44 +760,426 @@ def obtain_the_tensors(image_processor, model, report, init_year, end_year):
                     continue
                 output_path = national_tens_path + f"national_report_{year}"
 
-            file_names = [f for f in os.listdir(folder_path) if f.endswith(".png")]
+            file_paths = [
+                os.path.join(folder_path, f)
+                for f in os.listdir(folder_path) if f.endswith(".png")
+            ]
 
             # Ensure the output directory exists before saving
             os.makedirs(output_path, exist_ok=True)
 
-            for file_name in file_names:
-                file_path = os.path.join(folder_path, file_name)
-                image = Image.open(file_path).convert("RGB")
+            detections = {}
+            cached_path = os.path.join(output_path, "page.pt.tmp")
 
-                # Prepare image for the model
-                inputs = image_processor(images=image, return_tensors="pt")
+            # Reuse the candidates detected in previous runs
+            if cache is not None:
+                box_keys = {
+                    file_path: cache.key(
+                        cache.file_hash(file_path), revision, threshold
+                    )
+                    for file_path in file_paths
+                }
+                missing = []
+                for file_path in file_paths:
+                    if cache.fetch("boxes", box_keys[file_path], cached_path):
+                        detections[page_number(file_path)] = torch.load(
+                            cached_path, weights_only=True
+                        )
+                    else:
+                        missing.append(file_path)
+                file_paths = missing
+
+            if client is not None:
+                # The worker reads the images itself
+                batches = (
+                    [(file_path, None) for file_path in batch]
+                    for batch in batched(file_paths, batch_size)
+                )
+            else:
+                batches = prefetch_page_batches(file_paths, batch_size, prefetch)
+
+            for batch in batches:
+                # Pages without a table get no candidates
+                if prefilter is not None:
+                    kept = []
+                    for file_path, image in batch:
+                        if prefilter.keep(image if image is not None else Image.open(file_path)):
+                            kept.append((file_path, image))
+                        else:
+                            detections[page_number(file_path)] = no_candidates()
+                    batch = kept
+                    if not batch:
+                        continue
+
+                model_start = time.perf_counter()
+                if client is not None:
+                    results = client.detect(
+                        [file_path for file_path, _ in batch], threshold=threshold
+                    )
+                else:
+                    results = detect_table_batch(
+                        image_processor,
+                        model,
+                        [image for _, image in batch],
+                        threshold=threshold
+                    )
+                model_seconds += time.perf_counter() - model_start
 
-                # Forward pass
-                outputs = model(**inputs)
+                for (file_path, image), result in zip(batch, results):
+                    page_candidates = candidates(result, image_dpi(
+                        image if image is not None else Image.open(file_path)
+                    ))
+                    detections[page_number(file_path)] = page_candidates
+                    if cache is not None:
+                        torch.save(page_candidates, cached_path)
+                        cache.store("boxes", box_keys[file_path], cached_path)
+                n_pages += len(batch)
 
-                # Obtain the bounding boxes and class logits
-                target_sizes = torch.tensor([image.size[::-1]])
-                results = image_processor.post_process_object_detection(
-                    outputs, threshold=0.9, target_sizes=target_sizes
-                )[0]
+            if os.path.exists(cached_path):
+                os.remove(cached_path)
 
-                # Save the results
-                tensors_name = file_name.replace(".png", "")
-                torch.save(
-                    results["boxes"],
-                    f"{output_path}/{tensors_name}.pt"
-                )
+            # Save the candidates of every page of the year at once
+            save_detections(output_path, detections)
 
         except FileNotFoundError:
-            print(f"Error: {folder_path} does not exist. Skipping {year}")
+            report_error(errors, f"Error: {folder_path} does not exist. Skipping {year}")
+        except Exception as e:
+            report_error(errors, f"Unexpected error processing {folder_path}: {e}")
+
+    elapsed = time.perf_counter() - start_time
+    if n_pages:
+        print(
+            f"Detected tables in {n_pages} pages in {elapsed:.1f}s "
+            f"({n_pages / elapsed:.2f} pages/sec, batch size {batch_size})"
+        )
+    if prefilter is not None:
+        prefilter.summary(model_seconds / n_pages if n_pages else None)
+
+    print("Done!")
+
+
+def render_and_detect(
+        tables_dict,
+        image_processor,
+        model,
+        report,
+        init_year,
+        end_year,
+        batch_size=4,
+        queue_size=8,
+        dpi=200,
+        threshold=0.0,
+        save_png=False,
+        renderer="pdf2image",
+        save=True,
+        errors=None
+        ):
+    """Render the listed pages and detect their tables without PNG files.
+
+    Pages go from the renderer thread to the detector through a bounded
+    queue of `queue_size` images, and the same detections file as
+    obtain_the_tensors is written, unless save=False. PNGs are only
+    written with save_png=True, for debugging. Returns the detections of
+    the years that completed, keyed by year.
+    Per-year errors are appended to `errors` if a list is given, and
+    printed otherwise.
+    """
+    print("Rendering the pages and detecting their tables...")
+
+    model.eval()
+    n_pages, start_time = 0, time.perf_counter()
+    year_detections = {}
+
+    for year in range(init_year, end_year):
+        year_paths = get_year_paths(report, year)
+        pdf_path = year_paths["pdf"]
+
+        try:
+            if not os.path.exists(pdf_path):
+                print(f"Warning: {pdf_path} not found. Skipping {year}.")
+                continue
+
+            os.makedirs(year_paths["tens"], exist_ok=True)
+            if save_png:
+                os.makedirs(year_paths["img"], exist_ok=True)
+
+            # The renderer closes each image when the next one is requested,
+            # so the queue holds decoded RGB copies
+            pages = prefetch_in_thread(
+                (
+                    (page_num, image.convert("RGB"))
+                    for page_num, image in iter_pdf_pages(
+                        pdf_path, tables_dict[str(year)], dpi=dpi, renderer=renderer,
+                        image_processor=image_processor
+                    )
+                ),
+                maxsize=queue_size
+            )
+
+            detections = {}
+            for batch in batched(pages, batch_size):
+                results = detect_table_batch(
+                    image_processor,
+                    model,
+                    [image for _, image in batch],
+                    threshold=threshold
+                )
+
+                for (page_num, image), result in zip(batch, results):
+                    page_dpi = image_dpi(image)
+                    detections[page_num] = candidates(result, page_dpi)
+                    if save_png:
+                        image.save(
+                            f"{year_paths['img']}/{page_num}.png", "PNG",
+                            dpi=(page_dpi, page_dpi)
+                        )
+                n_pages += len(batch)
+
+            if save:
+                save_detections(year_paths["tens"], detections)
+            year_detections[year] = detections
+
         except Exception as e:
-            print(f"Unexpected error processing {folder_path}: {e}")
+            report_error(errors, f"Unexpected error processing {pdf_path}: {e}")
+
+    elapsed = time.perf_counter() - start_time
+    if n_pages:
+        print(
+            f"Rendered and detected {n_pages} pages in {elapsed:.1f}s "
+            f"({n_pages / elapsed:.2f} pages/sec, batch size {batch_size})"
+        )
 
     print("Done!")
+    return year_detections
+
+
+def text_layer_and_detect(
+        tables_dict,
+        get_detector,
+        report,
+        init_year,
+        end_year,
+        dpi=200,
+        batch_size=4,
+        threshold=0.0,
+        renderer="pdf2image",
+        errors=None
+        ):
+    """Locate the tables from the PDF text layer, rendering only scans.
+
+    The listed pages with a usable text layer get their tables from the
+    words and ruling lines of the PDF; the others are rendered at `dpi`
+    and go through the detector, which get_detector() only loads if such
+    pages exist. Both end up in the same detections file, so
+    report_tables_to_csv extracts them alike. A year whose scanned pages
+    fail to render or detect is failed, and its detections file is left
+    untouched.
+    Per-year errors are appended to `errors` if a list is given, and
+    printed otherwise.
+    """
+    print("Locating tables from the text layer of the reports...")
+
+    for year in range(init_year, end_year):
+        year_paths = get_year_paths(report, year)
+        pdf_path = year_paths["pdf"]
+
+        try:
+            if not os.path.exists(pdf_path):
+                print(f"Warning: {pdf_path} not found. Skipping {year}.")
+                continue
+
+            detections, image_pages = text_layer_detections(
+                pdf_path, tables_dict[str(year)]
+            )
+
+            if image_pages:
+                scan_errors = []
+                scanned = render_and_detect(
+                    {str(year): image_pages},
+                    *get_detector(),
+                    report,
+                    year,
+                    year + 1,
+                    batch_size=batch_size,
+                    dpi=dpi,
+                    threshold=threshold,
+                    renderer=renderer,
+                    save=False,
+                    errors=scan_errors
+                )
+                if scan_errors or year not in scanned:
+                    for error in scan_errors:
+                        report_error(errors, error)
+                    report_error(errors, f"Detection of the scanned pages of {pdf_path} failed. Skipping {year}")
+                    continue
+                detections.update(scanned[year])
+
+            os.makedirs(year_paths["tens"], exist_ok=True)
+            save_detections(year_paths["tens"], detections)
+
+        except Exception as e:
+            report_error(errors, f"Unexpected error processing {pdf_path}: {e}")
+
+    print("Done!")
+
+
+def boxes_to_pdf_areas(page_tensors):
+    """Convert detected boxes to tabula areas in a single vectorized step.
+
+    page_tensors maps each page number to its (n, 4) tensor of
+    (xmin, ymin, xmax, ymax) boxes in PDF points, as returned by
+    load_detections. Returns the list of (top, left, bottom, right) areas
+    and, for each area, the (page, tensor index) it belongs to.
+    """
+    owners = [
+        (page, tensor)
+        for page, boxes in page_tensors.items()
+        for tensor in range(len(boxes))
+    ]
+    if not owners:
+        return [], []
+
+    boxes = torch.cat([boxes.reshape(-1, 4) for boxes in page_tensors.values()])
+    areas = boxes[:, [1, 0, 3, 2]].tolist()
+
+    return areas, owners
+
+
+def extract_box_tables(pdf_path, areas, owners):
+    """Extract the detected tables one tabula call at a time."""
+    for (page, tensor), area in zip(owners, areas):
+        yield page, tensor, tabula.read_pdf(
+            pdf_path,
+            pages=page,
+            stream=True,
+            area=area
+        )
+
+
+def json_table_frames(raw_table):
+    """DataFrames of a table of tabula's JSON output, as tabula.read_pdf gives them.
+
+    The first row is the header, with blank names numbered "Unnamed: i" and
+    repeated ones suffixed ".1", ".2"...; the columns are made numeric
+    where they can be. An empty table gives an empty list.
+    """
+    rows = [
+        [cell["text"] if cell["text"] else np.nan for cell in row]
+        for row in raw_table["data"]
+    ]
+    if not rows:
+        return []
+
+    columns, counts, n_unnamed = [], {}, 0
+    for column in rows.pop(0):
+        if column is np.nan:
+            column = f"Unnamed: {n_unnamed}"
+            n_unnamed += 1
+        count = counts.get(column, 0)
+        while count > 0:
+            counts[column] = count + 1
+            column = f"{column}.{count}"
+            count = counts.get(column, 0)
+        columns.append(column)
+        counts[column] = count + 1
+
+    df = pd.DataFrame(data=rows, columns=columns)
+    for column in df.columns:
+        try:
+            df[column] = pd.to_numeric(df[column], errors="raise")
+        except (ValueError, TypeError):
+            pass
+    return [df]
+
+
+def page_tables_from_json(raw_tables, page, owners):
+    """Map the JSON tables of a page's tabula call back to their boxes.
+
+    Tabula returns one table per area passed, in order and including the
+    empty ones, so the i-th table belongs to the i-th owner. Returns a
+    list of (page, tensor index, list of DataFrames), or None if the
+    tables do not match the areas of the page.
+    """
+    if len(raw_tables) != len(owners) or any(
+            raw_table.get("page_number", page) != page for raw_table in raw_tables):
+        return None
+
+    return [
+        (page, tensor, json_table_frames(raw_table))
+        for raw_table, (_, tensor) in zip(raw_tables, owners)
+    ]
+
+
+def extract_report_tables(pdf_path, areas, owners, per_page=True):
+    """Extract every detected table of a report.
+
+    With per_page=True tabula is called once per page with the areas of
+    that page, instead of once per table. The tables are requested as
+    JSON, which keeps the empty ones, so each can be mapped back to its
+    area (see page_tables_from_json); a page whose tables cannot be mapped
+    is extracted one table at a time. areas and owners are the output of
+    boxes_to_pdf_areas. Yields (page, tensor index, list of DataFrames).
+    """
+    if not per_page:
+        yield from extract_box_tables(pdf_path, areas, owners)
+        return
+
+    page_areas = {}
+    for owner, area in zip(owners, areas):
+        page_areas.setdefault(owner[0], []).append((owner, area))
+
+    for page, boxes in page_areas.items():
+        page_owners = [owner for owner, _ in boxes]
+        raw_tables = tabula.read_pdf(
+            pdf_path,
+            pages=page,
+            stream=True,
+            guess=False,
+            multiple_tables=True,
+            area=[area for _, area in boxes],
+            output_format="json"
+        )
+
+        tables = page_tables_from_json(raw_tables, page, page_owners)
+        if tables is None:
+            print(
+                f"Warning: tabula returned {len(raw_tables)} tables for the "
+                f"{len(boxes)} areas of page {page} of {pdf_path}. "
+                "Extracting them one at a time"
+            )
+            tables = extract_box_tables(pdf_path, [area for _, area in boxes], page_owners)
+
+        yield from tables
 
 
 # Convert the tables to .csv files, if they can be read
-def report_tables_to_csv(res_cons, report, init_year, end_year):
+def report_tables_to_csv(
+        res_cons,
+        report,
+        init_year,
+        end_year,
+        threshold=0.9,
+        per_page=True,
+        cache=None,
+        errors=None,
+        store=None
+        ):
+    """Extract the detected tables from the reports and save them as .csv.
+
+    Only the candidate boxes scoring above threshold are extracted. The
+    .csv files left by earlier runs are removed first, since after a
+    threshold change a <page>_<table> name can point to another box.
+    Boxes are converted to PDF points with the dpi recorded for their
+    page; res_cons only scales boxes detected before the dpi was recorded.
+    With per_page=True (default) tabula is called once per page with the
+    areas of that page; with per_page=False it is called once per table.
+    If an ArtifactCache is given, tables already extracted from the same
+    PDF, page and box are copied from it instead of re-extracted.
+    If a TableStore is given, the tables of each year are also written to
+    it, replacing the year's partition.
+    Per-year errors are appended to `errors` if a list is given, and
+    printed otherwise.
+    """
 
     print("Extracting tables and saving them as .csv files...")
 
@@ -284,38 +1212,62 @@ def report_tables_to_csv(res_cons, report, init_year, end_year):
                     continue
                 output_path = national_csv_path + f"national_report_{year}"
 
-            file_names = [f for f in os.listdir(folder_path) if f.endswith(".pt")]
-
-            for file_name in file_names:
-                # Load the tensor and the report
-                file_path = os.path.join(folder_path, file_name)
-                table_tensor = torch.load(file_path, weights_only=True)
-
-                for tensor in range(len(table_tensor)):
-                    # Extract the bounding box coordinates
-                    tensor_list = table_tensor[tensor].tolist()
-                    tensor_list = [element * res_cons for element in tensor_list]
-                    xmin, ymin, xmax, ymax = tensor_list
-
-                    # Extract the table from the PDF page
-                    page = int(file_name.replace(".pt", ""))
-                    table = tabula.read_pdf(
-                        pdf_path,
-                        pages=page,
-                        stream=True,
-                        area=[ymin, xmin, ymax, xmax]
+            # The folder is the task's output, even if no table is read
+            os.makedirs(output_path, exist_ok=True)
+
+            # Load the boxes of every page of the report above the threshold
+            page_tensors = load_detections(folder_path, threshold, res_cons)
+
+            areas, owners = boxes_to_pdf_areas(page_tensors)
+
+            # Drop the tables of earlier runs, which are written again
+            # below or fetched from the cache
+            for file_name in os.listdir(output_path):
+                if re.fullmatch(r"\d+_\d+\.csv", file_name):
+                    os.remove(os.path.join(output_path, file_name))
+
+            # Reuse the tables extracted in previous runs
+            if cache is not None:
+                pdf_hash = cache.file_hash(pdf_path)
+                csv_keys = {
+                    owner: cache.key(pdf_hash, owner[0], [round(x, 2) for x in area])
+                    for owner, area in zip(owners, areas)
+                }
+                missing = [
+                    (owner, area) for owner, area in zip(owners, areas)
+                    if not cache.fetch(
+                        "csv",
+                        csv_keys[owner],
+                        f"{output_path}/{owner[0]}_{owner[1]}.csv"
                     )
-                    # Save the table as a .csv file if possible
-                    if table:
-                        df = pd.DataFrame(pd.concat(table))
-                        df.to_csv(
-                            f"{output_path}/{page}_{tensor}.csv",
-                            index=False
-                        )
+                ]
+                owners = [owner for owner, _ in missing]
+                areas = [area for _, area in missing]
+
+            tables = extract_report_tables(pdf_path, areas, owners, per_page)
+
+            for page, tensor, table in tables:
+                csv_path = f"{output_path}/{page}_{tensor}.csv"
+
+                # Save the table as a .csv file if possible
+                if table:
+                    df = pd.DataFrame(pd.concat(table))
+                    df.to_csv(csv_path, index=False)
+
+                if cache is not None:
+                    cache.store(
+                        "csv", csv_keys[(page, tensor)], csv_path if table else None
+                    )
+
+            if store is not None:
+                store.import_csv_folder(
+                    report, year, output_path,
+                    metadata={"pdf": pdf_path, "threshold": threshold}
+                )
 
         except FileNotFoundError:
-            print(f"Error: {folder_path} does not exist. Skipping {year}")
+            report_error(errors, f"Error: {folder_path} does not exist. Skipping {year}")
         except Exception as e:
-            print(f"Unexpected error processing {folder_path}: {e}")
+            report_error(errors, f"Unexpected error processing {folder_path}: {e}")
 
     print("Done!")
@@ -0,0 +1,192 @@
+# This script contains a content-addressed cache for the intermediate
+# artifacts of the report pipeline (page images, table boxes and CSVs).
+
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+from collections import Counter
+
+
+# Hits and misses of the caches unpickled in this process, i.e. in the
+# worker processes of the runner, which sends them back with each task
+_worker_counts = {"hits": Counter(), "misses": Counter()}
+
+
+def take_worker_counts():
+    """Hits and misses counted by the unpickled caches since the last call."""
+    counts = {name: dict(counter) for name, counter in _worker_counts.items()}
+    for counter in _worker_counts.values():
+        counter.clear()
+    return counts
+
+
+def copy_atomic(src_path, dest_path):
+    """Copy a file through a temporary file swapped in, so readers in other
+    processes never see a partial copy."""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(dest_path) or ".", suffix=".tmp"
+    )
+    os.close(fd)
+    try:
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    """Content-addressed store of pipeline artifacts with LRU eviction.
+
+    Artifacts are stored under `root/<namespace>/<key[:2]>/<key>`, where
+    the key is the hash of everything that determines their content (e.g.
+    PDF hash, page and dpi for a page image). An SQLite index keeps the
+    size and last access time of each entry, so the cache can be shared
+    by several processes and trimmed to `max_bytes` by evicting the least
+    recently used entries. Entries without a file record work that was
+    done but produced no output (e.g. an unreadable table).
+    """
+
+    def __init__(self, root, max_bytes=20 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = Counter()
+        self.misses = Counter()
+        self._file_hashes = {}
+
+        os.makedirs(root, exist_ok=True)
+        self._db = sqlite3.connect(
+            os.path.join(root, "index.sqlite"), timeout=60
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "namespace TEXT, key TEXT, size INTEGER, has_file INTEGER, "
+            "last_used REAL, PRIMARY KEY (namespace, key))"
+        )
+        self._db.commit()
+
+    def __getstate__(self):
+        # Worker processes open their own connection to the shared index
+        return {"root": self.root, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["root"], state["max_bytes"])
+        # Counted for the whole process, see take_worker_counts
+        self.hits = _worker_counts["hits"]
+        self.misses = _worker_counts["misses"]
+
+    @staticmethod
+    def key(*parts):
+        """Build a cache key from the parts that determine an artifact."""
+        return hashlib.sha256(
+            json.dumps(parts, default=str).encode()
+        ).hexdigest()
+
+    def file_hash(self, file_path):
+        """Hash of a file's content, memoized on its size and mtime."""
+        stat = os.stat(file_path)
+        memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._file_hashes:
+            self._file_hashes[memo_key] = hash_file(file_path)
+        return self._file_hashes[memo_key]
+
+    def _path(self, namespace, key):
+        return os.path.join(self.root, namespace, key[:2], key)
+
+    def lookup(self, namespace, key):
+        """Return (hit, path) for a key, where path is None for empty entries."""
+        row = self._db.execute(
+            "SELECT has_file FROM entries WHERE namespace = ? AND key = ?",
+            (namespace, key),
+        ).fetchone()
+
+        path = self._path(namespace, key)
+        if row is None or (row[0] and not os.path.exists(path)):
+            self.misses[namespace] += 1
+            return False, None
+
+        self._db.execute(
+            "UPDATE entries SET last_used = ? WHERE namespace = ? AND key = ?",
+            (time.time(), namespace, key),
+        )
+        self._db.commit()
+        self.hits[namespace] += 1
+        return True, path if row[0] else None
+
+    def fetch(self, namespace, key, dest_path):
+        """Copy a cached artifact to dest_path. Returns True on a hit."""
+        hit, path = self.lookup(namespace, key)
+        if hit and path is not None:
+            os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+            copy_atomic(path, dest_path)
+        return hit
+
+    def store(self, namespace, key, src_path=None):
+        """Add an artifact (or an empty entry if src_path is None)."""
+        size = 0
+        if src_path is not None:
+            path = self._path(namespace, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            copy_atomic(src_path, path)
+            size = os.path.getsize(path)
+
+        self._db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, size, int(src_path is not None), time.time()),
+        )
+        self._db.commit()
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits max_bytes."""
+        total = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        rows = self._db.execute(
+            "SELECT namespace, key, size FROM entries "
+            "WHERE has_file = 1 ORDER BY last_used"
+        ).fetchall()
+        for namespace, key, size in rows:
+            if total <= self.max_bytes:
+                break
+            path = self._path(namespace, key)
+            if os.path.exists(path):
+                os.remove(path)
+            self._db.execute(
+                "DELETE FROM entries WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            )
+            total -= size
+        self._db.commit()
+
+    def add_counts(self, counts):
+        """Add the hits and misses counted by a worker process."""
+        self.hits.update(counts["hits"])
+        self.misses.update(counts["misses"])
+
+    def report(self):
+        """Print the hits and misses of this run for each namespace."""
+        print("Cache report:")
+        for namespace in sorted(set(self.hits) | set(self.misses)):
+            hits, misses = self.hits[namespace], self.misses[namespace]
+            rate = hits / (hits + misses) if hits + misses else 0
+            print(f"  {namespace}: {hits} hits, {misses} misses ({rate:.0%})")
+
+    def close(self):
+        self._db.close()
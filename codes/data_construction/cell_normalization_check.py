@@ -0,0 +1,100 @@
+# This script checks the vectorized cell normalization of the national
+# reports against the former cell-by-cell implementation, on the whole
+# 1999-2019 incidents corpus, and times both. Run it from the root of the
+# repository (python -m codes.data_construction.cell_normalization_check),
+# once the national report tables have been extracted.
+
+import re
+import json
+import time
+import pandas as pd
+from codes.data_construction.national_reports_cleaning_utils import (
+    normalize_cells,
+    transpose_table
+)
+
+# Path to intermediate data files
+source_path = r'./data/intermediate/national_reports_raw_csvs/national_report_'
+# Path to auxiliary files
+aux_path = r'./codes/data_construction/aux_files/'
+
+
+def normalize_cells_by_cell(df):
+    '''Former normalization of clean_dataframe, one df.map pass per step'''
+
+    # Remove unwanted characters from observations
+    unwanted_characters = ['%', ' jaar']
+    for char in unwanted_characters:
+        df = df.map(
+            lambda x: re.sub(char, '', str(x))
+            if isinstance(x, str)
+            else x
+        )
+
+    # Remove spaces between integers
+    df = df.map(
+        lambda x: re.sub(r'(\d)\s+(\d)', r'\1\2', str(x))
+        if isinstance(x, str)
+        else x
+        )
+
+    # Remove other strings
+    df = df.map(
+        lambda x: re.search(r'\d+(\.\d+)?', str(x)).group()
+        if re.search(r'\d+(\.\d+)?', str(x))
+        else x
+        )
+
+    return df
+
+
+def load_corpus():
+    '''Transposed tables of the incidents datasets up to 2019'''
+    with open(aux_path + 'incidents_datasets.json', 'r') as file:
+        incidents_datasets = json.load(file)
+
+    tables = {}
+    for year, substances in incidents_datasets.items():
+        if int(year) >= 2020:
+            continue
+        index_year = str(int(year) + 1) if int(year) > 2013 else year
+        for substance, file in substances.items():
+            if substance != 'Ketamine':
+                tables[(year, substance)] = transpose_table(
+                    pd.read_csv(f"{source_path}{index_year}/{file}")
+                )
+    return tables
+
+
+def check_and_time(tables, repeat=5):
+    '''Compare both normalizations on every table and time them'''
+    mismatches = []
+    for name, df in tables.items():
+        try:
+            pd.testing.assert_frame_equal(normalize_cells_by_cell(df), normalize_cells(df))
+        except AssertionError as e:
+            mismatches.append(name)
+            print(f"Mismatch in {name}: {e}")
+
+    n_cells = sum(df.size for df in tables.values())
+    timings = {}
+    for function in [normalize_cells_by_cell, normalize_cells]:
+        best = float('inf')
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            for df in tables.values():
+                function(df)
+            best = min(best, time.perf_counter() - start_time)
+        timings[function.__name__] = best
+        print(f"{function.__name__}: {best * 1000:.1f} ms for {len(tables)} tables ({n_cells} cells)")
+
+    print(
+        f"Speed-up x{timings['normalize_cells_by_cell'] / timings['normalize_cells']:.2f}, "
+        f"{len(tables) - len(mismatches)} of {len(tables)} tables identical"
+    )
+    return mismatches
+
+
+if __name__ == '__main__':
+    mismatches = check_and_time(load_corpus())
+    raise SystemExit(1 if mismatches else 0)
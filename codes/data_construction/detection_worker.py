@@ -0,0 +1,141 @@
+# This script contains the long-lived table-detection worker and its
+# client. The worker loads the detector once and serves it over local
+# HTTP, so repeated partial runs of the pipeline skip the model startup.
+#
+# Protocol (JSON over HTTP):
+#   GET  /health  -> {"revision": ...}
+#   POST /detect  <- {"paths": [...]} or {"images": [base64 PNG, ...]},
+#                    and optionally "threshold" (default 0.9)
+#                 -> {"results": [{"scores": [...], "labels": [...],
+#                                  "boxes": [[x0, y0, x1, y1], ...]}, ...]}
+
+import io
+import os
+import json
+import base64
+import torch
+import requests
+from PIL import Image
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from data_construction.antenne_reports_utils import detect_table_batch, model_revision
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+
+def make_handler(image_processor, model):
+    revision = model_revision(model)
+
+    class DetectionHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health":
+                self.send_json(404, {"error": f"Unknown path: {self.path}"})
+                return
+            self.send_json(200, {"revision": revision})
+
+        def do_POST(self):
+            if self.path != "/detect":
+                self.send_json(404, {"error": f"Unknown path: {self.path}"})
+                return
+
+            try:
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if "paths" in request:
+                    images = [Image.open(path).convert("RGB") for path in request["paths"]]
+                else:
+                    images = [
+                        Image.open(io.BytesIO(base64.b64decode(image))).convert("RGB")
+                        for image in request["images"]
+                    ]
+                results = detect_table_batch(
+                    image_processor, model, images, request.get("threshold", 0.9)
+                ) if images else []
+            except Exception as e:
+                self.send_json(400, {"error": f"{type(e).__name__}: {e}"})
+                return
+
+            self.send_json(200, {
+                "results": [
+                    {key: result[key].tolist() for key in ("scores", "labels", "boxes")}
+                    for result in results
+                ]
+            })
+
+    return DetectionHandler
+
+
+def serve_detector(image_processor, model, host="127.0.0.1", port=8765):
+    """Serve the detector until interrupted.
+
+    Requests are handled one at a time, so batches never compete for the
+    model and torch keeps all its intra-op threads.
+    """
+    model.eval()
+    server = HTTPServer((host, port), make_handler(image_processor, model))
+    print(f"Detection worker ({model_revision(model)}) listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class DetectionClient:
+    """Client of a running detection worker.
+
+    detect() takes page image paths, which the worker reads from the shared
+    disk, and detect_images() takes PIL images, sent as PNG. Both return
+    result dicts (scores, labels, boxes) of tensors, like detect_table_batch.
+    """
+
+    def __init__(self, url=DEFAULT_URL, timeout=600):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+        response = self.session.get(self.url + "/health", timeout=10)
+        response.raise_for_status()
+        self.revision = response.json()["revision"]
+
+    def _detect(self, payload):
+        response = self.session.post(
+            self.url + "/detect", json=payload, timeout=self.timeout
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"Detection worker error: {response.json()['error']}")
+
+        return [
+            {
+                "scores": torch.tensor(result["scores"]),
+                "labels": torch.tensor(result["labels"], dtype=torch.int64),
+                "boxes": torch.tensor(result["boxes"]).reshape(-1, 4),
+            }
+            for result in response.json()["results"]
+        ]
+
+    def detect(self, file_paths, threshold=0.9):
+        # The worker may run from another working directory
+        paths = [os.path.abspath(file_path) for file_path in file_paths]
+        return self._detect({"paths": paths, "threshold": threshold})
+
+    def detect_images(self, images, threshold=0.9):
+        encoded = []
+        for image in images:
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+            encoded.append(base64.b64encode(buffer.getvalue()).decode())
+        return self._detect({"images": encoded, "threshold": threshold})
+
+    def close(self):
+        self.session.close()
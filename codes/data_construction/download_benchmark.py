@@ -0,0 +1,152 @@
+# This script benchmarks download_reports against a local stand-in of the
+# report webpage, serving fake PDFs with ETag, Last-Modified and Range
+# support and an artificial per-request latency. One fresh download is
+# cut halfway by the server, and has to be resumed by the next run. Then
+# a complete .part file, as left by a crash before its rename, has to be
+# kept rather than failing on the server's 416.
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from data_construction.antenne_reports_utils import download_reports
+
+
+def make_fake_pdfs(n_files, size):
+    """Random-content fake PDFs keyed by file name."""
+    return {
+        f"antenne-amsterdam-{2000 + i}.pdf": b"%PDF-1.4\n" + os.urandom(size)
+        for i in range(n_files)
+    }
+
+
+def make_handler(pdfs, latency, interrupted, ranges):
+    """Handler serving pdfs; the first GET of each name in interrupted is cut
+    halfway. The start of every Range request served is appended to ranges.
+    """
+    last_modified = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+
+    class FakeReportsHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            name = self.path.strip("/")
+
+            if name == "":
+                body = "".join(f'<a href="/{pdf}">{pdf}</a>' for pdf in pdfs).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            if name not in pdfs:
+                self.send_error(404)
+                return
+
+            content = pdfs[name]
+            etag = '"' + hashlib.md5(content).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            start = 0
+            byte_range = self.headers.get("Range")
+            if byte_range and self.headers.get("If-Range") in (etag, last_modified):
+                start = int(byte_range.split("=")[1].split("-")[0])
+
+            if start:
+                ranges.append((name, start))
+            if start >= len(content) > 0:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(content)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            self.send_response(206 if start else 200)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Content-Length", str(len(content) - start))
+            if start:
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"
+                )
+            self.end_headers()
+            if name in interrupted:
+                # Drop the connection mid-body, as a failing network would
+                interrupted.discard(name)
+                self.wfile.write(content[start:len(content) // 2])
+                self.close_connection = True
+                return
+            self.wfile.write(content[start:])
+
+    return FakeReportsHandler
+
+
+def benchmark_downloads(n_files=24, size=2 * 1024 ** 2, latency=0.05, workers=(1, 4, 8)):
+    """Print the throughput of download_reports for several worker counts."""
+    pdfs = make_fake_pdfs(n_files, size)
+    name = next(iter(pdfs))
+    interrupted, ranges = set(), []
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), make_handler(pdfs, latency, interrupted, ranges)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    total_mb = n_files * size / 1024 ** 2
+
+    for max_workers in workers:
+        with tempfile.TemporaryDirectory() as folder:
+            # The first download of one file is interrupted halfway
+            interrupted.add(name)
+            ranges.clear()
+
+            start_time = time.perf_counter()
+            download_reports(url, folder, max_workers=max_workers)
+            cold = time.perf_counter() - start_time
+            assert not os.path.exists(os.path.join(folder, name))
+            partial_size = os.path.getsize(os.path.join(folder, name + ".part"))
+            assert 0 < partial_size < len(pdfs[name])
+
+            # The rerun resumes the partial file and skips the others
+            start_time = time.perf_counter()
+            download_reports(url, folder, max_workers=max_workers)
+            warm = time.perf_counter() - start_time
+
+            assert ranges == [(name, partial_size)], f"Not resumed: {ranges}"
+            with open(os.path.join(folder, name), "rb") as f:
+                assert f.read() == pdfs[name], "Resumed file differs from the source"
+
+            # A crash after the last byte but before the rename
+            pdf_path = os.path.join(folder, name)
+            os.replace(pdf_path, pdf_path + ".part")
+            with open(os.path.join(folder, ".downloads.json"), "r") as f:
+                record = json.load(f)[url + name]
+            with open(pdf_path + ".part.json", "w") as f:
+                json.dump(record, f)
+            ranges.clear()
+            download_reports(url, folder, max_workers=max_workers)
+            assert ranges == [(name, len(pdfs[name]))], f"Not checked: {ranges}"
+            assert not os.path.exists(pdf_path + ".part")
+            with open(pdf_path, "rb") as f:
+                assert f.read() == pdfs[name], "Kept file differs from the source"
+
+            print(
+                f"{max_workers} workers: {total_mb / cold:.1f} MB/s cold, "
+                f"{warm:.2f}s for the rerun resuming the interrupted file"
+            )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    benchmark_downloads()
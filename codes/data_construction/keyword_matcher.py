@@ -0,0 +1,158 @@
+# This script contains the keyword matchers used to count the Telegraaf
+# keywords in the archive pages. A matcher is built once per run and
+# counts every keyword in a single pass over the page text.
+
+from collections import deque
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class CountMatcher:
+    '''Reference matcher: one str.count per keyword'''
+
+    def __init__(self, keywords, word_boundary=False):
+        if word_boundary:
+            raise ValueError('CountMatcher does not support word boundaries')
+        self.keywords = list(keywords)
+        self.patterns = [keyword.lower() for keyword in self.keywords]
+
+    def __call__(self, text):
+        return {
+            keyword: text.count(pattern)
+            for keyword, pattern in zip(self.keywords, self.patterns)
+        }
+
+
+class AhoCorasickMatcher:
+    '''Count all keywords in one pass with an Aho-Corasick automaton
+
+    Counts follow the semantics of str.count on the lowercased text: the
+    occurrences of each keyword are counted without overlapping each
+    other, while different keywords may overlap. With word_boundary=True
+    only occurrences delimited by non-word characters are counted. The C
+    automaton of pyahocorasick is used when installed, and a pure Python
+    one otherwise. Texts are expected to be lowercased already.
+    '''
+
+    def __init__(self, keywords, word_boundary=False, backend='auto'):
+        self.keywords = list(keywords)
+        self.word_boundary = word_boundary
+
+        # Keywords that only differ in case share a pattern
+        self.patterns = sorted({keyword.lower() for keyword in self.keywords if keyword})
+        self.pattern_ids = {pattern: i for i, pattern in enumerate(self.patterns)}
+
+        if backend == 'auto':
+            backend = 'c' if ahocorasick is not None else 'python'
+        self.backend = backend
+
+        if backend == 'c':
+            if ahocorasick is None:
+                raise ImportError('pyahocorasick is not installed')
+            self.automaton = ahocorasick.Automaton()
+            for pattern, i in self.pattern_ids.items():
+                self.automaton.add_word(pattern, (i, len(pattern)))
+            self.automaton.make_automaton()
+        elif backend == 'python':
+            self._build_python_automaton()
+        else:
+            raise ValueError(f'Unknown backend: {backend}')
+
+    def _build_python_automaton(self):
+        '''Build the trie, its failure links and the full transition table'''
+        trie, output = [{}], [[]]
+
+        for pattern, i in self.pattern_ids.items():
+            state = 0
+            for char in pattern:
+                if char not in trie[state]:
+                    trie.append({})
+                    output.append([])
+                    trie[state][char] = len(trie) - 1
+                state = trie[state][char]
+            output[state].append((i, len(pattern)))
+
+        # Breadth-first pass: states are completed after their failure
+        # state, so each transition table extends the one it falls back to
+        # and matching needs a single dict lookup per character
+        fail = [0] * len(trie)
+        delta = [dict(trie[0])] + [None] * (len(trie) - 1)
+        queue = deque(trie[0].values())
+        while queue:
+            state = queue.popleft()
+            if delta[state] is None:
+                delta[state] = {**delta[fail[state]], **trie[state]}
+            output[state] = output[state] + output[fail[state]]
+            for char, child in trie[state].items():
+                fail[child] = delta[fail[state]].get(char, 0) if state else 0
+                queue.append(child)
+
+        self.delta, self.output = delta, output
+
+    def __call__(self, text):
+        counts = [0] * len(self.patterns)
+        last_end = [-1] * len(self.patterns)
+        word_boundary = self.word_boundary
+
+        for end, (i, length) in self._iter_matches(text):
+            start = end - length + 1
+            if start <= last_end[i]:
+                continue
+            if word_boundary and (
+                (start > 0 and _is_word_char(text[start - 1]))
+                or (end + 1 < len(text) and _is_word_char(text[end + 1]))
+            ):
+                continue
+            counts[i] += 1
+            last_end[i] = end
+
+        # An empty keyword is counted as str.count would
+        return {
+            keyword: counts[self.pattern_ids[keyword.lower()]]
+            if keyword else text.count(keyword)
+            for keyword in self.keywords
+        }
+
+    def _iter_matches(self, text):
+        '''Yield (end index, (pattern id, length)) for every occurrence'''
+        if self.backend == 'c':
+            yield from self.automaton.iter(text)
+            return
+
+        delta, output, state = self.delta, self.output, 0
+        for end, char in enumerate(text):
+            state = delta[state].get(char, 0)
+            if output[state]:
+                for match in output[state]:
+                    yield end, match
+
+
+def build_matcher(keywords, kind='auto', word_boundary=False):
+    '''Build a keyword matcher once per run
+
+    kind is 'count' (one str.count per keyword), 'aho-corasick', or 'auto'.
+    On realistic pages the pure Python automaton only catches up with
+    str.count at a few hundred keywords, so 'auto' uses Aho-Corasick when
+    word boundaries are requested, or when pyahocorasick is installed and
+    there are at least 100 keywords, and str.count otherwise. The matcher
+    maps a lowercased text to {keyword: count}.
+    '''
+    keywords = list(keywords)
+    if kind == 'auto':
+        use_automaton = word_boundary or (
+            ahocorasick is not None and len(keywords) >= 100
+        )
+        kind = 'aho-corasick' if use_automaton else 'count'
+
+    if kind == 'count':
+        return CountMatcher(keywords, word_boundary=word_boundary)
+    if kind == 'aho-corasick':
+        return AhoCorasickMatcher(keywords, word_boundary=word_boundary)
+    raise ValueError(f'Unknown matcher: {kind}')
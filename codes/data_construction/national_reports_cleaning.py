@@ -6,6 +6,7 @@ from codes.data_construction.national_reports_cleaning_utils import (
     load_and_append_csvs,
     yearly_incidents
 )
+from codes.data_construction.table_store import open_store
 
 # Path to intermediate data files
 source_path = r'./data/intermediate/national_reports_raw_csvs/national_report_'
@@ -13,6 +14,8 @@ source_path = r'./data/intermediate/national_reports_raw_csvs/national_report_'
 aux_path = r'./codes/data_construction/aux_files/'
 # Path to save the cleaned datasets
 save_path = r'./data/processed/national_reports/incidents/'
+# Extracted tables, read from the .csv files if pyarrow is not installed
+store = open_store()
 
 # Load the incidents datasets
 with open(aux_path + 'incidents_datasets.json', 'r') as file:
@@ -29,7 +32,8 @@ incidents_datasets_up_to_2019 = {key: value for key, value in incidents_datasets
 incident_reports_up_to_19 = national_reports_cleaning(
     incidents_datasets_up_to_2019,
     source_path,
-    incidents_columns_mapping
+    incidents_columns_mapping,
+    store=store
 )
 
 
@@ -1,38 +1,75 @@
 import pandas as pd
+import numpy as np
 import re
 import os
+from codes.data_construction.table_store import YearTables
 
+# Characters removed from the cells, in order
+UNWANTED_CHARACTERS = ['%', ' jaar']
+# Spaces between digits (thousands separators)
+DIGIT_SPACES = re.compile(r'(\d)\s+(\d)')
+# First number of a cell
+CELL_NUMBER = re.compile(r'(\d+(?:\.\d+)?)')
 
-def clean_dataframe(df, year, substance, column_mappings):
-    '''Cleans the dataframes obtained from the national reports'''
 
-    # Preprocess
+def transpose_table(df):
+    '''Puts the origins of a national report table in the rows'''
     df = df.transpose()
     df.columns = df.iloc[0]
-    df = df[1:].dropna(axis=1, how='all')
-
-    # Remove unwanted characters from observations
-    unwanted_characters = ['%', ' jaar']
-    for char in unwanted_characters:
-        df = df.map(
-            lambda x: re.sub(char, '', str(x))
-            if isinstance(x, str)
-            else x
-        )
+    return df[1:].dropna(axis=1, how='all')
+
+
+def normalize_cells(df, numeric=False):
+    '''Keeps the first number of every cell of a dataframe
+
+    All the cells are normalized at once, as a single column: the unwanted
+    characters and the spaces between digits are removed from the strings,
+    and the first number is extracted from every cell. Cells without a
+    number keep their (stripped) value. The numbers are kept as strings,
+    since a dot can still be a thousands separator; with numeric=True the
+    columns where every cell holds a number are converted to floats.
+    '''
+    values = df.to_numpy(dtype=object, copy=True).ravel()
+    is_str = np.fromiter((isinstance(x, str) for x in values), bool, len(values))
+
+    # Strip the string cells
+    strings = pd.Series(values[is_str], dtype=object)
+    for char in UNWANTED_CHARACTERS:
+        strings = strings.str.replace(char, '', regex=False)
+    strings = strings.str.replace(DIGIT_SPACES, r'\1\2', regex=True)
+    values[is_str] = strings.to_numpy()
+
+    # Columns without strings turn numeric, as they did with df.map
+    grid = values.reshape(df.shape)
+    for position in np.flatnonzero(~is_str.reshape(df.shape).any(axis=0)):
+        column = pd.Series(grid[:, position], dtype=object).infer_objects()
+        grid[:, position] = column.to_numpy(dtype=object)
+
+    # Extract the first number, from the text of the other cells as well
+    text = values.copy()
+    text[~is_str] = [str(x) for x in values[~is_str]]
+    numbers = pd.Series(text, dtype=object).str.extract(CELL_NUMBER, expand=False).to_numpy()
+    has_number = ~pd.isna(numbers)
+    values[has_number] = numbers[has_number]
+
+    df = pd.DataFrame(
+        values.reshape(df.shape), index=df.index, columns=df.columns
+    ).infer_objects()
+
+    if numeric:
+        for position in np.flatnonzero(has_number.reshape(df.shape).all(axis=0)):
+            df.isetitem(position, pd.to_numeric(df.iloc[:, position]))
+    return df
 
-    # Remove spaces between integers
-    df = df.map(
-        lambda x: re.sub(r'(\d)\s+(\d)', r'\1\2', str(x))
-        if isinstance(x, str)
-        else x
-        )
 
-    # Remove other strings
-    df = df.map(
-        lambda x: re.search(r'\d+(\.\d+)?', str(x)).group()
-        if re.search(r'\d+(\.\d+)?', str(x))
-        else x
-        )
+def clean_dataframe(df, year, substance, column_mappings):
+    '''Cleans the dataframes obtained from the national reports'''
+
+    # Preprocess
+    df = transpose_table(df)
+
+    # Remove unwanted characters, spaces between integers and other strings
+    df = normalize_cells(df)
 
     # Year-specific processings
     if year == '2011':
@@ -76,14 +113,16 @@ def clean_dataframe(df, year, substance, column_mappings):
     return df.reset_index(drop=True)
 
 
-def national_reports_cleaning(incidents_dict, source_path, column_mappings):
+def national_reports_cleaning(incidents_dict, source_path, column_mappings, store=None):
 
     dfs = []
     for year, substances in incidents_dict.items():
         index_year = str(int(year) + 1) if int(year) > 2013 else year
+        # One read of the table store per year, or the .csv files without it
+        tables = YearTables(store, 'national', index_year, f"{source_path}{index_year}/")
         dfs_year = [
             clean_dataframe(
-                pd.read_csv(f"{source_path}{index_year}/{file}"),
+                tables.read(file),
                 year,
                 substance,
                 column_mappings
@@ -115,7 +154,13 @@ def load_and_append_csvs(folder_path):
     return pd.concat(all_dfs, ignore_index=True)
 
 
-def yearly_incidents(df, dict):
+# Origins summed into the 'SEH-MDI+LIS-ziekenhuizen' rows
+SEH_ORIGINS = ['SEH-MDI-ziekenhuizen', 'SEH-LIS-ziekenhuizen']
+SEVERITIES = ['light', 'moderate', 'severe']
+
+
+def incident_levels(df, dict):
+    '''Numeric incidents since 2011, with the SEH totals and severity counts'''
 
     # Beware of the dots in 'incidents'
     df['incidents'] = df['incidents'].str.replace('.', '', regex=False)
@@ -129,48 +174,80 @@ def yearly_incidents(df, dict):
 
     df.loc[:, 'origin'] = df['origin'].replace(dict)
 
-    # Group by year and drug, then sum incidents from specified origins
-    seh_origins = ['SEH-MDI-ziekenhuizen', 'SEH-LIS-ziekenhuizen']
-    grouped = df[df['origin'].isin(seh_origins)].groupby(['year', 'drug'])['incidents'].sum().reset_index()
+    # Sum the incidents of the SEH origins per year and drug, in new rows
+    # with NaN for the other columns
+    seh_rows = (
+        df[df['origin'].isin(SEH_ORIGINS)]
+        .groupby(['year', 'drug'])['incidents'].sum()
+        .reset_index()
+        .reindex(columns=df.columns)
+    )
+    seh_rows['origin'] = 'SEH-MDI+LIS-ziekenhuizen'
+    df = pd.concat([df, seh_rows], ignore_index=True)
+
+    for severity in SEVERITIES:
+        df.loc[:, f'{severity}_incidents'] = (
+            df['incidents'] * df[f'DOG_{severity}_pcnt'] * 0.01
+        )
 
-    # Add new rows with summed incidents and NaN for other columns
-    new_rows = []
-    for _, row in grouped.iterrows():
-        new_row = {col: (row['incidents'] if col == 'incidents' else row[col] if col in ['year', 'drug'] else float('NaN')) for col in df.columns}
-        new_row['origin'] = 'SEH-MDI+LIS-ziekenhuizen'
-        new_rows.append(new_row)
-    df = pd.concat([df, pd.DataFrame(new_rows)], ignore_index=True)
+    return df
 
-    
-    # Compute differences per group
+
+def incident_diffs(df):
+    '''Differences of the incidents within each (drug, origin) series'''
+
+    # Compute differences per group, for every count at once
     df = df.sort_values(by=['drug', 'origin', 'year'])
-    grouped = df.groupby(['drug', 'origin'])
-    df['incidents_diff'] = grouped['incidents'].diff()
+    counts = ['incidents'] + [f'{severity}_incidents' for severity in SEVERITIES]
+    diffs = df.groupby(['drug', 'origin'])[counts].diff().add_suffix('_diff')
 
-    for severity in ['light', 'moderate', 'severe']:
-        df.loc[:, f'{severity}_incidents'] = (
-            df['incidents'] * df[f'DOG_{severity}_pcnt'] * 0.01
-        )
-        df.loc[:, f'{severity}_incidents_diff'] = grouped[f'{severity}_incidents'].diff()
+    # Each severity count is followed by its difference
+    order = (
+        [col for col in df.columns if col not in counts[1:]]
+        + ['incidents_diff']
+        + [col for count in counts[1:] for col in (count, f'{count}_diff')]
+    )
+    df = df.join(diffs)[order]
 
     # Use mask() to conditionally replace values
     mask = df["year"] >= 2018
     df.loc[:,'incidents_diff'] = df['incidents'].mask(mask, df['incidents'])
 
-    for severity in ['light', 'moderate', 'severe']:
+    for severity in SEVERITIES:
         df.loc[:, f'{severity}_incidents'] = (
             df[f'{severity}_incidents_diff'].mask(mask, df[f'{severity}_incidents'])
         )
 
-    # Drop the '_diffs' columns
-    # df = df.loc[df['year'] > 2011].copy()
-    # df.loc[:,'incidents'] = df.loc[:,'incidents_diff']
-    # df = df.drop(columns=[col for col in df.columns if col.endswith('_diff')])
+    # Drop the intensity percentage columns
+    return df.drop(columns=[col for col in df.columns if col.startswith('DOG_')])
 
-    # Drop the intensity percentage columns 
-    df = df.drop(columns=[col for col in df.columns if col.startswith('DOG_')])
 
-    # Drop irrelevant columns
-    # df = df.drop('hospital_admission_pcnt', axis=1)
+def yearly_incidents(df, dict, previous=None):
+    '''Yearly incidents per drug and origin, with their differences
 
-    return df
+    With the output of an earlier run as previous, only the years after
+    its last one are computed, together with the last earlier row of each
+    (drug, origin) series as the base of its first difference, and
+    appended to previous.
+    '''
+    if previous is None:
+        return incident_diffs(incident_levels(df, dict))
+
+    last_year = previous['year'].max()
+    year = pd.to_numeric(df['year'], errors='coerce')
+    new_years = year > last_year
+    if not new_years.any():
+        return previous
+
+    # Rows of the new years, and of the last earlier year of each series
+    latest = year.where(~new_years).groupby(
+        [df['drug'], df['origin'].replace(dict)]
+    ).transform('max')
+    levels = incident_levels(df.loc[new_years | (year == latest)].copy(), dict)
+
+    new_rows = incident_diffs(levels)
+    new_rows = new_rows.loc[new_rows['year'] > last_year]
+
+    return pd.concat([previous, new_rows], ignore_index=True).sort_values(
+        by=['drug', 'origin', 'year']
+    )
@@ -0,0 +1,247 @@
+# This script contains the ONNX Runtime backend of the table detector. The
+# table-transformer is exported once to ONNX, cached on disk, and wrapped so
+# that obtain_the_tensors can use it in place of the PyTorch model. A graph
+# is only used once its boxes have been checked against the PyTorch model.
+# Run it from the root of the repository to check the cached graph again
+# (PYTHONPATH=codes python -m data_construction.onnx_detector).
+
+import os
+import sys
+import copy
+import json
+import types
+import random
+import torch
+import numpy as np
+import onnxruntime as ort
+from PIL import Image, ImageDraw
+from data_construction.antenne_reports_utils import (
+    detect_table_batch,
+    box_iou,
+    model_revision,
+)
+
+
+class _DetectorOutputs(torch.nn.Module):
+    """Export wrapper returning only the logits and the predicted boxes."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values, pixel_mask):
+        outputs = self.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+        return outputs.logits, outputs.pred_boxes
+
+
+def export_detector_onnx(model, onnx_dir, height=800, width=1066, opset=17):
+    """Export the detector to ONNX once and return the path of the graph.
+
+    The graph is cached under onnx_dir by model revision, with dynamic
+    batch, height and width axes so padded batches of any page size run
+    through the same graph.
+    """
+    onnx_path = os.path.join(
+        onnx_dir, f"table-transformer-{model_revision(model)}-opset{opset}.onnx"
+    )
+    if os.path.exists(onnx_path):
+        return onnx_path
+
+    print(f"Exporting the detector to {onnx_path}...")
+    os.makedirs(onnx_dir, exist_ok=True)
+
+    model.eval()
+    pixel_values = torch.randn(1, 3, height, width)
+    pixel_mask = torch.ones(1, height, width, dtype=torch.int64)
+
+    with torch.inference_mode():
+        torch.onnx.export(
+            _DetectorOutputs(model).eval(),
+            (pixel_values, pixel_mask),
+            onnx_path + ".tmp",
+            input_names=["pixel_values", "pixel_mask"],
+            output_names=["logits", "pred_boxes"],
+            dynamic_axes={
+                "pixel_values": {0: "batch", 2: "height", 3: "width"},
+                "pixel_mask": {0: "batch", 1: "height", 2: "width"},
+                "logits": {0: "batch"},
+                "pred_boxes": {0: "batch"},
+            },
+            opset_version=opset,
+            dynamo=False,
+        )
+    os.replace(onnx_path + ".tmp", onnx_path)
+
+    return onnx_path
+
+
+class OnnxDetector:
+    """ONNX Runtime stand-in for TableTransformerForObjectDetection.
+
+    Calling it with the image processor's outputs returns an object with
+    `logits` and `pred_boxes` tensors, which is all that
+    post_process_object_detection reads. Its config is a copy of the
+    PyTorch model's with the revision tagged "+onnx", so cached boxes of
+    the two backends are kept apart.
+    """
+
+    def __init__(self, model, onnx_dir, intra_op_threads=None):
+        session_options = ort.SessionOptions()
+        # The threads torch was given, i.e. a worker's share of the cores
+        session_options.intra_op_num_threads = intra_op_threads or torch.get_num_threads()
+        session_options.inter_op_num_threads = 1
+        session_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        session_options.graph_optimization_level = (
+            ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+
+        self.onnx_path = export_detector_onnx(model, onnx_dir)
+        self.session = ort.InferenceSession(
+            self.onnx_path,
+            session_options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.config = copy.deepcopy(model.config)
+        self.config._commit_hash = f"{model_revision(model)}+onnx"
+        self.name_or_path = model.name_or_path
+
+    def eval(self):
+        return self
+
+    def __call__(self, pixel_values, pixel_mask=None, **kwargs):
+        if pixel_mask is None:
+            pixel_mask = torch.ones(
+                pixel_values.shape[0], *pixel_values.shape[2:], dtype=torch.int64
+            )
+        logits, pred_boxes = self.session.run(
+            ["logits", "pred_boxes"],
+            {
+                "pixel_values": pixel_values.numpy().astype(np.float32),
+                "pixel_mask": pixel_mask.numpy().astype(np.int64),
+            },
+        )
+        return types.SimpleNamespace(
+            logits=torch.from_numpy(logits),
+            pred_boxes=torch.from_numpy(pred_boxes),
+        )
+
+
+def box_parity(reference_boxes, boxes):
+    """Largest IoU deviation (1 - IoU) between two sets of page boxes.
+
+    Each reference box is matched to its best overlapping box. Pages where
+    the number of boxes differs count as a full deviation of 1.
+    """
+    if len(reference_boxes) != len(boxes):
+        return 1.0
+    if len(boxes) == 0:
+        return 0.0
+    best_iou = box_iou(reference_boxes, boxes).max(dim=1).values
+    return float(1 - best_iou.min())
+
+
+def onnx_parity_check(image_processor, model, onnx_model, images, threshold=0.9):
+    """Compare the boxes of the PyTorch and ONNX backends on sample pages.
+
+    Prints and returns the max IoU deviation across pages.
+    """
+    deviations = []
+    for image in images:
+        torch_result = detect_table_batch(image_processor, model, [image], threshold)[0]
+        onnx_result = detect_table_batch(image_processor, onnx_model, [image], threshold)[0]
+        deviations.append(box_parity(torch_result["boxes"], onnx_result["boxes"]))
+
+    max_deviation = max(deviations, default=0.0)
+    print(
+        f"ONNX parity over {len(images)} pages: "
+        f"max IoU deviation {max_deviation:.2e}"
+    )
+    return max_deviation
+
+
+# Largest IoU deviation accepted between the ONNX and PyTorch boxes
+PARITY_TOLERANCE = 1e-2
+
+
+def synthetic_pages(n_pages=4, seed=0):
+    """A4 page images at the detector's resolution with ruled tables drawn on them."""
+    rng = random.Random(seed)
+    pages = []
+    for _ in range(n_pages):
+        image = Image.new("RGB", (800, 1131), "white")
+        draw = ImageDraw.Draw(image)
+        top = rng.randint(80, 300)
+        for _ in range(rng.randint(1, 2)):
+            n_rows, n_cols = rng.randint(4, 12), rng.randint(3, 6)
+            left, width, row_height = rng.randint(40, 120), rng.randint(450, 640), 24
+            for row in range(n_rows + 1):
+                y = top + row * row_height
+                draw.line([(left, y), (left + width, y)], fill="black")
+            for col in range(n_cols + 1):
+                x = left + col * width // n_cols
+                draw.line([(x, top), (x, top + n_rows * row_height)], fill="black")
+            for row in range(n_rows):
+                for col in range(n_cols):
+                    draw.text(
+                        (left + col * width // n_cols + 6, top + row * row_height + 6),
+                        str(rng.randint(0, 9999)), fill="black"
+                    )
+            top += n_rows * row_height + rng.randint(60, 160)
+        pages.append(image)
+    return pages
+
+
+def parity_images(n_pages=10):
+    """Rendered report pages if there are any, and synthetic pages otherwise."""
+    from data_construction.quantized_detector import sample_pages
+
+    return [Image.open(path).convert("RGB") for path in sample_pages(n_pages)] or synthetic_pages()
+
+
+def checked_onnx_detector(image_processor, model, onnx_dir, images=None, tolerance=PARITY_TOLERANCE):
+    """OnnxDetector of the model, whose graph passed the parity check.
+
+    A graph is checked once against the PyTorch model, on `images` or the
+    parity_images, and the result is saved next to it. A graph deviating
+    by more than `tolerance` is deleted, so it is exported again next
+    time, and a RuntimeError is raised instead of using it.
+    """
+    onnx_model = OnnxDetector(model, onnx_dir)
+    check_path = onnx_model.onnx_path + ".parity.json"
+    if os.path.exists(check_path):
+        return onnx_model
+
+    images = images or parity_images()
+    deviation = onnx_parity_check(image_processor, model, onnx_model, images, threshold=0.5)
+    if deviation > tolerance:
+        onnx_path = onnx_model.onnx_path
+        del onnx_model
+        os.remove(onnx_path)
+        raise RuntimeError(
+            f"The ONNX detector deviates from the PyTorch model by {deviation:.2e} "
+            f"(tolerance {tolerance:.0e}); {onnx_path} was removed"
+        )
+
+    with open(check_path, "w") as f:
+        json.dump({"max_iou_deviation": deviation, "pages": len(images), "tolerance": tolerance}, f)
+    return onnx_model
+
+
+if __name__ == "__main__":
+    from transformers import AutoImageProcessor, TableTransformerForObjectDetection
+
+    onnx_dir = sys.argv[1] if len(sys.argv) > 1 else "./data/intermediate/onnx_models"
+    image_processor = AutoImageProcessor.from_pretrained("microsoft/table-transformer-detection")
+    model = TableTransformerForObjectDetection.from_pretrained("microsoft/table-transformer-detection")
+
+    # Check the cached graph again, whether or not it passed before
+    check_path = os.path.join(
+        onnx_dir, f"table-transformer-{model_revision(model)}-opset17.onnx.parity.json"
+    )
+    if os.path.exists(check_path):
+        os.remove(check_path)
+    try:
+        checked_onnx_detector(image_processor, model, onnx_dir)
+    except RuntimeError as e:
+        print(e)
+        raise SystemExit(1)
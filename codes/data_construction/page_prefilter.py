@@ -0,0 +1,132 @@
+# This script contains the page pre-filter run in front of the table
+# detector. A few vectorized NumPy features of a downsampled page (ruling
+# lines and column-aligned text rows) give a cheap table score, and the
+# model is skipped on pages that clearly hold no table, such as prose or
+# pages with a single picture.
+
+import time
+import numpy as np
+
+
+def runs(mask):
+    """Start and end (exclusive) indices of the runs of True in a 1-D mask."""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def longest_runs(ink):
+    """Length of the longest run of ink pixels in each row of a 2-D mask."""
+    height, width = ink.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = ink
+    edges = np.diff(padded, axis=1)
+
+    # Pair the starts and ends of the runs row by row
+    start_rows, start_cols = np.nonzero(edges == 1)
+    _, end_cols = np.nonzero(edges == -1)
+    longest = np.zeros(height, dtype=np.int64)
+    np.maximum.at(longest, start_rows, end_cols - start_cols)
+    return longest
+
+
+def count_lines(longest, min_length):
+    """Number of ruling lines, merging adjacent rows of the same line."""
+    starts, _ = runs(longest >= min_length)
+    return len(starts)
+
+
+def page_features(image, width=400, ink_level=160, line_length=0.25, column_gap=0.03):
+    """Table features of a page image.
+
+    The page is converted to grayscale and downsampled by an integer factor
+    to about `width` pixels.
+    Returns a dict with:
+        h_lines     horizontal ruling lines spanning `line_length` of the width
+        v_lines     vertical ruling lines spanning `line_length` of the height
+        text_rows   bands of text
+        column_rows text bands split in at least three blocks by gaps of
+                    `column_gap` of the width, as in the rows of a table
+        ink         fraction of ink pixels
+    """
+    gray = image.convert("L")
+    gray = np.asarray(gray.reduce(max(1, gray.width // width)))
+    ink = gray < ink_level
+    height, width = ink.shape
+
+    h_lines = count_lines(longest_runs(ink), line_length * width)
+    v_lines = count_lines(longest_runs(ink.T), line_length * height)
+
+    # Bands of consecutive rows with some ink, i.e. lines of text
+    row_ink = ink.mean(axis=1)
+    band_starts, band_ends = runs((row_ink > 0.002) & (row_ink < 0.6))
+
+    # Split each band in blocks separated by wide empty gaps
+    min_gap = max(2, round(column_gap * width))
+    column_rows = 0
+    for start, end in zip(band_starts, band_ends):
+        gap_starts, gap_ends = runs(~ink[start:end].any(axis=0))
+        inner = (gap_starts > 0) & (gap_ends < width)
+        if np.count_nonzero(gap_ends[inner] - gap_starts[inner] >= min_gap) >= 2:
+            column_rows += 1
+
+    return {
+        "h_lines": h_lines,
+        "v_lines": v_lines,
+        "text_rows": len(band_starts),
+        "column_rows": column_rows,
+        "ink": float(ink.mean()),
+    }
+
+
+def table_score(features):
+    """Score in [0, 1] of the chance that a page holds a table.
+
+    Ruled tables show several ruling lines and borderless ones several
+    rows of column-aligned text; either is enough for a full score.
+    """
+    return max(
+        min(features["h_lines"] / 4, 1.0),
+        min(features["v_lines"] / 3, 1.0),
+        min(features["column_rows"] / 4, 1.0),
+    )
+
+
+class PagePrefilter:
+    """Decide which pages go through the table detector.
+
+    A page is skipped when its table score is below `min_score`, the
+    recall-safe margin: the lower it is, the clearer the evidence of no
+    table has to be. Pages that are nearly blank are kept as well, since
+    a faint scan can hide a table from the features. `skipped`, `kept`
+    and `seconds` count the decisions and the time spent on them.
+    """
+
+    def __init__(self, min_score=0.25, min_ink=0.002):
+        self.min_score = min_score
+        self.min_ink = min_ink
+        self.skipped = 0
+        self.kept = 0
+        self.seconds = 0.0
+
+    def keep(self, image):
+        start_time = time.perf_counter()
+        features = page_features(image)
+        keep = features["ink"] < self.min_ink or table_score(features) >= self.min_score
+        self.seconds += time.perf_counter() - start_time
+
+        if keep:
+            self.kept += 1
+        else:
+            self.skipped += 1
+        return keep
+
+    def summary(self, model_seconds_per_page=None):
+        """Print the pages skipped and the model time saved."""
+        message = (
+            f"Pre-filter skipped {self.skipped} of {self.skipped + self.kept} pages "
+            f"(min score {self.min_score}, {self.seconds:.1f}s of features)"
+        )
+        if model_seconds_per_page is not None:
+            saved = self.skipped * model_seconds_per_page - self.seconds
+            message += f", saving ~{saved:.1f}s of detection"
+        print(message)
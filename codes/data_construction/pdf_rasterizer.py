@@ -0,0 +1,119 @@
+# This script contains the in-process PDF rasterizer. Pages are rendered
+# with PDFium straight to PIL images, from document handles that stay
+# open across the whole page list, instead of spawning a poppler process
+# per call and round-tripping every page through a temporary file.
+
+import os
+import time
+import atexit
+import threading
+from collections import OrderedDict
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+
+class PdfDocumentPool:
+    """Open PDFium documents, kept for reuse across calls.
+
+    Documents are keyed by path and modification time, so a re-downloaded
+    report is reopened, and the least recently used one is closed when
+    more than `max_open` are open. PDFium is not thread-safe, so renders
+    through the pool hold its lock.
+    """
+
+    def __init__(self, max_open=4):
+        if pdfium is None:
+            raise ImportError("The pdfium renderer needs pypdfium2")
+        self.max_open = max_open
+        self.documents = OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, pdf_path):
+        key = (os.path.abspath(pdf_path), os.path.getmtime(pdf_path))
+        with self.lock:
+            if key in self.documents:
+                self.documents.move_to_end(key)
+                return self.documents[key]
+
+            document = pdfium.PdfDocument(pdf_path)
+            self.documents[key] = document
+            while len(self.documents) > self.max_open:
+                _, oldest = self.documents.popitem(last=False)
+                oldest.close()
+            return document
+
+    def render(self, pdf_path, page_num, dpi=200):
+        """Render a page (numbered from 1) to an RGB PIL image."""
+        with self.lock:
+            page = self.get(pdf_path)[page_num - 1]
+            try:
+                bitmap = page.render(scale=dpi / 72)
+                return bitmap.to_pil().convert("RGB")
+            finally:
+                page.close()
+
+    def page_size(self, pdf_path, page_num):
+        """(width, height) of a page (numbered from 1), in points."""
+        with self.lock:
+            page = self.get(pdf_path)[page_num - 1]
+            try:
+                return page.get_size()
+            finally:
+                page.close()
+
+    def close(self):
+        with self.lock:
+            for document in self.documents.values():
+                document.close()
+            self.documents.clear()
+
+
+# Pool shared by the renders of a run
+_pool = None
+
+
+def document_pool():
+    """Process-wide document pool, created on first use."""
+    global _pool
+    if _pool is None:
+        _pool = PdfDocumentPool()
+        atexit.register(_pool.close)
+    return _pool
+
+
+def iter_pdfium_pages(pdf_path, pages, dpi=200):
+    """Render the listed pages of a PDF in-process, one image at a time."""
+    pool = document_pool()
+    for page_num in pages:
+        yield page_num, pool.render(pdf_path, page_num, dpi)
+
+
+def benchmark_renderers(pdf_path, pages, dpi=200, repeat=3):
+    """Print the pages/sec of the pdf2image and pdfium renderers."""
+    from data_construction.antenne_reports_utils import iter_pdf_pages
+
+    for renderer in ["pdf2image", "pdfium"]:
+        try:
+            best = float("inf")
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                for _, image in iter_pdf_pages(pdf_path, pages, dpi=dpi, renderer=renderer):
+                    image.load()
+                best = min(best, time.perf_counter() - start_time)
+            print(f"{renderer}: {len(pages) / best:.1f} pages/sec ({len(pages)} pages at {dpi} dpi)")
+        except Exception as e:
+            print(f"{renderer}: unavailable ({type(e).__name__}: {e})")
+
+
+if __name__ == "__main__":
+    import json
+    from data_construction.antenne_reports_utils import get_year_paths
+
+    with open("./data/source/antenne_reports/tables_dict.json", "r") as f:
+        tables_dict = json.load(f)
+
+    year = max(tables_dict)
+    benchmark_renderers(get_year_paths("antenne", int(year))["pdf"], tables_dict[year])
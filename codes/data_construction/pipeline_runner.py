@@ -0,0 +1,337 @@
+# This script contains a small incremental task runner for the report
+# pipeline. Each (report, year, stage) is a task with declared inputs and
+# outputs, and completed tasks are recorded in an on-disk manifest. Tasks
+# run one after the other, or across a pool of worker processes.
+
+import os
+import json
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from data_construction.artifact_cache import take_worker_counts
+
+
+def input_signature(inputs, params=None):
+    """Hash the content of the input files together with the parameters."""
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode())
+    for path in sorted(inputs):
+        digest.update(path.encode())
+        if not os.path.exists(path):
+            digest.update(b"<missing>")
+            continue
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class WorkerResource:
+    """Picklable handle on an expensive object, built once per process.
+
+    Calling the handle returns the object built by `loader()`, e.g. the
+    detection model, loading it on first use in each worker process and
+    reusing it for every later task that process runs.
+    """
+
+    _loaded = {}
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+
+    def __call__(self):
+        if self.name not in self._loaded:
+            self._loaded[self.name] = self.loader()
+        return self._loaded[self.name]
+
+
+def run_collecting_errors(function, *args, detector=None, **kwargs):
+    """Run a per-year pipeline function and return the errors it collected.
+
+    With a detector handle, the image processor and the model it returns
+    are passed as keyword arguments.
+    """
+    errors = []
+    if detector is not None:
+        kwargs["image_processor"], kwargs["model"] = detector()
+    function(*args, errors=errors, **kwargs)
+    return errors
+
+
+def run_in_worker(action):
+    """Run a task's action in a worker process.
+
+    Returns its errors and the cache hits and misses it counted, which the
+    parent process would not see otherwise.
+    """
+    take_worker_counts()
+    errors = action() or []
+    return errors, take_worker_counts()
+
+
+def init_worker(n_threads):
+    """Give each worker process its share of the cores for torch (and ONNX Runtime)."""
+    import torch
+
+    torch.set_num_threads(n_threads)
+
+
+class Task:
+    """A unit of pipeline work.
+
+    `inputs` and `outputs` are lists of paths, or callables returning them
+    when they are only known once upstream tasks have run. `params` holds
+    any non-file setting that should trigger a rerun when it changes. The
+    action may return a list of errors, which fails the task; to run in a
+    worker process it must be picklable (e.g. a functools.partial of a
+    module-level function).
+    """
+
+    def __init__(self, name, action, inputs=(), outputs=(), params=None, deps=()):
+        self.name = name
+        self.action = action
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params
+        self.deps = list(deps)
+
+    def resolve(self, paths):
+        return list(paths() if callable(paths) else paths)
+
+
+class PipelineRunner:
+    """Run tasks in dependency order, skipping those that are up to date.
+
+    A task is up to date when the manifest holds the signature of its
+    current inputs and all of its outputs exist. A task that raises,
+    returns errors or leaves outputs missing is reported as failed and is
+    not recorded, so the next run retries it.
+
+    With max_workers > 1 the tasks whose dependencies are done run in a
+    pool of worker processes, each with an equal share of the cores for
+    torch's intra-op threads. The manifest is only written by this
+    process, and the cache hits and misses of the workers are added to
+    `cache`, if given, so its report covers them.
+    """
+
+    def __init__(self, manifest_path, force=False, max_workers=1, cache=None):
+        self.manifest_path = manifest_path
+        self.force = force
+        self.max_workers = max_workers
+        self.cache = cache
+        self.tasks = {}
+        self.errors = {}
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+
+    def add(self, task):
+        self.tasks[task.name] = task
+        return task
+
+    def _save_manifest(self):
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _order(self):
+        """Topological order of the tasks, following insertion order."""
+        ordered, visiting, seen = [], set(), set()
+
+        def visit(name):
+            if name in seen:
+                return
+            if name in visiting:
+                raise ValueError(f"Dependency cycle at task {name}")
+            visiting.add(name)
+            for dep in self.tasks[name].deps:
+                if dep in self.tasks:
+                    visit(dep)
+            visiting.discard(name)
+            seen.add(name)
+            ordered.append(self.tasks[name])
+
+        for name in self.tasks:
+            visit(name)
+        return ordered
+
+    def _signature(self, task):
+        """Signature of a task's inputs, or None if it is up to date."""
+        signature = input_signature(task.resolve(task.inputs), task.params)
+        record = self.manifest.get(task.name, {})
+        outputs_exist = all(
+            os.path.exists(path) for path in task.resolve(task.outputs)
+        )
+        if not self.force and record.get("signature") == signature and outputs_exist:
+            return None
+        return signature
+
+    def _missing_outputs(self, task, errors):
+        """The task's errors, or an error if some of its outputs are missing."""
+        missing = [
+            path for path in task.resolve(task.outputs)
+            if not os.path.exists(path)
+        ]
+        if missing and not errors:
+            return [f"{len(missing)} outputs missing"]
+        return errors
+
+    def record(self, name, signature, seconds, completed=None):
+        """Record a completed task in the manifest."""
+        self.manifest[name] = {
+            "signature": signature,
+            "seconds": round(seconds, 2),
+            "completed": completed or time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self._save_manifest()
+
+    def _finish(self, task, signature, seconds, errors):
+        """Record a task that ran; returns whether it succeeded."""
+        errors = self._missing_outputs(task, errors)
+        if errors:
+            self.errors[task.name] = errors
+            print(f"Task {task.name} failed: {errors[0]}")
+            return False
+
+        self.record(task.name, signature, seconds)
+        return True
+
+    def stale_tasks(self):
+        """Tasks to run, in order: the stale ones and everything downstream."""
+        stale, names = [], set()
+        for task in self._order():
+            if any(dep in names for dep in task.deps) or self._signature(task) is not None:
+                stale.append(task)
+                names.add(task.name)
+        return stale
+
+    def run_task(self, name):
+        """Run a single task without recording it in the manifest.
+
+        Used by the workers of the sharded mode. Returns the task's errors
+        and the signature of the inputs it ran on.
+        """
+        task = self.tasks[name]
+        signature = input_signature(task.resolve(task.inputs), task.params)
+        try:
+            errors = task.action() or []
+        except Exception as e:
+            errors = [f"{type(e).__name__}: {e}"]
+        return self._missing_outputs(task, errors), signature
+
+    def run(self):
+        """Run every stale task and return the names of the failed ones."""
+        start_time = time.perf_counter()
+        if self.max_workers > 1:
+            failed, n_run, n_skipped = self._run_parallel()
+        else:
+            failed, n_run, n_skipped = self._run_sequential()
+
+        print(
+            f"Pipeline finished in {time.perf_counter() - start_time:.1f}s: "
+            f"{n_run} tasks run, {n_skipped} up to date, {len(failed)} failed"
+        )
+        for name, errors in self.errors.items():
+            print(f"  {name}:")
+            for error in errors:
+                print(f"    {error}")
+        return failed
+
+    def _run_sequential(self):
+        failed, n_run, n_skipped = [], 0, 0
+
+        for task in self._order():
+            if any(dep in failed for dep in task.deps):
+                print(f"Skipping {task.name}: an upstream task failed")
+                failed.append(task.name)
+                continue
+
+            signature = self._signature(task)
+            if signature is None:
+                n_skipped += 1
+                continue
+
+            print(f"Running {task.name}...")
+            start_time = time.perf_counter()
+            try:
+                errors = task.action() or []
+            except Exception as e:
+                errors = [f"{type(e).__name__}: {e}"]
+
+            if self._finish(task, signature, time.perf_counter() - start_time, errors):
+                n_run += 1
+            else:
+                failed.append(task.name)
+
+        return failed, n_run, n_skipped
+
+    def _run_parallel(self):
+        """Run the ready tasks in worker processes as their deps complete."""
+        failed, done, n_run, n_skipped = [], set(), 0, 0
+        pending = self._order()
+        running = {}
+
+        n_threads = max(1, (os.cpu_count() or 1) // self.max_workers)
+        executor = ProcessPoolExecutor(
+            self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(n_threads,),
+        )
+        with executor:
+            while pending or running:
+                for task in list(pending):
+                    if any(dep in failed for dep in task.deps):
+                        print(f"Skipping {task.name}: an upstream task failed")
+                        failed.append(task.name)
+                        pending.remove(task)
+                    elif all(dep in done or dep not in self.tasks for dep in task.deps):
+                        pending.remove(task)
+                        signature = self._signature(task)
+                        if signature is None:
+                            n_skipped += 1
+                            done.add(task.name)
+                            continue
+                        print(f"Running {task.name}...")
+                        future = executor.submit(run_in_worker, task.action)
+                        running[future] = (task, signature, time.perf_counter())
+
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task, signature, start_time = running.pop(future)
+                    try:
+                        errors, counts = future.result()
+                        if self.cache is not None:
+                            self.cache.add_counts(counts)
+                    except Exception as e:
+                        errors = [f"{type(e).__name__}: {e}"]
+
+                    if self._finish(task, signature, time.perf_counter() - start_time, errors):
+                        n_run += 1
+                        done.add(task.name)
+                    else:
+                        failed.append(task.name)
+
+        return failed, n_run, n_skipped
+
+
+def parse_years(selectors):
+    """Parse year selectors such as ['2003', '2015-2017'] into a set."""
+    years = set()
+    for selector in selectors:
+        for part in selector.split(","):
+            if "-" in part:
+                first, last = part.split("-")
+                years.update(range(int(first), int(last) + 1))
+            elif part:
+                years.add(int(part))
+    return years
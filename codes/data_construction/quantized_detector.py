@@ -0,0 +1,210 @@
+# This script contains the int8 mode of the table detector. The linear
+# layers of the table-transformer (attention projections, feed-forward
+# blocks and prediction heads) are quantized dynamically to int8 and the
+# quantized model is cached on disk. It also contains the harness that
+# compares the fp32 and int8 detectors on a fixed sample of report pages.
+
+import os
+import copy
+import time
+import random
+import resource
+import threading
+import torch
+from PIL import Image
+from data_construction.antenne_reports_utils import (
+    get_year_paths,
+    detect_table_batch,
+    box_iou,
+    model_revision,
+)
+
+
+def quantize_detector(model, quantized_dir):
+    """Return an int8 copy of the detector, cached under quantized_dir.
+
+    Dynamic quantization stores the weights of every nn.Linear as int8 and
+    quantizes the activations on the fly, so no calibration data is needed.
+    The convolutional backbone stays in fp32. The copy's revision is tagged
+    "+int8" so its cached boxes are kept apart from the fp32 ones.
+    """
+    revision = model_revision(model)
+    quantized_path = os.path.join(
+        quantized_dir, f"table-transformer-{revision}-int8.pt"
+    )
+
+    if os.path.exists(quantized_path):
+        # The file is a pickled module written by this function
+        quantized_model = torch.load(quantized_path, weights_only=False)
+        return quantized_model.eval()
+
+    print(f"Quantizing the detector to {quantized_path}...")
+    os.makedirs(quantized_dir, exist_ok=True)
+
+    quantized_model = torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(model).eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+    quantized_model.config._commit_hash = f"{revision}+int8"
+
+    torch.save(quantized_model, quantized_path + ".tmp")
+    os.replace(quantized_path + ".tmp", quantized_path)
+
+    return quantized_model
+
+
+def current_rss():
+    """Resident memory of the process in bytes."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # No procfs: fall back to the peak, in KiB on Linux and bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakMemory:
+    """Context manager sampling the resident memory in a background thread.
+
+    `peak` is the highest resident memory seen above the level at entry.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+
+    def _sample(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, current_rss() - self.baseline)
+            self._done.wait(self.interval)
+
+    def __enter__(self):
+        self.baseline = current_rss()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss() - self.baseline)
+
+
+def sample_pages(n_pages=20, seed=0):
+    """Fixed sample of rendered antenne and national page images.
+
+    Half of the pages are drawn from each report, over every year whose
+    images are present.
+    """
+    rng = random.Random(seed)
+    sample = []
+
+    for report, years in [("antenne", range(2003, 2024)), ("national", range(1999, 2024))]:
+        file_paths = []
+        for year in years:
+            img_path = get_year_paths(report, year)["img"]
+            if os.path.isdir(img_path):
+                file_paths += sorted(
+                    os.path.join(img_path, f)
+                    for f in os.listdir(img_path) if f.endswith(".png")
+                )
+        sample += rng.sample(file_paths, min(n_pages // 2, len(file_paths)))
+
+    return sample
+
+
+def table_recall(reference_boxes, boxes, match_iou=0.5):
+    """Match the reference tables of a page to the detected ones.
+
+    Returns the number of reference tables found with an IoU of at least
+    match_iou, and the IoU of each of those matches.
+    """
+    if len(reference_boxes) == 0 or len(boxes) == 0:
+        return 0, []
+    best_iou = box_iou(reference_boxes, boxes).max(dim=1).values
+    matched = best_iou[best_iou >= match_iou]
+    return len(matched), matched.tolist()
+
+
+def compare_detectors(
+        image_processor,
+        models,
+        file_paths,
+        batch_size=4,
+        threshold=0.9,
+        match_iou=0.5
+        ):
+    """Run every detector on the same pages and print a comparison.
+
+    models maps a mode name to a model; the first one is the reference for
+    recall and IoU. For each mode the latency per page, the peak resident
+    memory of the run and, against the reference, the table-level recall
+    and mean IoU of the matched tables at the given threshold are reported.
+    """
+    images = [Image.open(file_path).convert("RGB") for file_path in file_paths]
+    batches = [images[start:start + batch_size] for start in range(0, len(images), batch_size)]
+
+    # Warm-up batch, so one-off allocations are not timed
+    for model in models.values():
+        detect_table_batch(image_processor, model.eval(), batches[0], threshold)
+
+    report, reference = {}, None
+    for mode, model in models.items():
+        with PeakMemory() as memory:
+            start_time = time.perf_counter()
+            results = [
+                result
+                for batch in batches
+                for result in detect_table_batch(image_processor, model, batch, threshold)
+            ]
+            elapsed = time.perf_counter() - start_time
+
+        boxes = [result["boxes"] for result in results]
+        if reference is None:
+            reference = boxes
+
+        n_reference = sum(len(page_boxes) for page_boxes in reference)
+        n_found, ious = 0, []
+        for reference_boxes, page_boxes in zip(reference, boxes):
+            page_found, page_ious = table_recall(reference_boxes, page_boxes, match_iou)
+            n_found += page_found
+            ious += page_ious
+
+        report[mode] = {
+            "ms_per_page": elapsed / len(images) * 1000,
+            "peak_mb": memory.peak / 2**20,
+            "tables": sum(len(page_boxes) for page_boxes in boxes),
+            "recall": n_found / n_reference if n_reference else 1.0,
+            "mean_iou": sum(ious) / len(ious) if ious else 1.0,
+        }
+        print(
+            f"{mode}: {report[mode]['ms_per_page']:.0f} ms/page, "
+            f"peak +{report[mode]['peak_mb']:.0f} MB, "
+            f"{report[mode]['tables']} tables, "
+            f"recall {report[mode]['recall']:.3f}, "
+            f"mean IoU {report[mode]['mean_iou']:.3f} (threshold {threshold})"
+        )
+
+    return report
+
+
+if __name__ == "__main__":
+    from transformers import AutoImageProcessor, TableTransformerForObjectDetection
+
+    image_processor = AutoImageProcessor.from_pretrained(
+        "microsoft/table-transformer-detection"
+    )
+    model = TableTransformerForObjectDetection.from_pretrained(
+        "microsoft/table-transformer-detection"
+    )
+
+    file_paths = sample_pages()
+    print(f"Comparing the detectors on {len(file_paths)} pages...")
+    compare_detectors(
+        image_processor,
+        {
+            "fp32": model,
+            "int8": quantize_detector(model, "./data/intermediate/quantized_models"),
+        },
+        file_paths,
+    )
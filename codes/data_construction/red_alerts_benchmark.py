@@ -0,0 +1,148 @@
+# This script benchmarks the Telegraaf archive crawler against a local
+# fake archive server, comparing the sequential scraper with the
+# concurrent one and checking that both produce the same matches, and
+# compares the keyword matchers on synthetic archive pages.
+
+import time
+import random
+import asyncio
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from data_construction.keyword_matcher import build_matcher, AhoCorasickMatcher
+from data_construction.telegraaf_match_store import MatchStore
+from data_construction.red_alerts_scraper import (
+    archive_url,
+    crawl_archive,
+    scrape_for_keywords,
+)
+
+WORDS = ["amsterdam", "politie", "xtc", "cocaine", "feest", "waarschuwing", "nieuws"]
+
+# Vocabulary of the synthetic archive pages
+SYLLABLES = ["ver", "ge", "de", "an", "pil", "len", "drug", "stof", "xt", "co", "ka",
+             "ine", "mdma", "wiet", "han", "del", "aar", "ziek", "huis", "ling"]
+
+
+def make_handler(latency, error_rate):
+    rng = random.Random(0)
+
+    class FakeArchiveHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            if rng.random() < error_rate:
+                self.send_error(503)
+                return
+
+            # The content of a day only depends on its path
+            day_rng = random.Random(self.path)
+            links = "".join(
+                f'<a href="/a/{i}">{" ".join(day_rng.choices(WORDS, k=12))}</a>'
+                for i in range(day_rng.randint(20, 60))
+            )
+            body = f'<html><div class="Archive__list">{links}</div></html>'.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return FakeArchiveHandler
+
+
+def benchmark_crawl(n_days=120, latency=0.05, error_rate=0.02, concurrency=(1, 8, 32)):
+    """Print the crawl time of the sequential and concurrent scrapers."""
+    keywords = ["xtc", "cocaine", "waarschuwing"]
+    start_date = datetime(2009, 1, 1)
+    end_date = start_date + timedelta(days=n_days - 1)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(latency, error_rate))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url_base = f"http://127.0.0.1:{server.server_address[1]}/archief/"
+
+    start_time = time.perf_counter()
+    sequential = {}
+    for i in range(n_days):
+        date = start_date + timedelta(days=i)
+        result = scrape_for_keywords(archive_url(url_base, date), keywords)
+        if result:
+            sequential[date.date().isoformat()] = result
+    print(f"sequential: {time.perf_counter() - start_time:.2f}s ({n_days} days)")
+
+    for n_workers in concurrency:
+        with tempfile.TemporaryDirectory() as folder:
+            store = MatchStore(folder)
+            start_time = time.perf_counter()
+            asyncio.run(crawl_archive(
+                url_base, keywords, start_date, end_date, store,
+                concurrency=n_workers, rate=1000, backoff=0.05
+            ))
+            elapsed = time.perf_counter() - start_time
+            results = store.read_results()
+
+        same = all(results[day] == result for day, result in sequential.items())
+        print(
+            f"concurrency {n_workers}: {elapsed:.2f}s, {len(results)} days, "
+            f"same counts as sequential: {same}"
+        )
+
+    server.shutdown()
+
+
+def make_archive_text(rng, n_words):
+    """Lowercased text of a synthetic archive page with Dutch-like words."""
+    return " ".join(
+        "".join(rng.choices(SYLLABLES, k=rng.randint(1, 4)))
+        for _ in range(n_words)
+    )
+
+
+def benchmark_matchers(n_keywords=300, n_pages=50, n_words=8000, repeat=3):
+    """Print the time per page of each keyword matcher."""
+    rng = random.Random(0)
+    keywords = list(dict.fromkeys(
+        "".join(rng.choices(SYLLABLES, k=rng.randint(1, 3)))
+        for _ in range(n_keywords * 2)
+    ))[:n_keywords]
+    pages = [make_archive_text(rng, n_words) for _ in range(n_pages)]
+    print(
+        f"{len(keywords)} keywords, {n_pages} pages of "
+        f"~{sum(map(len, pages)) // n_pages // 1024} KB"
+    )
+
+    matchers = {
+        "str.count": build_matcher(keywords, kind="count"),
+        "aho-corasick (python)": AhoCorasickMatcher(keywords, backend="python"),
+        "aho-corasick (python, word boundaries)": AhoCorasickMatcher(
+            keywords, word_boundary=True, backend="python"
+        ),
+    }
+    try:
+        matchers["aho-corasick (c)"] = AhoCorasickMatcher(keywords, backend="c")
+    except ImportError:
+        print("pyahocorasick not installed, skipping the C automaton")
+
+    reference = [matchers["str.count"](page) for page in pages]
+    for name, matcher in matchers.items():
+        best = min(
+            timeit(lambda: [matcher(page) for page in pages])
+            for _ in range(repeat)
+        )
+        same = "boundaries" in name or [matcher(page) for page in pages] == reference
+        print(f"{name}: {best / n_pages * 1000:.2f} ms/page, same counts: {same}")
+
+
+def timeit(function):
+    start_time = time.perf_counter()
+    function()
+    return time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    benchmark_crawl()
+    benchmark_matchers()
@@ -1,8 +1,45 @@
 import requests
 from bs4 import BeautifulSoup
 from datetime import datetime, timedelta
-import pandas as pd
+from requests.adapters import HTTPAdapter
+import asyncio
+import random
+import time
 import json
+import sys
+from pathlib import Path
+
+# The script is run from the root of the repository
+# (python codes/data_construction/red_alerts_scraper.py), so the codes
+# folder is put on the path to import its sibling modules
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from data_construction.keyword_matcher import build_matcher
+from data_construction.telegraaf_match_store import MatchStore
+
+
+def count_keywords(page_content, matcher):
+    '''Count the keywords and archive links in the HTML of a page
+
+    matcher is built once per run with build_matcher, or is a plain list
+    of keywords, counted with one str.count per keyword.
+    '''
+    if not callable(matcher):
+        matcher = build_matcher(matcher, kind='count')
+
+    # Parse the HTML
+    soup = BeautifulSoup(page_content, 'html.parser')
+
+    # Convert HTML to plain text and search for keywords
+    page_text = soup.get_text().lower()
+
+    # Search for keywords
+    found_keywords = matcher(page_text)
+
+    # Find all links within the container with the specific class
+    n_links = len(soup.select('.Archive__list a'))
+
+    return [found_keywords, n_links]
 
 
 def scrape_for_keywords(url, keywords):
@@ -12,110 +49,152 @@ def scrape_for_keywords(url, keywords):
         # Fetch the content of the webpage
         response = requests.get(url)
         response.raise_for_status()  # Raise an exception for HTTP errors
-        page_content = response.text
-
-        # Parse the HTML
-        soup = BeautifulSoup(page_content, 'html.parser')
-
-        # Convert HTML to plain text and search for keywords
-        page_text = soup.get_text().lower()
-
-        # Search for keywords
-        found_keywords = {keyword: page_text.count(keyword.lower()) for keyword in keywords}
-
-        # Find all links within the container with the specific class
-        n_links = len(soup.select('.Archive__list a'))
 
-        return [found_keywords, n_links]
+        return count_keywords(response.text, keywords)
 
     except requests.exceptions.RequestException as e:
         print(f"An error occurred: {e}")
         return None
 
 
-# Load the keywords
-keywords_path = r'./codes/data_construction/aux_files/telegraaf_keywords.json'
-with open(keywords_path, 'r') as f:
-    keywords = json.load(f)
-
-# Common link
-url_base = "https://www.telegraaf.nl/archief/"
-
-# Define the start and end dates
-start_date, end_date = datetime(2009, 1, 1), datetime(2023, 12, 31)
-delta = timedelta(days=1)
-
-# Create an empty list to store the matches
-matches = []
-
-# Loop over the dates and scrape the webpage for the keywords
-current_date = start_date
-
-while current_date <= end_date:
-    # Extract the current year, month, and day
-    c_year = current_date.year
-    c_month = current_date.month
-    c_day = current_date.day
-
-    # Construct the URL for the current date
-    url = url_base + f"/{c_year}/{c_month:02d}/{c_day:02d}"
-
-    # Scrape the webpage for the keywords
-    results = scrape_for_keywords(url, keywords)
-
-    # Check if results are not None
-    if results:
-        results_keywords = results[0]
-        results_links = results[1]
-
-        # Append the results to the matches list
-        for keyword, count in results_keywords.items():
-            matches.append({
-                'date': current_date,
-                'n_links': results_links,
-                'keyword': keyword,
-                'count': count,
-                'url': url
-            })
-
-    # Move to the next day
-    current_date += delta
-
-# Alerts results path
-results_path = r'./data/processed/red_alerts_news/'
-
-# Save the matches to a JSON file
-with open(results_path + 'telegraaf_matches.json', 'w') as f:
-    json.dump(matches, f, default=str)
-
-# Convert matches to a DataFrame
-matches_df = pd.DataFrame(matches)
-
-# Convert the 'date' column to datetime
-matches_df['date'] = pd.to_datetime(matches_df['date'])
-
-# Aggregate the observations at the year-month level for each keyword
-matches_df['year_month'] = matches_df['date'].dt.to_period('M')
-monthly_aggregated_df = matches_df.groupby(['year_month', 'keyword']).agg({
-    'count': 'sum',
-    'n_links': 'sum'
-}).reset_index()
-
-# Save the aggregated data to a CSV file
-monthly_aggregated_df.to_csv(
-    results_path + 'telegraaf_monthly_aggregated.csv',
-    index=False
-)
-
-# Aggregate the observations at the year level for each keyword
-matches_df['year'] = matches_df['date'].dt.year
-yearly_aggregated_df = matches_df.groupby(['year', 'keyword']).agg({
-    'count': 'sum',
-    'n_links': 'sum'
-}).reset_index()
-
-# Save the aggregated data to a CSV file
-yearly_aggregated_df.to_csv(
-    results_path + 'telegraaf_yearly_aggregated.csv',
-    index=False
-)
+class TokenBucket:
+    '''Polite rate limiter: at most `rate` requests per second on average,
+    with bursts of up to `capacity` requests'''
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def archive_url(url_base, date):
+    '''Construct the archive URL of a date'''
+    return url_base + f"/{date.year}/{date.month:02d}/{date.day:02d}"
+
+
+async def crawl_day(session, url, matcher, bucket, semaphore, retries, backoff):
+    '''Fetch an archive page with retries and exponential backoff'''
+
+    async with semaphore:
+        for attempt in range(retries + 1):
+            await bucket.acquire()
+            try:
+                response = await asyncio.to_thread(session.get, url, timeout=30)
+                response.raise_for_status()
+                return await asyncio.to_thread(
+                    count_keywords, response.text, matcher
+                )
+            except requests.exceptions.RequestException as e:
+                if attempt == retries:
+                    print(f"An error occurred: {e}")
+                    return None
+                await asyncio.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+
+async def crawl_archive(
+        url_base,
+        keywords,
+        start_date,
+        end_date,
+        store,
+        concurrency=8,
+        rate=4,
+        retries=3,
+        backoff=1,
+        matcher_kind='auto',
+        word_boundary=False
+        ):
+    '''Crawl the archive concurrently, streaming each day to the store
+
+    Every scraped day is appended to the MatchStore as soon as it arrives,
+    so memory does not grow with the date range and the store acts as the
+    checkpoint: dates already stored are skipped, and an interrupted crawl
+    resumes where it stopped. Returns the number of days scraped.
+    '''
+
+    finished = store.finished_dates()
+
+    dates = []
+    current_date = start_date
+    while current_date <= end_date:
+        if current_date.date().isoformat() not in finished:
+            dates.append(current_date)
+        current_date += timedelta(days=1)
+
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_maxsize=concurrency))
+    session.mount('http://', HTTPAdapter(pool_maxsize=concurrency))
+    matcher = build_matcher(keywords, kind=matcher_kind, word_boundary=word_boundary)
+    bucket = TokenBucket(rate, capacity=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def crawl(date):
+        url = archive_url(url_base, date)
+        return date, url, await crawl_day(
+            session, url, matcher, bucket, semaphore, retries, backoff
+        )
+
+    n_done = 0
+    for task in asyncio.as_completed([crawl(date) for date in dates]):
+        date, url, result = await task
+        # Failed dates are left out of the store to be retried next run
+        if result is not None:
+            store.append(date, url, *result)
+            n_done += 1
+
+    session.close()
+
+    return n_done
+
+
+def main():
+
+    # Load the keywords
+    keywords_path = r'./codes/data_construction/aux_files/telegraaf_keywords.json'
+    with open(keywords_path, 'r') as f:
+        keywords = json.load(f)
+
+    # Common link
+    url_base = "https://www.telegraaf.nl/archief/"
+
+    # Define the start and end dates
+    start_date, end_date = datetime(2009, 1, 1), datetime(2023, 12, 31)
+
+    # Alerts results path
+    results_path = r'./data/processed/red_alerts_news/'
+
+    # Month-partitioned store of the daily counts
+    store = MatchStore(results_path + 'telegraaf_matches')
+
+    # Scrape the archive for the keywords, resuming from the stored days
+    asyncio.run(crawl_archive(
+        url_base,
+        keywords,
+        start_date,
+        end_date,
+        store
+    ))
+
+    # Save the matches and the aggregates (only new months are recomputed)
+    store.export_matches(results_path + 'telegraaf_matches.json')
+    store.save_aggregates(results_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+# This script contains the streaming mode of the report pipeline. Pages
+# flow from render workers to detection workers to extraction workers
+# through bounded queues, so poppler, torch and tabula are busy at the
+# same time and a run takes about as long as its slowest stage instead of
+# the sum of the three.
+
+import os
+import time
+import queue
+import threading
+from data_construction.antenne_reports_utils import (
+    get_year_paths,
+    image_dpi,
+    iter_pdf_pages,
+    detect_table_batch,
+    candidates,
+    save_detections,
+    report_tables_to_csv,
+)
+
+# End of the input of a stage
+DONE = object()
+
+
+class StageQueue:
+    """Bounded queue between two stages, recording its depth.
+
+    The depth is sampled at every put. `blocked` is the time producers
+    spent waiting for room, i.e. the back-pressure of the consumer stage.
+    """
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.puts = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.blocked = 0.0
+
+    def put(self, item):
+        start_time = time.perf_counter()
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        with self.lock:
+            self.blocked += time.perf_counter() - start_time
+            if item is not DONE:
+                self.puts += 1
+                self.depth_sum += depth
+                self.max_depth = max(self.max_depth, depth)
+
+    def get(self, block=True):
+        return self.queue.get(block)
+
+    def summary(self):
+        mean_depth = self.depth_sum / self.puts if self.puts else 0.0
+        return (
+            f"{self.name} queue: {self.puts} items, mean depth {mean_depth:.1f}, "
+            f"max {self.max_depth}/{self.queue.maxsize}, "
+            f"producers blocked {self.blocked:.1f}s"
+        )
+
+
+class Stage:
+    """A pool of worker threads calling `work(items)` on a queue's items.
+
+    Each call gets up to `batch_size` items: the first one is waited for
+    and the others are taken only if already queued. `busy` and `starved`
+    are the seconds the workers spent working and waiting for input.
+    """
+
+    def __init__(self, name, work, inputs, workers=1, batch_size=1):
+        self.name = name
+        self.work = work
+        self.inputs = inputs
+        self.workers = workers
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.threads = []
+
+    def _take(self):
+        """Next batch of items, or None once the input is done."""
+        items = [self.inputs.get()]
+        while items[-1] is not DONE and len(items) < self.batch_size:
+            try:
+                items.append(self.inputs.get(block=False))
+            except queue.Empty:
+                break
+
+        if items[-1] is DONE:
+            # Leave the marker for the other workers of the stage
+            self.inputs.put(DONE)
+            items.pop()
+        return items or None
+
+    def _run(self):
+        while True:
+            start_time = time.perf_counter()
+            items = self._take()
+            waited = time.perf_counter() - start_time
+            if items is None:
+                break
+
+            start_time = time.perf_counter()
+            self.work(items)
+            with self.lock:
+                self.starved += waited
+                self.busy += time.perf_counter() - start_time
+                self.items += len(items)
+
+    def start(self):
+        self.threads = [
+            threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def summary(self):
+        return (
+            f"{self.name}: {self.items} items, {self.workers} workers, "
+            f"busy {self.busy:.1f}s, starved {self.starved:.1f}s"
+        )
+
+
+class StreamingPipeline:
+    """Render, detect and extract report years as a stream of pages.
+
+    run() takes (report, year, pages) work items. Render workers render
+    the listed pages of a year at `dpi` into the detection queue, and
+    detection workers run the model on batches of pages, possibly of
+    different years. Once the last page of a year is detected, its
+    detections file is written (every candidate box, as in the tensors
+    stage) and the year goes to the extraction workers, which run
+    report_tables_to_csv with `threshold` on it. With a DetectionClient
+    the pages are sent to the detection worker instead of the model.
+    With a TableStore the extracted tables are also written to it.
+    """
+
+    def __init__(
+            self,
+            image_processor,
+            model,
+            res_cons=72 / 200,
+            threshold=0.9,
+            dpi=200,
+            renderer="pdf2image",
+            batch_size=4,
+            render_workers=2,
+            detect_workers=1,
+            extract_workers=2,
+            queue_size=16,
+            cache=None,
+            client=None,
+            store=None
+            ):
+        self.image_processor = image_processor
+        self.model = model
+        self.res_cons = res_cons
+        self.threshold = threshold
+        self.dpi = dpi
+        self.renderer = renderer
+        self.cache = cache
+        self.client = client
+        self.store = store
+
+        self.queues = {
+            name: StageQueue(name, queue_size)
+            for name in ("render", "detect", "extract")
+        }
+        self.stages = [
+            Stage("render", self._render, self.queues["render"], render_workers),
+            Stage("detect", self._detect, self.queues["detect"], detect_workers, batch_size),
+            Stage("extract", self._extract, self.queues["extract"], extract_workers),
+        ]
+
+        # Progress of the years in flight, keyed by (report, year)
+        self.lock = threading.Lock()
+        self.years = {}
+        self.errors = {}
+
+    def _fail(self, report, year, message):
+        with self.lock:
+            self.errors.setdefault(f"{report}/{year}", []).append(message)
+
+    def _render(self, items):
+        for report, year, pages in items:
+            pdf_path = get_year_paths(report, year)["pdf"]
+            n_pages = 0
+            try:
+                if not os.path.exists(pdf_path):
+                    raise FileNotFoundError(f"{pdf_path} does not exist")
+                for page_num, image in iter_pdf_pages(
+                        pdf_path, pages, dpi=self.dpi, renderer=self.renderer,
+                        image_processor=self.image_processor):
+                    # The renderer closes each image when the next one is requested
+                    self.queues["detect"].put((report, year, page_num, image.convert("RGB")))
+                    n_pages += 1
+            except Exception as e:
+                self._fail(report, year, f"Rendering {pdf_path}: {type(e).__name__}: {e}")
+
+            with self.lock:
+                self.years[(report, year)]["expected"] = n_pages
+            self._maybe_finish(report, year)
+
+    def _detect(self, items):
+        images = [image for _, _, _, image in items]
+        try:
+            if self.client is not None:
+                results = self.client.detect_images(images, threshold=0.0)
+            else:
+                results = detect_table_batch(
+                    self.image_processor, self.model, images, threshold=0.0
+                )
+        except Exception as e:
+            results = [None] * len(items)
+            for report, year in {(report, year) for report, year, _, _ in items}:
+                self._fail(report, year, f"Detection: {type(e).__name__}: {e}")
+
+        for (report, year, page_num, image), result in zip(items, results):
+            with self.lock:
+                progress = self.years[(report, year)]
+                progress["detected"] += 1
+                if result is not None:
+                    progress["detections"][page_num] = candidates(result, image_dpi(image))
+            self._maybe_finish(report, year)
+
+    def _maybe_finish(self, report, year):
+        """Save the detections of a year once all its pages are detected."""
+        with self.lock:
+            progress = self.years[(report, year)]
+            if progress["expected"] != progress["detected"] or progress["finished"]:
+                return
+            progress["finished"] = True
+            failed = f"{report}/{year}" in self.errors
+
+        if failed:
+            return
+        try:
+            tens_path = get_year_paths(report, year)["tens"]
+            os.makedirs(tens_path, exist_ok=True)
+            save_detections(tens_path, progress["detections"])
+        except Exception as e:
+            self._fail(report, year, f"Saving the detections: {type(e).__name__}: {e}")
+            return
+        # The pages are not needed anymore
+        progress["detections"] = None
+        if progress["extract"]:
+            self.queues["extract"].put((report, year))
+
+    def _extract(self, items):
+        for report, year in items:
+            errors = []
+            report_tables_to_csv(
+                self.res_cons, report, year, year + 1,
+                threshold=self.threshold, cache=self.cache, errors=errors,
+                store=self.store
+            )
+            for error in errors:
+                self._fail(report, year, error)
+
+    def run(self, work_items, extract_years=None):
+        """Stream the (report, year, pages) work items through the stages.
+
+        Only the (report, year) pairs in extract_years, if given, go through
+        extraction. Returns the errors of the failed years, keyed by
+        "report/year".
+        """
+        start_time = time.perf_counter()
+        for report, year, _ in work_items:
+            self.years[(report, year)] = {
+                "expected": None,
+                "detected": 0,
+                "detections": {},
+                "finished": False,
+                "extract": extract_years is None or (report, year) in extract_years,
+            }
+
+        for stage in self.stages:
+            stage.start()
+
+        for item in work_items:
+            self.queues["render"].put(item)
+
+        # Close each stage once the one feeding it is done
+        for stage in self.stages:
+            stage.inputs.put(DONE)
+            stage.join()
+
+        self.summary(time.perf_counter() - start_time)
+        return self.errors
+
+    def summary(self, elapsed):
+        """Print the time, stage and queue metrics of the run."""
+        print(f"Streaming pipeline finished in {elapsed:.1f}s")
+        for stage in self.stages:
+            print(f"  {stage.summary()}")
+        for stage_queue in self.queues.values():
+            print(f"  {stage_queue.summary()}")
+
+        # The busiest stage, per worker, bounds the end-to-end time
+        slowest = max(self.stages, key=lambda stage: stage.busy / stage.workers)
+        print(
+            f"  Slowest stage: {slowest.name} "
+            f"({slowest.busy / slowest.workers:.1f}s per worker)"
+        )
+        for name, errors in self.errors.items():
+            print(f"  {name}:")
+            for error in errors:
+                print(f"    {error}")
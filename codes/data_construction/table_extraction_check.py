@@ -0,0 +1,163 @@
+# This script checks how the tables of a page's tabula call are mapped
+# back to their detected boxes. The JSON conversion is compared with
+# tabula's own, the mapping is checked on JSON shaped like tabula's output
+# where one detected table is empty, and, if Java is installed, tabula is
+# run on a generated two-page PDF with one call per page and one call per
+# table. Run it from the codes folder.
+
+import os
+import shutil
+import tempfile
+import pandas as pd
+from tabula.io import _extract_from
+from data_construction.antenne_reports_utils import (
+    json_table_frames,
+    page_tables_from_json,
+    extract_report_tables,
+)
+
+
+def cell(text):
+    return {"top": 0.0, "left": 0.0, "width": 1.0, "height": 1.0, "text": text}
+
+
+def raw_table(page, area, rows):
+    '''A table of tabula's JSON output'''
+    top, left, bottom, right = area
+    return {
+        "extraction_method": "stream",
+        "page_number": page,
+        "top": top, "left": left, "bottom": bottom, "right": right,
+        "width": right - left, "height": bottom - top,
+        "data": [[cell(text) for text in row] for row in rows],
+    }
+
+
+def check_conversion():
+    '''The JSON tables convert to the DataFrames tabula.read_pdf gives'''
+    tables = [
+        [["year", "n"], ["2020", "12"]],
+        [["drug", "%"], ["MDMA", "45"], ["GHB", ""]],
+        [["", "x", "x", "", "x.1"], ["a", "1", "2.5", "", "b"]],
+        [["only a header"]],
+        [],
+    ]
+    for rows in tables:
+        table = raw_table(1, [0, 0, 10, 10], rows)
+        expected, frames = _extract_from([table]), json_table_frames(table)
+        assert len(frames) == len(expected), rows
+        for frame, expected_frame in zip(frames, expected):
+            pd.testing.assert_frame_equal(frame, expected_frame)
+    print("JSON table conversion: OK")
+
+
+def check_mapping():
+    '''Each area of a page gets its table, and an empty one gives []'''
+    areas = [[10, 10, 100, 200], [300, 10, 400, 200], [500, 50, 590, 90]]
+    owners = [(3, 0), (3, 1), (3, 2)]
+    contents = [
+        [["year", "n"], ["2020", "12"]],
+        [["drug", "%"], ["MDMA", "45"], ["GHB", ""]],
+        # Detected on page 3 but tabula found no text in it
+        [],
+    ]
+    raw_tables = [raw_table(3, area, rows) for area, rows in zip(areas, contents)]
+
+    tables = page_tables_from_json(raw_tables, 3, owners)
+    assert [(page, tensor) for page, tensor, _ in tables] == owners, tables
+
+    by_owner = {(page, tensor): dfs for page, tensor, dfs in tables}
+    pd.testing.assert_frame_equal(
+        by_owner[(3, 0)][0], pd.DataFrame({"year": [2020], "n": [12]})
+    )
+    pd.testing.assert_frame_equal(
+        by_owner[(3, 1)][0],
+        pd.DataFrame({"drug": ["MDMA", "GHB"], "%": [45.0, float("nan")]})
+    )
+    assert by_owner[(3, 2)] == []
+
+    # Tables missing or from another page are rejected, so the caller
+    # falls back to one call per table
+    assert page_tables_from_json(raw_tables[:-1], 3, owners) is None
+    assert page_tables_from_json(raw_tables, 4, owners) is None
+    print("Per-page table mapping: OK")
+
+
+def write_text_pdf(path, pages):
+    '''Minimal PDF with lines of Helvetica text placed at (x, y) points.
+
+    pages is a list of pages, each a list of (x, y, text) from the bottom
+    left of a 595x842 page.
+    '''
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for lines in pages:
+        stream = "".join(
+            f"BT /F1 10 Tf {x} {y} Td ({text}) Tj ET\n" for x, y, text in lines
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}endstream")
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>"
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{i} 0 R" for i in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>"
+
+    content, offsets = "%PDF-1.4\n", []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(content))
+        content += f"{i} 0 obj\n{body}\nendobj\n"
+    xref = len(content)
+    content += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n"
+    content += "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    content += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    with open(path, "w", encoding="latin-1") as f:
+        f.write(content)
+
+
+def table_lines(top, rows):
+    '''Text lines of a table whose first row is top points below the page top'''
+    return [
+        (72 + 90 * col, 842 - top - 14 * row, text)
+        for row, values in enumerate(rows)
+        for col, text in enumerate(values)
+    ]
+
+
+def check_tabula():
+    '''One tabula call per page gives the tables of one call per table'''
+    if shutil.which("java") is None:
+        print("Tabula extraction: skipped, Java is not installed")
+        return
+
+    pages = [
+        table_lines(100, [["year", "n"], ["2020", "12"], ["2021", "15"]])
+        + table_lines(400, [["drug", "pct"], ["MDMA", "45"], ["GHB", "3"]]),
+        table_lines(200, [["city", "samples"], ["Amsterdam", "120"]]),
+    ]
+    # (top, left, bottom, right) areas around the tables, and an empty one
+    areas = [[90, 60, 140, 260], [390, 60, 440, 260], [600, 60, 700, 260], [190, 60, 225, 260]]
+    owners = [(1, 0), (1, 1), (1, 2), (2, 0)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        pdf_path = os.path.join(folder, "tables.pdf")
+        write_text_pdf(pdf_path, pages)
+        per_page = list(extract_report_tables(pdf_path, areas, owners))
+        per_table = list(extract_report_tables(pdf_path, areas, owners, per_page=False))
+
+    assert [owner[:2] for owner in per_page] == owners, per_page
+    assert [owner[:2] for owner in per_table] == owners, per_table
+    for (_, _, dfs), (_, _, expected) in zip(per_page, per_table):
+        assert len(dfs) == len(expected)
+        for df, expected_df in zip(dfs, expected):
+            pd.testing.assert_frame_equal(df, expected_df)
+    assert [len(dfs) for _, _, dfs in per_page] == [1, 1, 0, 1], per_page
+    print("Tabula extraction: OK")
+
+
+if __name__ == "__main__":
+    check_conversion()
+    check_mapping()
+    check_tabula()
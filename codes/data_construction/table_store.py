@@ -0,0 +1,394 @@
+# This script contains the table store of the extracted report tables.
+# Instead of one .csv file per table, the tables of a (report, year) are
+# written to a single Parquet file of the store, keyed by page and table
+# index, with a JSON sidecar recording the columns and dtypes each table
+# has when read with pd.read_csv and the .csv file it was imported from.
+# The cleaning scripts load a year with one read and look its tables up by
+# their .csv file name, reading the .csv file when it changed since.
+
+import os
+import re
+import sys
+import json
+import time
+import numpy as np
+import pandas as pd
+from io import StringIO
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # The cleaners fall back to the .csv files
+    pa = pq = None
+
+# Root of the store, partitioned as report=<report>/year=<year>
+TABLE_STORE_PATH = "./data/intermediate/report_tables/"
+
+# Files of a partition
+DATA_FILE = "tables.parquet"
+SIDECAR_FILE = "tables.json"
+
+# Name of the .csv file of a table, <page>_<table index>.csv
+TABLE_FILE = re.compile(r"(\d+)_(\d+)\.csv")
+
+
+def table_key(file_name):
+    """(page, table index) of a table's .csv file name, or None."""
+    match = TABLE_FILE.fullmatch(os.path.basename(file_name))
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+# Cells pd.read_csv parses as booleans
+BOOL_VALUES = {"True", "TRUE", "true", "False", "FALSE", "false"}
+
+
+def infer_dtype(values):
+    """The dtype pd.read_csv infers for a column from its str cells."""
+    if len(values) == 0:
+        return "object"
+    present = values[~pd.isna(values)]
+    if len(present) == 0:
+        return "float64"
+    complete = len(present) == len(values)
+    if set(present) <= BOOL_VALUES:
+        return "bool" if complete else "object"
+    try:
+        numbers = pd.to_numeric(present)
+    except (ValueError, TypeError):
+        return "object"
+    # Integer columns with missing cells become float64
+    if numbers.dtype.kind in "iu" and complete:
+        return str(numbers.dtype)
+    return "float64" if numbers.dtype.kind in "iuf" else "object"
+
+
+def parse_csv_text(text):
+    """A table's cells as read with dtype=str, and the dtypes pd.read_csv infers."""
+    raw = pd.read_csv(StringIO(text), dtype=str)
+    return raw, [infer_dtype(raw[column].to_numpy(dtype=object)) for column in raw]
+
+
+def file_signature(path):
+    """Size and modification time of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def restore_column(values, dtype):
+    """Convert a stored column of str cells to the dtype pd.read_csv gives."""
+    if dtype == "object":
+        # Boolean columns with missing cells keep their booleans as objects
+        present = values[~pd.isna(values)]
+        if len(present) and set(present) <= BOOL_VALUES:
+            values = values.copy()
+            values[~pd.isna(values)] = [value.lower() == "true" for value in present]
+        return values
+    if dtype == "bool":
+        return np.array([value.lower() == "true" for value in values], dtype=bool)
+    return values.astype(dtype)
+
+
+class TableStore:
+    """Extracted tables, one Parquet file and sidecar per (report, year).
+
+    Each partition holds the cells of all the tables of a year as strings,
+    one row per table row, in `page`, `table`, `row` and `c0`...`cN`
+    columns, sorted by page and table. Cells are kept as their .csv text,
+    since the cleaners read most tables with dtype=str. The sidecar lists
+    the tables in that order with their number of rows, column names, the
+    dtypes pd.read_csv infers from their .csv text and the signature of the
+    .csv file they were imported from, so a stored table is read back
+    exactly as pd.read_csv (with or without dtype=str) would read its .csv
+    file. A partition is replaced as a whole, so years can be written by
+    parallel workers. Requires pyarrow.
+    """
+
+    def __init__(self, root=TABLE_STORE_PATH):
+        if pa is None:
+            raise ImportError("The table store requires pyarrow")
+        self.root = root
+
+    def partition(self, report, year):
+        return os.path.join(self.root, f"report={report}", f"year={year}")
+
+    def data_path(self, report, year):
+        return os.path.join(self.partition(report, year), DATA_FILE)
+
+    def has_year(self, report, year):
+        partition = self.partition(report, year)
+        return (
+            os.path.exists(os.path.join(partition, DATA_FILE))
+            and os.path.exists(os.path.join(partition, SIDECAR_FILE))
+        )
+
+    def years(self, report):
+        """Years of a report held by the store."""
+        report_path = os.path.join(self.root, f"report={report}")
+        if not os.path.isdir(report_path):
+            return []
+        return sorted(
+            int(name[len("year="):]) for name in os.listdir(report_path)
+            if name.startswith("year=") and self.has_year(report, name[len("year="):])
+        )
+
+    def metadata(self, report, year):
+        """Sidecar of a year: its tables and the metadata given when writing it."""
+        with open(os.path.join(self.partition(report, year), SIDECAR_FILE), "r") as f:
+            return json.load(f)
+
+    def keys(self, report, year):
+        """(page, table index) of the tables of a year."""
+        return [(table["page"], table["table"]) for table in self.metadata(report, year)["tables"]]
+
+    def write_year(self, report, year, tables, metadata=None):
+        """Replace the tables of a year.
+
+        tables maps (page, table index) to the DataFrames, which are stored
+        as pd.read_csv would read them back from df.to_csv(index=False).
+        """
+        self._write(
+            report, year,
+            {key: df.to_csv(index=False) for key, df in tables.items()},
+            {}, metadata
+        )
+
+    def import_csv_folder(self, report, year, folder, metadata=None):
+        """Replace the tables of a year with the <page>_<table>.csv files of a folder.
+
+        A missing folder leaves the year without tables. The size and
+        modification time of each file are recorded, see YearTables.
+        """
+        texts, sources = {}, {}
+        for file_name in os.listdir(folder) if os.path.isdir(folder) else []:
+            key = table_key(file_name)
+            if key is not None:
+                csv_path = os.path.join(folder, file_name)
+                sources[key] = file_signature(csv_path)
+                with open(csv_path, "r", newline="") as f:
+                    texts[key] = f.read()
+        self._write(report, year, texts, sources, metadata)
+
+    def _write(self, report, year, texts, sources, metadata):
+        """Write a partition from the .csv text and source signature of each table."""
+        tables, blocks, keys = [], [], {"page": [], "table": [], "row": []}
+        for (page, index) in sorted(texts):
+            raw, dtypes = parse_csv_text(texts[(page, index)])
+            tables.append({
+                "page": page,
+                "table": index,
+                "file": f"{page}_{index}.csv",
+                "rows": len(raw),
+                "columns": list(raw.columns),
+                "dtypes": dtypes,
+                "source": sources.get((page, index)),
+            })
+            blocks.append(raw.to_numpy(dtype=object))
+            keys["page"] += [page] * len(raw)
+            keys["table"] += [index] * len(raw)
+            keys["row"] += range(len(raw))
+
+        # Tables narrower than the widest one leave their last cells null
+        n_columns = max((len(table["columns"]) for table in tables), default=0)
+        cells = np.full((len(keys["row"]), n_columns), None, dtype=object)
+        start = 0
+        for block in blocks:
+            cells[start:start + len(block), :block.shape[1]] = block
+            start += len(block)
+        cells[pd.isna(cells)] = None
+
+        columns = {
+            name: pa.array(values, type=pa.int32()) for name, values in keys.items()
+        }
+        for i in range(n_columns):
+            columns[f"c{i}"] = pa.array(cells[:, i], type=pa.string())
+
+        partition = self.partition(report, year)
+        os.makedirs(partition, exist_ok=True)
+        sidecar = {
+            "report": report,
+            "year": int(year),
+            "written": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "n_columns": n_columns,
+            "metadata": metadata or {},
+            "tables": tables,
+        }
+
+        # Write both files aside and swap them in, the data file first
+        data_path = os.path.join(partition, DATA_FILE)
+        sidecar_path = os.path.join(partition, SIDECAR_FILE)
+        pq.write_table(pa.table(columns), data_path + ".tmp")
+        with open(sidecar_path + ".tmp", "w") as f:
+            json.dump(sidecar, f, indent=1)
+        os.replace(data_path + ".tmp", data_path)
+        os.replace(sidecar_path + ".tmp", sidecar_path)
+
+    def _read_cells(self, report, year, filters=None):
+        """Cells of a partition as an object array, with NaN for missing cells."""
+        sidecar = self.metadata(report, year)
+        names = [f"c{i}" for i in range(sidecar["n_columns"])]
+        data = pq.read_table(self.data_path(report, year), columns=names, filters=filters)
+        cells = np.empty((data.num_rows, len(names)), dtype=object)
+        for i, name in enumerate(names):
+            cells[:, i] = data.column(name).to_numpy(zero_copy_only=False)
+        cells[pd.isna(cells)] = np.nan
+        return sidecar, cells
+
+    def open_year(self, report, year):
+        """The tables of a year, read in one go and split on request."""
+        return StoredYear(*self._read_cells(report, year))
+
+    def read_year(self, report, year, dtype=None):
+        """All the tables of a year, keyed by (page, table index), in one read."""
+        return self.open_year(report, year).tables(dtype)
+
+    def read_table(self, report, year, page, index, dtype=None):
+        """A single table, reading only its rows of the partition."""
+        sidecar, cells = self._read_cells(
+            report, year, filters=[("page", "=", page), ("table", "=", index)]
+        )
+        for table in sidecar["tables"]:
+            if (table["page"], table["table"]) == (page, index):
+                return table_frame(cells, table, dtype)
+        raise KeyError(f"No table {page}_{index} in {report}/{year}")
+
+
+def table_frame(cells, table, dtype=None):
+    """DataFrame of a stored table from its rows of cells."""
+    if dtype is str:
+        return pd.DataFrame(cells[:, :len(table["columns"])], columns=table["columns"])
+    return pd.DataFrame({
+        column: restore_column(cells[:, i], column_dtype)
+        for i, (column, column_dtype) in enumerate(zip(table["columns"], table["dtypes"]))
+    }, columns=table["columns"])
+
+
+class StoredYear:
+    """Cells of a partition read once, split into tables on request."""
+
+    def __init__(self, sidecar, cells):
+        self.sidecar = sidecar
+        self.cells = cells
+        # Tables are stored in the order of the sidecar
+        self.slices, start = {}, 0
+        for table in sidecar["tables"]:
+            key = (table["page"], table["table"])
+            self.slices[key] = (table, slice(start, start + table["rows"]))
+            start += table["rows"]
+
+    def __contains__(self, key):
+        return key in self.slices
+
+    def table(self, key, dtype=None):
+        table, rows = self.slices[key]
+        return table_frame(self.cells[rows], table, dtype)
+
+    def tables(self, dtype=None):
+        return {key: self.table(key, dtype) for key in self.slices}
+
+
+class YearTables:
+    """Tables of a report year, looked up by the name of their .csv file.
+
+    The year's partition of the store is read once, at the first lookup.
+    Tables the store does not hold, or every table if store is None, are
+    read from the .csv files of csv_path instead, so the cleaning scripts
+    work with or without the store. So are the tables whose .csv file was
+    rewritten or removed since it was imported, e.g. when a year is
+    extracted again without the store; the store is only trusted without
+    checking when csv_path does not exist.
+    """
+
+    def __init__(self, store, report, year, csv_path):
+        self.store = store
+        self.report = report
+        self.year = int(year)
+        self.csv_path = csv_path
+        self._stored = None
+
+    def _stored_year(self):
+        if self._stored is None:
+            if self.store is not None and self.store.has_year(self.report, self.year):
+                self._stored = self.store.open_year(self.report, self.year)
+            else:
+                self._stored = StoredYear({"tables": []}, None)
+        return self._stored
+
+    def _is_current(self, table, csv_file):
+        """Whether a stored table still matches its .csv file."""
+        if table.get("source") is None or not os.path.isdir(self.csv_path):
+            return True
+        return file_signature(csv_file) == table.get("source")
+
+    def read(self, file_name, dtype=None):
+        """The table of a .csv file name, as pd.read_csv(dtype=dtype) reads it."""
+        key = table_key(file_name)
+        csv_file = os.path.join(self.csv_path, file_name)
+        stored = self._stored_year()
+        if key in stored and self._is_current(stored.slices[key][0], csv_file):
+            return stored.table(key, dtype)
+        return pd.read_csv(csv_file, dtype=dtype)
+
+
+def open_store(root=TABLE_STORE_PATH):
+    """The table store, or None if pyarrow is not installed."""
+    return TableStore(root) if pa is not None else None
+
+
+def import_and_check(report, csv_root, years, store):
+    """Import the .csv folders of a report into the store and check the lookups.
+
+    Every stored table must equal pd.read_csv of its .csv file, with and
+    without dtype=str. Prints the time of loading each year from the .csv
+    files and from the store. Returns the number of mismatching tables.
+    """
+    folder_prefix = {"antenne": "antenne_amsterdam_", "national": "national_report_"}[report]
+    n_mismatches, csv_seconds, store_seconds, n_tables = 0, 0.0, 0.0, 0
+    for year in years:
+        folder = os.path.join(csv_root, f"{folder_prefix}{year}")
+        if not os.path.isdir(folder):
+            continue
+        store.import_csv_folder(report, year, folder, metadata={"imported_from": folder})
+        file_names = sorted(name for name in os.listdir(folder) if table_key(name))
+
+        for dtype in (None, str):
+            start_time = time.perf_counter()
+            from_csv = {
+                name: pd.read_csv(os.path.join(folder, name), dtype=dtype)
+                for name in file_names
+            }
+            csv_seconds += time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            tables = YearTables(store, report, year, folder)
+            from_store = {name: tables.read(name, dtype) for name in file_names}
+            store_seconds += time.perf_counter() - start_time
+
+            for name in file_names:
+                try:
+                    pd.testing.assert_frame_equal(from_csv[name], from_store[name])
+                except AssertionError as e:
+                    n_mismatches += 1
+                    print(f"Mismatch in {report}/{year}/{name} (dtype={dtype}): {e}")
+            n_tables += len(file_names)
+
+    if n_tables:
+        print(
+            f"{report}: {n_tables} table reads, .csv files {csv_seconds:.2f}s, "
+            f"store {store_seconds:.2f}s (x{csv_seconds / store_seconds:.1f}), "
+            f"{n_mismatches} mismatches"
+        )
+    return n_mismatches
+
+
+if __name__ == "__main__":
+    # Fill the store from the .csv folders of data/intermediate; run it
+    # from the root of the repository
+    store = TableStore(sys.argv[1] if len(sys.argv) > 1 else TABLE_STORE_PATH)
+    n_mismatches = sum(
+        import_and_check(report, f"./data/intermediate/{report}_reports_raw_csvs", years, store)
+        for report, years in [("antenne", range(2003, 2024)), ("national", range(1999, 2024))]
+    )
+    raise SystemExit(1 if n_mismatches else 0)
@@ -0,0 +1,181 @@
+# This script contains the month-partitioned store of the Telegraaf
+# keyword matches. Each crawled day is appended to the JSON Lines shard of
+# its month as soon as it is scraped, and the monthly and yearly
+# aggregates are computed incrementally from the shards.
+
+import os
+import json
+from datetime import datetime
+import pandas as pd
+
+
+class MatchStore:
+    '''Month-partitioned JSON Lines store of the daily keyword counts
+
+    Layout under `root`:
+        shards/YYYY-MM.jsonl       one line per day: date, url, n_links, counts
+        aggregates/YYYY-MM.csv     monthly aggregate of the shard
+
+    Every day is written with a single appended line, so the store doubles
+    as the crawl checkpoint: a day is finished once its line is present.
+    A truncated last line left by a crash is ignored when reading, and
+    cut before the next day is appended.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.shards_path = os.path.join(root, 'shards')
+        self.aggregates_path = os.path.join(root, 'aggregates')
+        os.makedirs(self.shards_path, exist_ok=True)
+        os.makedirs(self.aggregates_path, exist_ok=True)
+
+    def _shard(self, month):
+        return os.path.join(self.shards_path, f'{month}.jsonl')
+
+    def months(self):
+        '''Months with a shard, in chronological order'''
+        return sorted(
+            file_name[:-len('.jsonl')]
+            for file_name in os.listdir(self.shards_path)
+            if file_name.endswith('.jsonl')
+        )
+
+    def append(self, date, url, found_keywords, n_links):
+        '''Append the counts of a scraped day to its month's shard'''
+        line = json.dumps({
+            'date': date.date().isoformat(),
+            'url': url,
+            'n_links': n_links,
+            'counts': found_keywords,
+        })
+        shard_path = self._shard(date.strftime('%Y-%m'))
+        self._cut_truncated_line(shard_path)
+        with open(shard_path, 'a') as f:
+            f.write(line + '\n')
+
+    def _cut_truncated_line(self, shard_path):
+        '''Drop a last line left without its newline by a crash
+
+        Otherwise the next line would be appended onto it, and both days
+        would be skipped when reading.
+        '''
+        if not os.path.exists(shard_path):
+            return
+        with open(shard_path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == b'\n':
+                return
+            f.seek(0)
+            f.truncate(f.read().rfind(b'\n') + 1)
+
+    def read_month(self, month):
+        '''Yield the days stored in a month's shard'''
+        with open(self._shard(month), 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def month_days(self, month):
+        '''Days of a month in date order, keeping the last line of each day'''
+        days = {day['date']: day for day in self.read_month(month)}
+        return [days[date] for date in sorted(days)]
+
+    def finished_dates(self):
+        '''ISO dates already stored'''
+        return {day['date'] for month in self.months() for day in self.read_month(month)}
+
+    def read_results(self):
+        '''Results per ISO date, as [found_keywords, n_links]'''
+        return {
+            day['date']: [day['counts'], day['n_links']]
+            for month in self.months()
+            for day in self.read_month(month)
+        }
+
+    def month_matches(self, month):
+        '''Matches of a month as a DataFrame (one row per keyword and day)'''
+        rows = [
+            (day['date'], day['n_links'], keyword, count, day['url'])
+            for day in self.month_days(month)
+            for keyword, count in day['counts'].items()
+        ]
+        matches_df = pd.DataFrame(
+            rows, columns=['date', 'n_links', 'keyword', 'count', 'url']
+        )
+        matches_df['date'] = pd.to_datetime(matches_df['date'])
+        return matches_df
+
+    def monthly_aggregate(self, month):
+        '''Aggregate of a month, recomputed only if its shard changed'''
+        aggregate_path = os.path.join(self.aggregates_path, f'{month}.csv')
+        if (
+            os.path.exists(aggregate_path)
+            and os.path.getmtime(aggregate_path) >= os.path.getmtime(self._shard(month))
+        ):
+            return pd.read_csv(
+                aggregate_path,
+                dtype={'year_month': str, 'keyword': str},
+                keep_default_na=False
+            )
+
+        matches_df = self.month_matches(month)
+        matches_df['year_month'] = matches_df['date'].dt.to_period('M')
+        monthly_aggregated_df = matches_df.groupby(['year_month', 'keyword']).agg({
+            'count': 'sum',
+            'n_links': 'sum'
+        }).reset_index()
+
+        monthly_aggregated_df.to_csv(aggregate_path, index=False)
+        return monthly_aggregated_df.astype({'year_month': str})
+
+    def save_aggregates(self, results_path):
+        '''Save the monthly and yearly aggregates of all the stored months'''
+
+        monthly_aggregated_df = pd.concat(
+            [self.monthly_aggregate(month) for month in self.months()],
+            ignore_index=True
+        )
+
+        # Save the aggregated data to a CSV file
+        monthly_aggregated_df.to_csv(
+            results_path + 'telegraaf_monthly_aggregated.csv',
+            index=False
+        )
+
+        # The yearly aggregates are sums of the monthly ones
+        monthly_aggregated_df['year'] = monthly_aggregated_df['year_month'].str[:4].astype(int)
+        yearly_aggregated_df = monthly_aggregated_df.groupby(['year', 'keyword']).agg({
+            'count': 'sum',
+            'n_links': 'sum'
+        }).reset_index()
+
+        # Save the aggregated data to a CSV file
+        yearly_aggregated_df.to_csv(
+            results_path + 'telegraaf_yearly_aggregated.csv',
+            index=False
+        )
+
+    def export_matches(self, json_path):
+        '''Write all matches as one JSON list, streaming month by month'''
+        with open(json_path, 'w') as f:
+            f.write('[')
+            first = True
+            for month in self.months():
+                for day in self.month_days(month):
+                    date = datetime.fromisoformat(day['date'])
+                    for keyword, count in day['counts'].items():
+                        match = {
+                            'date': date,
+                            'n_links': day['n_links'],
+                            'keyword': keyword,
+                            'count': count,
+                            'url': day['url']
+                        }
+                        f.write(('' if first else ', ') + json.dumps(match, default=str))
+                        first = False
+            f.write(']')
@@ -0,0 +1,118 @@
+# This script contains the text-layer fast path of the table detection.
+# Born-digital reports carry their words and ruling lines in the PDF
+# itself, so their tables are located from the text and vector layer
+# without rendering the pages or running the transformer. Only pages
+# without a usable text layer (scans) go through the image path.
+
+import time
+import torch
+
+try:
+    import pdfplumber
+    from pdfplumber.utils import cluster_objects
+except ImportError:
+    pdfplumber = None
+
+# Ruled tables: cells are delimited by the drawn lines and rectangles
+LINES_SETTINGS = {
+    "vertical_strategy": "lines",
+    "horizontal_strategy": "lines",
+}
+
+
+def has_text_layer(page, min_chars=100):
+    """Whether a pdfplumber page has enough extractable text.
+
+    Scanned pages have no characters, and some broken fonts only map to
+    (cid:n) placeholders; neither is usable.
+    """
+    chars = page.chars
+    if len(chars) < min_chars:
+        return False
+    readable = sum(1 for char in chars if not char["text"].startswith("(cid:"))
+    return readable / len(chars) >= 0.9
+
+
+def borderless_tables(page, column_gap=12, min_rows=3, min_columns=3):
+    """Bounding boxes of the tables whose cells are only aligned words.
+
+    Words are grouped in text lines, and a line is a table row when gaps
+    of at least column_gap points split it in min_columns cells or more;
+    word spacing in prose stays far below that. Runs of at least min_rows
+    consecutive table rows form a table.
+    """
+    lines = cluster_objects(page.extract_words(), "top", tolerance=3)
+
+    tables, run = [], []
+    for line in lines + [[]]:
+        line = sorted(line, key=lambda word: word["x0"])
+        gaps = [right["x0"] - left["x1"] for left, right in zip(line, line[1:])]
+        if line and 1 + sum(gap >= column_gap for gap in gaps) >= min_columns:
+            run += line
+            continue
+        if len({round(word["top"]) for word in run}) >= min_rows:
+            tables.append((
+                min(word["x0"] for word in run),
+                min(word["top"] for word in run),
+                max(word["x1"] for word in run),
+                max(word["bottom"] for word in run),
+            ))
+        run = []
+
+    return tables
+
+
+def find_page_tables(page, min_rows=2, min_columns=2):
+    """Bounding boxes (x0, top, x1, bottom), in PDF points, of the tables.
+
+    Ruled tables are located from the drawn lines and rectangles. On pages
+    without any, tables are located from the word alignment. Tables are
+    returned from top to bottom.
+    """
+    tables = [
+        table.bbox for table in page.find_tables(LINES_SETTINGS)
+        if len(table.rows) >= min_rows and len(table.columns) >= min_columns
+    ]
+    if not tables:
+        tables = borderless_tables(page)
+    return sorted(tables, key=lambda bbox: (bbox[1], bbox[0]))
+
+
+def text_layer_detections(pdf_path, pages, min_chars=100):
+    """Locate the tables of the listed pages from the PDF's text layer.
+
+    Returns the detections of the pages with a usable text layer, in the
+    format of the detections file (boxes in PDF points, i.e. at 72 dpi,
+    with a score of 1 and the table label), and the pages that have to go
+    through the image path.
+    """
+    if pdfplumber is None:
+        raise ImportError("The text-layer engine needs pdfplumber")
+
+    detections, image_pages = {}, []
+    start_time = time.perf_counter()
+
+    with pdfplumber.open(pdf_path) as pdf:
+        for page_num in pages:
+            page = pdf.pages[page_num - 1]
+            if not has_text_layer(page, min_chars):
+                image_pages.append(page_num)
+                continue
+
+            bboxes = find_page_tables(page)
+            detections[page_num] = {
+                "scores": torch.ones(len(bboxes)),
+                "labels": torch.zeros(len(bboxes), dtype=torch.int64),
+                "boxes": torch.tensor(bboxes, dtype=torch.float32).reshape(-1, 4),
+                "dpi": 72,
+            }
+            # Release the parsed objects of the page
+            page.close()
+
+    print(
+        f"Text layer: {len(detections)} of {len(pages)} pages in "
+        f"{time.perf_counter() - start_time:.1f}s, "
+        f"{sum(len(page['boxes']) for page in detections.values())} tables; "
+        f"{len(image_pages)} pages left for the image path"
+    )
+    return detections, image_pages
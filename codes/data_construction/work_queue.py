@@ -0,0 +1,349 @@
+# This script contains the shared work queue of the sharded pipeline
+# mode. (report, year, stage) jobs are stored in an SQLite file on shared
+# storage, and any number of worker processes, on one or several
+# machines, lease the jobs whose dependencies are done, keep their lease
+# alive with heartbeats and record the result. Jobs whose worker stopped
+# heartbeating are leased again once their lease expires.
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import threading
+
+# Job states
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+
+def worker_name():
+    """Identify a worker process across machines."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """Jobs with dependencies, leased to workers through an SQLite file.
+
+    A leased job belongs to its worker until `lease_seconds` after the
+    last heartbeat. A job that fails, or whose lease expires, goes back to
+    pending until it has been tried `max_attempts` times, and is then
+    failed along with the jobs depending on it. Claims run in an immediate
+    transaction, so two workers never lease the same job. The default
+    rollback journal is kept, since WAL does not work on network storage.
+    """
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # The heartbeat thread shares the connection, behind the lock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "name TEXT PRIMARY KEY, payload TEXT, deps TEXT, state TEXT, "
+            "attempts INTEGER, worker TEXT, lease_expires REAL, "
+            "signature TEXT, seconds REAL, error TEXT, updated REAL)"
+        )
+
+    def __getstate__(self):
+        return {
+            "path": self.path,
+            "lease_seconds": self.lease_seconds,
+            "max_attempts": self.max_attempts,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _transaction(self, function, *args):
+        """Run function(*args) in an immediate (write-locked) transaction."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(*args)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    def enqueue(self, jobs):
+        """Add or reset (name, payload, deps) jobs as pending.
+
+        Jobs currently leased by a live worker are left alone. Returns the
+        number of jobs queued.
+        """
+        def add():
+            n_queued, now = 0, time.time()
+            for name, payload, deps in jobs:
+                row = self._db.execute(
+                    "SELECT state, lease_expires FROM jobs WHERE name = ?", (name,)
+                ).fetchone()
+                if row is not None and row[0] == LEASED and row[1] > now:
+                    continue
+                self._db.execute(
+                    "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, 0, NULL, NULL, NULL, NULL, NULL, ?)",
+                    (name, json.dumps(payload), json.dumps(list(deps)), PENDING, now),
+                )
+                n_queued += 1
+            return n_queued
+
+        return self._transaction(add)
+
+    def _expire_and_propagate(self, now):
+        """Requeue expired leases and fail the jobs that cannot run anymore."""
+        expired = self._db.execute(
+            "SELECT name, attempts, worker FROM jobs WHERE state = ? AND lease_expires < ?",
+            (LEASED, now),
+        ).fetchall()
+        for name, attempts, worker in expired:
+            state = FAILED if attempts >= self.max_attempts else PENDING
+            self._db.execute(
+                "UPDATE jobs SET state = ?, worker = NULL, error = ?, updated = ? WHERE name = ?",
+                (state, f"Lease of {worker} expired", now, name),
+            )
+
+        # Failures propagate to every job downstream
+        states = dict(self._db.execute("SELECT name, state FROM jobs"))
+        changed = True
+        while changed:
+            changed = False
+            for name, deps in self._db.execute(
+                    "SELECT name, deps FROM jobs WHERE state = ?", (PENDING,)).fetchall():
+                failed_deps = [dep for dep in json.loads(deps) if states.get(dep) == FAILED]
+                if failed_deps and states[name] == PENDING:
+                    self._db.execute(
+                        "UPDATE jobs SET state = ?, error = ?, updated = ? WHERE name = ?",
+                        (FAILED, f"Upstream job {failed_deps[0]} failed", now, name),
+                    )
+                    states[name] = FAILED
+                    changed = True
+        return states
+
+    def claim(self, worker):
+        """Lease the next pending job whose dependencies are done.
+
+        Returns a dict with the job's name, payload and attempt number, or
+        None if no job can run now.
+        """
+        def lease():
+            now = time.time()
+            states = self._expire_and_propagate(now)
+            for name, payload, deps, attempts in self._db.execute(
+                    "SELECT name, payload, deps, attempts FROM jobs "
+                    "WHERE state = ? ORDER BY rowid", (PENDING,)).fetchall():
+                # Dependencies that were never queued are up to date
+                if all(states.get(dep, DONE) == DONE for dep in json.loads(deps)):
+                    self._db.execute(
+                        "UPDATE jobs SET state = ?, attempts = ?, worker = ?, "
+                        "lease_expires = ?, updated = ? WHERE name = ?",
+                        (LEASED, attempts + 1, worker, now + self.lease_seconds, now, name),
+                    )
+                    return {"name": name, "payload": json.loads(payload), "attempt": attempts + 1}
+            return None
+
+        return self._transaction(lease)
+
+    def heartbeat(self, name, worker):
+        """Extend a lease. Returns False if the worker no longer holds it."""
+        def extend():
+            now = time.time()
+            return self._db.execute(
+                "UPDATE jobs SET lease_expires = ?, updated = ? "
+                "WHERE name = ? AND worker = ? AND state = ?",
+                (now + self.lease_seconds, now, name, worker, LEASED),
+            ).rowcount == 1
+
+        return self._transaction(extend)
+
+    def finish(self, name, worker, errors=(), signature=None, seconds=None):
+        """Record the result of a leased job.
+
+        A failed job goes back to pending while it has attempts left.
+        Returns False if the lease was lost, in which case nothing is
+        recorded.
+        """
+        def record():
+            row = self._db.execute(
+                "SELECT attempts FROM jobs WHERE name = ? AND worker = ? AND state = ?",
+                (name, worker, LEASED),
+            ).fetchone()
+            if row is None:
+                return False
+
+            if not errors:
+                state = DONE
+            else:
+                state = FAILED if row[0] >= self.max_attempts else PENDING
+            self._db.execute(
+                "UPDATE jobs SET state = ?, worker = NULL, lease_expires = NULL, "
+                "signature = ?, seconds = ?, error = ?, updated = ? WHERE name = ?",
+                (
+                    state, signature, seconds,
+                    "\n".join(errors) if errors else None, time.time(), name,
+                ),
+            )
+            return True
+
+        return self._transaction(record)
+
+    def counts(self):
+        """Number of jobs in each state."""
+        with self._lock:
+            return dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    def jobs(self, state=None):
+        """Rows of the jobs, optionally only those in a state."""
+        query = "SELECT name, state, attempts, worker, signature, seconds, error, updated FROM jobs"
+        params = ()
+        if state is not None:
+            query, params = query + " WHERE state = ?", (state,)
+        with self._lock:
+            return [
+                dict(zip(
+                    ("name", "state", "attempts", "worker", "signature", "seconds", "error", "updated"),
+                    row,
+                ))
+                for row in self._db.execute(query + " ORDER BY rowid", params)
+            ]
+
+    def status(self):
+        """Print the job counts and the errors of the failed jobs."""
+        counts = self.counts()
+        print(
+            f"Work queue {self.path}: "
+            + ", ".join(f"{counts.get(state, 0)} {state}" for state in (PENDING, LEASED, DONE, FAILED))
+        )
+        for job in self.jobs(FAILED):
+            print(f"  {job['name']} (attempt {job['attempts']}): {job['error']}")
+
+    def close(self):
+        self._db.close()
+
+
+class Heartbeat:
+    """Context manager extending a job's lease in a background thread."""
+
+    def __init__(self, work_queue, name, worker, interval):
+        self.work_queue = work_queue
+        self.name = name
+        self.worker = worker
+        self.interval = interval
+        self.lost = False
+
+    def _beat(self):
+        while not self._done.wait(self.interval):
+            if not self.work_queue.heartbeat(self.name, self.worker):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+
+
+def drain(work_queue, run_job, worker=None, poll_seconds=5.0):
+    """Run the queue's jobs until none is pending or leased.
+
+    run_job(job) runs a claimed job and returns its errors and, optionally,
+    its input signature as (errors, signature). While it runs, the lease
+    is renewed every third of the lease time. Returns the number of jobs
+    this worker completed.
+    """
+    worker = worker or worker_name()
+    n_done = 0
+
+    while True:
+        job = work_queue.claim(worker)
+        if job is None:
+            counts = work_queue.counts()
+            if not counts.get(PENDING) and not counts.get(LEASED):
+                break
+            # Wait for the jobs of other workers to unlock more work
+            time.sleep(poll_seconds)
+            continue
+
+        print(f"[{worker}] Running {job['name']} (attempt {job['attempt']})...")
+        start_time = time.perf_counter()
+        with Heartbeat(work_queue, job["name"], worker, work_queue.lease_seconds / 3) as beat:
+            try:
+                errors, signature = run_job(job)
+            except Exception as e:
+                errors, signature = [f"{type(e).__name__}: {e}"], None
+
+        seconds = round(time.perf_counter() - start_time, 2)
+        if beat.lost or not work_queue.finish(job["name"], worker, errors, signature, seconds):
+            print(f"[{worker}] Lost the lease of {job['name']}; its result is not recorded")
+        elif errors:
+            print(f"[{worker}] {job['name']} failed: {errors[0]}")
+        else:
+            n_done += 1
+
+    print(f"[{worker}] Queue drained, {n_done} jobs done")
+    return n_done
+
+
+def demo_job(job):
+    """Job of the demo: sleep, and crash the process on a first attempt if asked."""
+    payload = job["payload"]
+    if payload.get("crash") and job["attempt"] == 1:
+        # Simulate a machine dying mid-job: no result, no more heartbeats
+        os._exit(1)
+    time.sleep(payload["seconds"])
+    return [], None
+
+
+def demo_worker(queue_path):
+    drain(WorkQueue(queue_path, lease_seconds=2), demo_job, poll_seconds=0.2)
+
+
+def demo(n_workers=4, n_years=12):
+    """Drain a queue of sleeping jobs with several local worker processes.
+
+    One job crashes its worker on the first attempt, so its lease expires
+    and another worker runs it again.
+    """
+    import tempfile
+    import multiprocessing
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue_path = os.path.join(tmp_dir, "work_queue.sqlite")
+        work_queue = WorkQueue(queue_path, lease_seconds=2)
+        jobs = []
+        for year in range(2003, 2003 + n_years):
+            jobs.append((f"demo/{year}/tensors", {"seconds": 0.5, "crash": year == 2005}, []))
+            jobs.append((f"demo/{year}/csv", {"seconds": 0.2}, [f"demo/{year}/tensors"]))
+        work_queue.enqueue(jobs)
+
+        start_time = time.perf_counter()
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=demo_worker, args=(queue_path,))
+            for _ in range(n_workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        # The crashed worker is replaced here, to drain what it left
+        drain(work_queue, demo_job, poll_seconds=0.2)
+        print(f"Drained {len(jobs)} jobs with {n_workers} workers in {time.perf_counter() - start_time:.1f}s")
+        work_queue.status()
+        work_queue.close()
+
+
+if __name__ == "__main__":
+    demo(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,71 @@
+# This script measures how the year-parallel pipeline runner scales with
+# the number of worker processes. Every (report, year) task runs the same
+# fixed amount of torch work, standing in for the detection of a year's
+# pages, so the speed-up only reflects the pool and the thread split.
+
+import os
+import sys
+import time
+import tempfile
+from functools import partial
+from data_construction.pipeline_runner import Task, PipelineRunner, WorkerResource
+
+
+def synthetic_weights(size=512):
+    """Stand-in for the detection model, loaded once per worker."""
+    import torch
+
+    return torch.randn(size, size)
+
+
+def synthetic_year(weights, output_path, n_batches=40):
+    """Run the fixed torch work of a year and write its output."""
+    import torch
+
+    activations = torch.randn(64, weights().shape[0])
+    for _ in range(n_batches):
+        activations = torch.tanh(activations @ weights())
+    torch.save(activations.sum(), output_path)
+
+
+def time_workers(n_tasks, max_workers, n_batches=40):
+    """Seconds the runner takes for n_tasks year tasks with max_workers."""
+    weights = WorkerResource("synthetic-weights", synthetic_weights)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        runner = PipelineRunner(
+            os.path.join(tmp_dir, "manifest.json"), max_workers=max_workers
+        )
+        for year in range(n_tasks):
+            output_path = os.path.join(tmp_dir, f"{year}.pt")
+            runner.add(Task(
+                f"synthetic/{year}",
+                partial(synthetic_year, weights, output_path, n_batches),
+                outputs=[output_path],
+            ))
+
+        start_time = time.perf_counter()
+        runner.run()
+        return time.perf_counter() - start_time
+
+
+def benchmark_workers(worker_counts=(1, 4, 16, 32), n_tasks=64, n_batches=40):
+    """Print the wall time and speed-up at each number of workers."""
+    print(f"{os.cpu_count()} cores, {n_tasks} year tasks")
+
+    results = {}
+    for max_workers in worker_counts:
+        results[max_workers] = time_workers(n_tasks, max_workers, n_batches)
+
+    baseline = results[worker_counts[0]]
+    for max_workers, seconds in results.items():
+        print(
+            f"{max_workers:>3} workers: {seconds:.1f}s, "
+            f"{n_tasks / seconds:.2f} tasks/sec, speed-up x{baseline / seconds:.2f}"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    worker_counts = tuple(int(n) for n in sys.argv[1:]) or (1, 4, 16, 32)
+    benchmark_workers(worker_counts)
@@ -0,0 +1,132 @@
+# This script times yearly_incidents on synthetic long panels of the
+# national incidents: the former row-by-row construction of the SEH rows
+# with one grouped diff per count, the vectorized version, and its
+# incremental mode appending the last year to an earlier output. All
+# three are checked to give the same rows. Run it from the root of the
+# repository (python -m codes.data_construction.yearly_incidents_benchmark).
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+from codes.data_construction.national_reports_cleaning_utils import yearly_incidents
+
+ORIGINS = [
+    'Ziekenhuizen', 'SEH-LIS-ziekenhuizen', 'EHB', 'Ambulances',
+    'Politieartsen', 'Totaal'
+]
+
+ORIGIN_MAPPING = {
+    'Ziekenhuizen': 'SEH-MDI-ziekenhuizen',
+    'EHB': 'EHBO-posten',
+    'Politieartsen': 'Politieartsen/Forensisch artsen',
+}
+
+
+def yearly_incidents_by_row(df, dict):
+    '''Former yearly_incidents, building the SEH rows one at a time'''
+
+    df['incidents'] = df['incidents'].str.replace('.', '', regex=False)
+
+    cols_to_convert = df.columns.difference(['drug', 'origin'])
+    df.loc[:, cols_to_convert] = df[cols_to_convert].apply(pd.to_numeric, errors='coerce')
+
+    df = df.loc[df['year'] >= 2011].copy()
+
+    df.loc[:, 'origin'] = df['origin'].replace(dict)
+
+    seh_origins = ['SEH-MDI-ziekenhuizen', 'SEH-LIS-ziekenhuizen']
+    grouped = df[df['origin'].isin(seh_origins)].groupby(['year', 'drug'])['incidents'].sum().reset_index()
+
+    new_rows = []
+    for _, row in grouped.iterrows():
+        new_row = {col: (row['incidents'] if col == 'incidents' else row[col] if col in ['year', 'drug'] else float('NaN')) for col in df.columns}
+        new_row['origin'] = 'SEH-MDI+LIS-ziekenhuizen'
+        new_rows.append(new_row)
+    df = pd.concat([df, pd.DataFrame(new_rows)], ignore_index=True)
+
+    df = df.sort_values(by=['drug', 'origin', 'year'])
+    grouped = df.groupby(['drug', 'origin'])
+    df['incidents_diff'] = grouped['incidents'].diff()
+
+    for severity in ['light', 'moderate', 'severe']:
+        df.loc[:, f'{severity}_incidents'] = (
+            df['incidents'] * df[f'DOG_{severity}_pcnt'] * 0.01
+        )
+        df.loc[:, f'{severity}_incidents_diff'] = grouped[f'{severity}_incidents'].diff()
+
+    mask = df["year"] >= 2018
+    df.loc[:,'incidents_diff'] = df['incidents'].mask(mask, df['incidents'])
+
+    for severity in ['light', 'moderate', 'severe']:
+        df.loc[:, f'{severity}_incidents'] = (
+            df[f'{severity}_incidents_diff'].mask(mask, df[f'{severity}_incidents'])
+        )
+
+    return df.drop(columns=[col for col in df.columns if col.startswith('DOG_')])
+
+
+def incidents_panel(n_drugs, years=range(2009, 2023), seed=0):
+    '''Raw incidents of n_drugs drugs, as strings like the extracted tables'''
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product(
+        [[str(year) for year in years], [f'drug_{i}' for i in range(n_drugs)], ORIGINS],
+        names=['year', 'drug', 'origin']
+    )
+    n_rows = len(index)
+    incidents = rng.integers(10, 5000, n_rows)
+
+    df = index.to_frame(index=False)
+    df['incidents'] = [
+        f'{n // 1000}.{n % 1000:03d}' if n >= 1000 else str(n) for n in incidents
+    ]
+    for column, high in [('light', 60), ('moderate', 40), ('severe', 20)]:
+        df[f'DOG_{column}_pcnt'] = rng.integers(0, high, n_rows).astype(str)
+    df['median_age'] = rng.integers(18, 40, n_rows).astype(str)
+
+    # Some origins are missing in some years
+    return df.loc[rng.random(n_rows) > 0.1].reset_index(drop=True)
+
+
+def same_rows(a, b):
+    '''Whether two outputs hold the same rows, whatever their order'''
+    key = ['drug', 'origin', 'year']
+    pd.testing.assert_frame_equal(
+        a.sort_values(key).reset_index(drop=True),
+        b.sort_values(key).reset_index(drop=True),
+        check_dtype=False
+    )
+
+
+def time_panel(n_drugs):
+    '''Time the three versions on a panel of n_drugs drugs'''
+    df = incidents_panel(n_drugs)
+    last_year = df['year'].max()
+
+    start_time = time.perf_counter()
+    by_row = yearly_incidents_by_row(df.copy(), ORIGIN_MAPPING)
+    by_row_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    vectorized = yearly_incidents(df.copy(), ORIGIN_MAPPING)
+    vectorized_seconds = time.perf_counter() - start_time
+
+    # Output of the previous run, without the last year
+    previous = yearly_incidents(df.loc[df['year'] != last_year].copy(), ORIGIN_MAPPING)
+    start_time = time.perf_counter()
+    incremental = yearly_incidents(df.copy(), ORIGIN_MAPPING, previous=previous)
+    incremental_seconds = time.perf_counter() - start_time
+
+    pd.testing.assert_frame_equal(by_row, vectorized)
+    same_rows(vectorized, incremental)
+
+    print(
+        f"{len(df)} rows ({n_drugs} drugs): row-wise {by_row_seconds:.3f}s, "
+        f"vectorized {vectorized_seconds:.3f}s (x{by_row_seconds / vectorized_seconds:.1f}), "
+        f"incremental {incremental_seconds:.3f}s (x{by_row_seconds / incremental_seconds:.1f})"
+    )
+
+
+if __name__ == '__main__':
+    for n_drugs in [int(arg) for arg in sys.argv[1:]] or [4, 40, 400, 4000]:
+        time_panel(n_drugs)
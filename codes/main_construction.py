@@ -1,33 +1,350 @@
-
+import sys
+import time
 import json
-from transformers import AutoImageProcessor, TableTransformerForObjectDetection
+import argparse
+from functools import partial
 from data_construction.antenne_reports_utils import (
     read_link,
+    get_year_paths,
+    DETECT_DPI,
+    DETECTOR_CHECKPOINT,
+    DETECTIONS_FILE,
     download_reports,
     rename_pdf_files,
     report_tables_to_png,
     obtain_the_tensors,
     report_tables_to_csv,
+    render_and_detect,
+    text_layer_and_detect,
+)
+from data_construction.artifact_cache import ArtifactCache
+from data_construction.detection_worker import DetectionClient, serve_detector
+from data_construction.page_prefilter import PagePrefilter
+from data_construction.streaming_pipeline import StreamingPipeline
+from data_construction.table_store import open_store, TABLE_STORE_PATH
+from data_construction.work_queue import WorkQueue, drain, DONE
+from data_construction.pipeline_runner import (
+    Task,
+    PipelineRunner,
+    WorkerResource,
+    run_collecting_errors,
+    parse_years,
 )
 
+# Stages of the pipeline, in order
+STAGES = ["download", "png", "tensors", "csv"]
 
-# Main function
-def main():
+# Years covered by each report, per stage
+REPORT_YEARS = {
+    "antenne": {
+        "png": range(2003, 2024),
+        "tensors": range(2003, 2024),
+        "csv": range(2003, 2024),
+    },
+    "national": {
+        "png": range(1999, 2024),
+        "tensors": range(1999, 2024),
+        "csv": range(2003, 2024),
+    },
+}
 
-    # Load the paths
-    antenne_reps_path = r"./data/source/antenne_reports"
-    national_reps_path = r"./data/source/national_drug_monitor"
 
-    # Load the links
-    antenne_reps_link = read_link(antenne_reps_path + "/original_link.txt")
-    national_reps_link = read_link(national_reps_path + "/original_link.txt")
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build the intermediate report datasets incrementally."
+    )
+    parser.add_argument(
+        "--years", nargs="+", default=None,
+        help="Years to process, e.g. 2017 or 2003-2010 (default: all)"
+    )
+    parser.add_argument(
+        "--stages", nargs="+", choices=STAGES, default=STAGES,
+        help="Stages to run (default: all)"
+    )
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Rerun the selected tasks even if they are up to date"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.9,
+        help="Confidence threshold of the detected tables, applied at extraction"
+    )
+    parser.add_argument(
+        "--prefilter", type=float, default=None, metavar="MIN_SCORE",
+        help="Skip detection on pages whose table score is below MIN_SCORE, e.g. 0.25"
+    )
+    parser.add_argument(
+        "--backend", choices=["torch", "onnx", "int8"], default="torch",
+        help="Inference backend of the table detector"
+    )
+    parser.add_argument(
+        "--detector-url", default=None,
+        help="Send the pages to a running detection worker, e.g. http://127.0.0.1:8765"
+    )
+    parser.add_argument(
+        "--serve-detector", action="store_true",
+        help="Load the detector once and serve it as a detection worker"
+    )
+    parser.add_argument(
+        "--port", type=int, default=8765,
+        help="Port of the detection worker started with --serve-detector"
+    )
+    parser.add_argument(
+        "--dpi", default="200",
+        help="Rendering resolution of the pages, or 'detect' to render each page "
+             "at the detector's input resolution, from its size (default: 200)"
+    )
+    parser.add_argument(
+        "--renderer", choices=["pdf2image", "pdfium"], default="pdf2image",
+        help="Rasterize the pages with poppler (pdf2image) or in-process with PDFium"
+    )
+    parser.add_argument(
+        "--engine", choices=["image", "text"], default="image",
+        help="Locate the tables from rendered pages, or from the PDF text layer "
+             "with the image path only for scanned pages"
+    )
+    parser.add_argument(
+        "--fused", action="store_true",
+        help="Render and detect in one pass, without writing the PNGs"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Number of worker processes running the year tasks in parallel"
+    )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="Stream the pages from rendering to detection to extraction"
+    )
+    parser.add_argument(
+        "--render-workers", type=int, default=2,
+        help="Rendering threads of the streaming mode"
+    )
+    parser.add_argument(
+        "--detect-workers", type=int, default=1,
+        help="Detection threads of the streaming mode"
+    )
+    parser.add_argument(
+        "--extract-workers", type=int, default=2,
+        help="Extraction threads of the streaming mode"
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=16,
+        help="Capacity of the queues between the streaming stages"
+    )
+    parser.add_argument(
+        "--shard", choices=["enqueue", "work", "status"], default=None,
+        help="Sharded mode: queue the stale tasks, drain the queue as a "
+             "worker, or show its status"
+    )
+    parser.add_argument(
+        "--queue", default="./data/intermediate/work_queue.sqlite",
+        help="Path of the shared work queue of the sharded mode"
+    )
+    parser.add_argument(
+        "--lease", type=float, default=300,
+        help="Seconds a sharded job stays leased without a heartbeat"
+    )
+    parser.add_argument(
+        "--table-store", default=TABLE_STORE_PATH,
+        help="Root of the Parquet store the csv stage also writes the tables to "
+             "(needs pyarrow)"
+    )
+    parser.add_argument(
+        "--manifest", default="./data/intermediate/pipeline_manifest.json",
+        help="Path of the manifest recording completed tasks"
+    )
+    return parser.parse_args(argv)
+
+
+def load_detector(backend="torch"):
+    """Load the table-transformer image processor and model.
+
+    With backend="onnx" the model is exported once to ONNX (cached under
+    ./data/intermediate/onnx_models), checked against the PyTorch model
+    (see checked_onnx_detector) and run with ONNX Runtime. With
+    backend="int8" its linear layers are quantized dynamically to int8
+    (cached under ./data/intermediate/quantized_models).
+    """
+    from transformers import AutoImageProcessor, TableTransformerForObjectDetection
+
+    image_processor = AutoImageProcessor.from_pretrained(DETECTOR_CHECKPOINT)
+    model = TableTransformerForObjectDetection.from_pretrained(DETECTOR_CHECKPOINT)
+
+    if backend == "onnx":
+        from data_construction.onnx_detector import checked_onnx_detector
+        model = checked_onnx_detector(
+            image_processor, model, "./data/intermediate/onnx_models"
+        )
+    elif backend == "int8":
+        from data_construction.quantized_detector import quantize_detector
+        model = quantize_detector(model, "./data/intermediate/quantized_models")
+
+    return image_processor, model
+
+
+def download_report(source_path, report):
+    """Download the PDF files of a report."""
+    download_reports(read_link(source_path + "/original_link.txt"), source_path)
+    if report == "national":
+        # Rename the PDF files (National reports)
+        rename_pdf_files(source_path)
+
+
+def build_tasks(
+        runner,
+        reports,
+        years,
+        stages,
+        cache,
+        fused=False,
+        backend="torch",
+        client=None,
+        threshold=0.9,
+        prefilter=None,
+        engine="image",
+        dpi=200,
+        renderer="pdf2image",
+        store=None
+        ):
+    """Add a task per (report, year, stage) to the runner.
+
+    With fused=True the png and tensors stages of a year run as a single
+    detect task that hands the rendered pages straight to the model. With a
+    DetectionClient the tensors tasks use the running detection worker
+    instead of loading the model. The detection tasks keep every candidate
+    box, so only the csv tasks depend on the confidence threshold. With a
+    prefilter minimum score the tensors tasks skip the model on pages that
+    hold no table. With engine="text" each year runs a single detect task
+    that locates the tables from the PDF text layer and only renders and
+    detects the scanned pages. Pages are rendered at `dpi`, or each at its
+    own dpi with DETECT_DPI; the boxes record it, so they are converted
+    back to PDF points at the right scale.
+    renderer selects the rasterizer of every rendering task. With a
+    TableStore the csv tasks also write the tables of their year to it.
+    The actions are picklable, so the runner can run them in worker
+    processes.
+    """
+
+    # Scale of the boxes detected before their dpi was recorded (200 dpi)
+    res_cons = 72 / 200
+
+    # The model is only loaded if a detection task has to run, once per process
+    detector = WorkerResource(f"detector-{backend}", partial(load_detector, backend))
+    # With a detection worker the tensors tasks never load it
+    tensors_detector = (
+        {"detector": detector} if client is None
+        else {"image_processor": None, "model": None}
+    )
+
+    for report, settings in reports.items():
+        source_path = settings["source_path"]
+        tables_dict = settings["tables_dict"]
+
+        if "download" in stages:
+            runner.add(Task(
+                f"{report}/download",
+                partial(download_report, source_path, report),
+                inputs=[source_path + "/original_link.txt"],
+                outputs=[
+                    get_year_paths(report, year)["pdf"]
+                    for year in REPORT_YEARS[report]["png"]
+                    if str(year) in tables_dict and (years is None or year in years)
+                ],
+            ))
+
+        for year in REPORT_YEARS[report]["png"]:
+            if str(year) not in tables_dict or (years is not None and year not in years):
+                continue
+
+            year_paths = get_year_paths(report, year)
+            pages = tables_dict[str(year)]
+            png_files = [f"{year_paths['img']}/{page}.png" for page in pages]
+            detections_file = f"{year_paths['tens']}/{DETECTIONS_FILE}"
+
+            if engine == "text" and ("png" in stages or "tensors" in stages):
+                runner.add(Task(
+                    f"{report}/{year}/detect",
+                    partial(
+                        run_collecting_errors, text_layer_and_detect,
+                        tables_dict, detector, report, year, year + 1,
+                        dpi=dpi, renderer=renderer
+                    ),
+                    inputs=[year_paths["pdf"]],
+                    outputs=[detections_file],
+                    params={"pages": pages, "engine": engine, "dpi": dpi, "backend": backend},
+                    deps=[f"{report}/download"],
+                ))
+
+            elif fused and ("png" in stages or "tensors" in stages):
+                runner.add(Task(
+                    f"{report}/{year}/detect",
+                    partial(
+                        run_collecting_errors, render_and_detect, tables_dict,
+                        detector=detector, report=report, init_year=year, end_year=year + 1,
+                        dpi=dpi, renderer=renderer
+                    ),
+                    inputs=[year_paths["pdf"]],
+                    outputs=[detections_file],
+                    params={"pages": pages, "dpi": dpi, "backend": backend},
+                    deps=[f"{report}/download"],
+                ))
+
+            detect_task = fused or engine == "text"
+
+            if "png" in stages and not detect_task:
+                runner.add(Task(
+                    f"{report}/{year}/png",
+                    partial(
+                        run_collecting_errors, report_tables_to_png,
+                        tables_dict, report, year, year + 1,
+                        dpi=dpi, cache=cache, renderer=renderer
+                    ),
+                    inputs=[year_paths["pdf"]],
+                    outputs=png_files,
+                    params={"pages": pages, "dpi": dpi},
+                    deps=[f"{report}/download"],
+                ))
+
+            if "tensors" in stages and not detect_task:
+                runner.add(Task(
+                    f"{report}/{year}/tensors",
+                    partial(
+                        run_collecting_errors, obtain_the_tensors,
+                        **tensors_detector,
+                        report=report, init_year=year, end_year=year + 1,
+                        cache=cache, client=client,
+                        prefilter=PagePrefilter(prefilter) if prefilter is not None else None
+                    ),
+                    inputs=png_files,
+                    outputs=[detections_file],
+                    params={
+                        "backend": backend if client is None else client.revision,
+                        "prefilter": prefilter,
+                    },
+                    deps=[f"{report}/{year}/png"],
+                ))
 
-    # Download the reports
-    download_reports(antenne_reps_link, antenne_reps_path)
-    download_reports(national_reps_link, national_reps_path)
+            if "csv" in stages and year in REPORT_YEARS[report]["csv"]:
+                runner.add(Task(
+                    f"{report}/{year}/csv",
+                    partial(
+                        run_collecting_errors, report_tables_to_csv,
+                        res_cons, report, year, year + 1,
+                        threshold=threshold, cache=cache, store=store
+                    ),
+                    inputs=[year_paths["pdf"], detections_file],
+                    outputs=[year_paths["csv"]] + (
+                        [store.data_path(report, year)] if store is not None else []
+                    ),
+                    params={"res_cons": res_cons, "threshold": threshold},
+                    deps=[f"{report}/{year}/detect" if detect_task else f"{report}/{year}/tensors"],
+                ))
 
-    # Rename the PDF files (National reports)
-    rename_pdf_files(national_reps_path)
+
+def load_reports():
+    """Source folder and table pages of each report."""
+    antenne_reps_path = r"./data/source/antenne_reports"
+    national_reps_path = r"./data/source/national_drug_monitor"
 
     # Load the tables dictionary (Antenne reports)
     with open(antenne_reps_path + "/tables_dict.json", "r") as f:
@@ -37,60 +354,150 @@ def main():
     with open(national_reps_path + "/incidents_dict.json", "r") as f:
         national_dict = json.load(f)
 
-    # Convert report tables to PNG
-    report_tables_to_png(
-        antenne_dict,
-        "antenne",
-        init_year=2003,
-        end_year=2024
-    )
+    return {
+        "antenne": {"source_path": antenne_reps_path, "tables_dict": antenne_dict},
+        "national": {"source_path": national_reps_path, "tables_dict": national_dict},
+    }
 
-    report_tables_to_png(
-        national_dict,
-        "national",
-        init_year=1999,
-        end_year=2024
-    )
 
-    # Initialize the image processor and model
-    image_processor = AutoImageProcessor.from_pretrained(
-        "microsoft/table-transformer-detection"
+def runner_from_args(args, reports, cache):
+    """PipelineRunner holding the tasks selected on the command line."""
+    years = parse_years(args.years) if args.years else None
+    runner = PipelineRunner(
+        args.manifest, force=args.force, max_workers=args.workers, cache=cache
     )
-    model = TableTransformerForObjectDetection.from_pretrained(
-        "microsoft/table-transformer-detection"
+    client = DetectionClient(args.detector_url) if args.detector_url else None
+    build_tasks(
+        runner, reports, years, args.stages, cache,
+        fused=args.fused, backend=args.backend, client=client,
+        threshold=args.threshold, prefilter=args.prefilter, engine=args.engine,
+        dpi=DETECT_DPI if args.dpi == "detect" else int(args.dpi),
+        renderer=args.renderer, store=open_store(args.table_store)
     )
+    return runner
 
-    # Obtain the tensors
-    obtain_the_tensors(
-        image_processor,
-        model,
-        "antenne",
-        init_year=2003,
-        end_year=2024
-    )
 
-    obtain_the_tensors(
-        image_processor,
-        model,
-        "national",
-        init_year=1999,
-        end_year=2024
-    )
+def merge_done_jobs(work_queue, runner):
+    """Record the jobs completed by the sharded workers in the manifest."""
+    for job in work_queue.jobs(DONE):
+        if job["name"] in runner.tasks and job["signature"] is not None:
+            runner.record(
+                job["name"], job["signature"], job["seconds"],
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job["updated"]))
+            )
 
-    # Resolution constant (200 dpi)
-    res_cons = 72 / 200
 
-    # Convert report tables to CSV
-    report_tables_to_csv(
-        res_cons,
-        "antenne",
-        init_year=2003,
-        end_year=2024
-    )
+def run_sharded(args, argv, reports, cache):
+    """Enqueue, work on or report the shared queue of the sharded mode.
+
+    enqueue queues the stale tasks selected by the other options, with
+    their dependencies and the command line that selected them. Workers,
+    started with --shard work on any machine sharing the queue and the
+    data folder, rebuild the tasks from that command line and write their
+    outputs in the usual data/intermediate layout. enqueue and status
+    first record the completed jobs in the manifest.
+    Returns the names of the failed jobs.
+    """
+    work_queue = WorkQueue(args.queue, lease_seconds=args.lease)
+
+    if args.shard == "work":
+        # The runners of the command lines found in the jobs
+        runners = {}
 
-    report_tables_to_csv(
-        res_cons,
-        "national",
-        init_year=2003,
-        end_year=2024
+        def run_job(job):
+            job_argv = job["payload"]["argv"]
+            key = json.dumps(job_argv)
+            if key not in runners:
+                runners[key] = runner_from_args(parse_args(job_argv), reports, cache)
+            return runners[key].run_task(job["name"])
+
+        drain(work_queue, run_job)
+
+    else:
+        runner = runner_from_args(args, reports, cache)
+        merge_done_jobs(work_queue, runner)
+        if args.shard == "enqueue":
+            jobs = [
+                (task.name, {"argv": argv}, [dep for dep in task.deps if dep in runner.tasks])
+                for task in runner.stale_tasks()
+            ]
+            print(f"Queued {work_queue.enqueue(jobs)} of {len(jobs)} stale tasks")
+
+    work_queue.status()
+    failed = [job["name"] for job in work_queue.jobs("failed")]
+    work_queue.close()
+    return failed
+
+
+def stream_reports(args, reports, years, cache, client=None, dpi=200):
+    """Run the png, tensors and csv stages of the selected years as a stream.
+
+    The years are always rerun; the manifest is not used. Returns the
+    names of the failed years.
+    """
+    work_items, extract_years = [], set()
+    for report, settings in reports.items():
+        tables_dict = settings["tables_dict"]
+        for year in REPORT_YEARS[report]["png"]:
+            if str(year) not in tables_dict or (years is not None and year not in years):
+                continue
+            work_items.append((report, year, tables_dict[str(year)]))
+            if "csv" in args.stages and year in REPORT_YEARS[report]["csv"]:
+                extract_years.add((report, year))
+
+    if not work_items:
+        return []
+
+    image_processor, model = load_detector(args.backend) if client is None else (None, None)
+    pipeline = StreamingPipeline(
+        image_processor, model,
+        threshold=args.threshold, dpi=dpi, renderer=args.renderer,
+        render_workers=args.render_workers, detect_workers=args.detect_workers,
+        extract_workers=args.extract_workers, queue_size=args.queue_size,
+        cache=cache, client=client, store=open_store(args.table_store)
     )
+    return list(pipeline.run(work_items, extract_years))
+
+
+# Main function
+def main(argv=None):
+
+    args = parse_args(argv)
+
+    # Keep the model warm for later runs with --detector-url
+    if args.serve_detector:
+        serve_detector(*load_detector(args.backend), port=args.port)
+        return []
+
+    years = parse_years(args.years) if args.years else None
+
+    # Cache of the rendered pages, detected boxes and extracted tables
+    cache_path = r"./data/intermediate/artifact_cache"
+    cache = ArtifactCache(cache_path)
+
+    reports = load_reports()
+
+    if args.shard:
+        failed = run_sharded(args, sys.argv[1:] if argv is None else list(argv), reports, cache)
+    elif args.stream:
+        # Only the downloads go through the runner
+        runner = PipelineRunner(args.manifest, force=args.force)
+        build_tasks(runner, reports, years, set(args.stages) & {"download"}, cache)
+        failed = runner.run()
+        client = DetectionClient(args.detector_url) if args.detector_url else None
+        dpi = DETECT_DPI if args.dpi == "detect" else int(args.dpi)
+        failed += stream_reports(args, reports, years, cache, client=client, dpi=dpi)
+    else:
+        # Run the stale (report, year, stage) tasks
+        failed = runner_from_args(args, reports, cache).run()
+
+    # Summary of the work skipped thanks to the cache
+    cache.report()
+    cache.close()
+
+    return failed
+
+
+if __name__ == "__main__":
+    # A non-zero status stops main.py before the analysis
+    sys.exit(1 if main() else 0)